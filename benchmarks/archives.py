@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import tarfile
+
+logger = logging.getLogger(__name__)
+
+SIZE_REGEX = re.compile(r"^(?P<value>\d+)(?P<unit>[KMG]?)B?$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+# Layers are split into files of that size
+FILE_SIZE = 64 * 1024 * 1024
+
+# Each block of synthetic data is half random, half repeated bytes
+# so that compression ratios stay close to real images
+BLOCK_SIZE = 1024 * 1024
+
+
+def parse_size(value):
+    """
+    Parse a human readable size like 100M or 5G into bytes
+    """
+    match = SIZE_REGEX.match(value.strip())
+    assert match is not None, "Invalid size {}".format(value)
+    return int(match.group("value")) * SIZE_UNITS[match.group("unit").upper()]
+
+
+class SyntheticFile(io.RawIOBase):
+    """
+    Read-only file producing deterministic, partly compressible data
+    """
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.position = 0
+        self.random = random.Random(seed)
+        self.block = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        remaining = self.size - self.position
+        if remaining <= 0:
+            return 0
+        if not self.block:
+            half = BLOCK_SIZE // 2
+            filler = bytes([self.position % 251]) * half
+            self.block = memoryview(self.random.randbytes(half) + filler)
+        length = min(len(buffer), remaining, len(self.block))
+        buffer[:length] = self.block[:length]
+        self.block = self.block[length:]
+        self.position += length
+        return length
+
+
+def write_layer(path, size, seed):
+    """
+    Write a layer tarball holding synthetic files for a total of size bytes
+    """
+    with tarfile.open(path, "w") as tar:
+        index = 0
+        while size > 0:
+            file_size = min(size, FILE_SIZE)
+            info = tarfile.TarInfo("data/{}-{}.bin".format(seed, index))
+            info.size = file_size
+            data = SyntheticFile(file_size, "{}-{}".format(seed, index))
+            tar.addfile(info, io.BufferedReader(data))
+            size -= file_size
+            index += 1
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(BLOCK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_docker_archive(path, size, tag, layers=4):
+    """
+    Build a docker-archive image of roughly the requested size,
+    spread over several synthetic layers
+    """
+    workdir = "{}.layers".format(path)
+    os.makedirs(workdir, exist_ok=True)
+
+    layer_paths = []
+    for i in range(layers):
+        layer_path = os.path.join(workdir, "layer-{}.tar".format(i))
+        write_layer(layer_path, size // layers, seed="{}-{}".format(size, i))
+        layer_paths.append(layer_path)
+    diff_ids = ["sha256:{}".format(sha256_file(layer)) for layer in layer_paths]
+
+    config = json.dumps(
+        {
+            "architecture": "amd64",
+            "os": "linux",
+            "config": {"Cmd": ["/bin/true"]},
+            "rootfs": {"type": "layers", "diff_ids": diff_ids},
+            "history": [
+                {"created_by": "synthetic layer {}".format(i)} for i in range(layers)
+            ],
+        }
+    ).encode("utf-8")
+    config_name = "{}.json".format(hashlib.sha256(config).hexdigest())
+
+    layer_names = ["{}/layer.tar".format(diff_id[7:]) for diff_id in diff_ids]
+    manifest = json.dumps(
+        [{"Config": config_name, "RepoTags": [tag], "Layers": layer_names}]
+    ).encode("utf-8")
+
+    def _add_bytes(tar, name, content):
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+
+    with tarfile.open(path, "w") as tar:
+        _add_bytes(tar, config_name, config)
+        for layer_path, layer_name in zip(layer_paths, layer_names):
+            tar.add(layer_path, arcname=layer_name)
+            os.unlink(layer_path)
+        _add_bytes(tar, "manifest.json", manifest)
+    os.rmdir(workdir)
+
+    logger.info(
+        "Built synthetic image {} ({} bytes)".format(path, os.path.getsize(path))
+    )
+    return path
+
+
+def get_docker_archive(workdir, size, tag="127.0.0.1/benchmark/image:latest"):
+    """
+    Get a synthetic docker archive, reusing a previously generated one
+    """
+    path = os.path.join(workdir, "image-{}.tar".format(size))
+    if not os.path.exists(path):
+        build_docker_archive(path + ".tmp", size, tag)
+        os.replace(path + ".tmp", path)
+    return path
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import taskcluster
+
+from benchmarks.archives import get_docker_archive
+from benchmarks.archives import parse_size
+from benchmarks.standins import S3
+from benchmarks.standins import Queue
+from benchmarks.standins import Registry
+from taskboot.aws import push_s3
+from taskboot.docker import Skopeo
+from taskboot.docker import read_archive_tags
+from taskboot.docker import read_manifest
+from taskboot.docker import write_manifest
+from taskboot.utils import download_progress
+from taskboot.utils import load_artifacts
+from taskboot.utils import zstd_compress
+from taskboot.utils import zstd_decompress
+
+logger = logging.getLogger(__name__)
+
+ROOT_TASK = "benchmark-root"
+BUCKET = "benchmark"
+
+# Number of dependencies and of unrelated artifacts on each of them,
+# to exercise the artifact listing and filtering
+NB_DEPENDENCIES = 10
+NB_ARTIFACTS = 200
+
+
+def measure(name, operation, repeat, setup=None, size=None):
+    """
+    Run an operation several times, only timing the operation itself
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        operation()
+        durations.append(time.perf_counter() - start)
+
+    median = statistics.median(durations)
+    result = {
+        "median": median,
+        "min": min(durations),
+        "max": max(durations),
+        "runs": repeat,
+    }
+    if size:
+        result["bytes"] = size
+        result["throughput"] = size / median if median else None
+    logger.info("{}: median {:.3f}s over {} runs".format(name, median, repeat))
+    return result
+
+
+def copy(source, destination):
+    """
+    Setup helper copying a file before a destructive operation
+    """
+
+    def _copy():
+        shutil.copyfile(source, destination)
+
+    return _copy
+
+
+def setup_environment(workdir, queue, s3, registry):
+    """
+    Point the Taskcluster and AWS clients used by taskboot at the stand-ins
+    """
+    for key in list(os.environ):
+        if key.startswith("TASKCLUSTER_") or key.startswith("AWS_"):
+            del os.environ[key]
+    os.environ["TASKCLUSTER_PROXY_URL"] = queue.root_url
+
+    # Measure the transfers, not the local artifacts cache
+    os.environ["TASKBOOT_ARTIFACT_CACHE_SIZE"] = "0"
+
+    aws_config = os.path.join(workdir, "aws.cfg")
+    with open(aws_config, "w") as f:
+        f.write("[default]\ns3 =\n  addressing_style = path\n")
+    os.environ["AWS_CONFIG_FILE"] = aws_config
+    os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+    os.environ["AWS_ENDPOINT_URL"] = s3.url
+
+    # Skopeo must use plain HTTP with the local registry
+    registries = os.path.join(workdir, "registries.conf")
+    with open(registries, "w") as f:
+        f.write(
+            '[[registry]]\nlocation = "{}"\ninsecure = true\n'.format(registry.host)
+        )
+    os.environ["CONTAINERS_REGISTRIES_CONF"] = registries
+
+    taskboot_config = os.path.join(workdir, "taskboot.yml")
+    with open(taskboot_config, "w") as f:
+        json.dump({"aws": {"access_key_id": "key", "secret_access_key": "secret"}}, f)
+    return taskboot_config
+
+
+def run_benchmarks(workdir, sizes, repeat):
+    results = {}
+
+    with Queue() as queue, S3([BUCKET]) as s3, Registry() as registry:
+        taskboot_config = setup_environment(workdir, queue, s3, registry)
+        tc_queue = taskcluster.Queue({"rootUrl": queue.root_url})
+
+        # Unrelated artifacts, only used by the listing
+        dependencies = ["benchmark-dep-{}".format(i) for i in range(NB_DEPENDENCIES)]
+        filler = {
+            "public/logs/{}.log".format(i): os.devnull for i in range(NB_ARTIFACTS)
+        }
+        for task_id in dependencies:
+            queue.add_task(task_id, artifacts=filler)
+        queue.add_task(ROOT_TASK, dependencies)
+
+        results["load_artifacts"] = measure(
+            "load_artifacts",
+            lambda: load_artifacts(ROOT_TASK, tc_queue, "public/**.tar.zst"),
+            repeat,
+        )
+
+        for size_name in sizes:
+            size = parse_size(size_name)
+            archive = get_docker_archive(workdir, size)
+            archive_size = os.path.getsize(archive)
+            path = os.path.join(workdir, "work.tar")
+
+            # Serve the archive as an artifact of the first dependency
+            queue.artifacts[dependencies[0]].update(
+                {
+                    "public/image.tar": archive,
+                    "public/site/image.tar": archive,
+                }
+            )
+
+            def _key(name):
+                return "{}[{}]".format(name, size_name)
+
+            url = "{}/storage/{}/public/image.tar".format(queue.url, dependencies[0])
+            results[_key("download_progress")] = measure(
+                _key("download_progress"),
+                lambda: download_progress(url, path),
+                repeat,
+                size=archive_size,
+            )
+
+            results[_key("read_archive_tags")] = measure(
+                _key("read_archive_tags"),
+                lambda: read_archive_tags(archive),
+                repeat,
+            )
+
+            manifest = read_manifest(archive)
+            manifest[0]["RepoTags"].append("127.0.0.1/benchmark/image:other")
+            results[_key("write_manifest")] = measure(
+                _key("write_manifest"),
+                lambda: write_manifest(path, manifest),
+                repeat,
+                setup=copy(archive, path),
+            )
+
+            results[_key("zstd_compress")] = measure(
+                _key("zstd_compress"),
+                lambda: zstd_compress(path),
+                repeat,
+                setup=copy(archive, path),
+                size=archive_size,
+            )
+
+            # Keep a compressed copy to restore before each decompression
+            compressed = os.path.join(workdir, "work.tar.zst.orig")
+            shutil.copyfile(path + ".zst", compressed)
+            results[_key("zstd_decompress")] = measure(
+                _key("zstd_decompress"),
+                lambda: zstd_decompress(path),
+                repeat,
+                setup=copy(compressed, path + ".zst"),
+                size=archive_size,
+            )
+            os.unlink(compressed)
+
+            def _push_s3():
+                with open(taskboot_config) as config:
+                    args = argparse.Namespace(
+                        task_id=ROOT_TASK,
+                        artifact_folder="public/site",
+                        bucket=BUCKET,
+                        secret=None,
+                        config=config,
+                    )
+                    push_s3(None, args)
+
+            results[_key("push_s3")] = measure(
+                _key("push_s3"), _push_s3, repeat, size=archive_size
+            )
+
+            if shutil.which("skopeo"):
+                skopeo = Skopeo()
+                skopeo.login(registry.host, "user", "password")
+                tag = "{}/benchmark/image:latest".format(registry.host)
+
+                def _reset_registry():
+                    registry.blobs.clear()
+
+                results[_key("push_archive")] = measure(
+                    _key("push_archive"),
+                    lambda: skopeo.push_archive(archive, tag),
+                    repeat,
+                    setup=_reset_registry,
+                    size=archive_size,
+                )
+            else:
+                logger.warning("Skopeo is not available, skipping push_archive")
+
+            del queue.artifacts[dependencies[0]]["public/image.tar"]
+            del queue.artifacts[dependencies[0]]["public/site/image.tar"]
+            if os.path.exists(path):
+                os.unlink(path)
+
+    results["cli_startup"] = measure(
+        "cli_startup",
+        lambda: subprocess.run(
+            [sys.executable, "-m", "taskboot.cli", "--help"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        ),
+        repeat,
+    )
+
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """
+    List the benchmarks slower than their baseline beyond the tolerance
+    Slowdowns under min_delta seconds are timing noise on the fastest
+    benchmarks, and never reported
+    """
+    regressions = []
+    for name, reference in sorted(baseline.get("benchmarks", {}).items()):
+        if name not in results:
+            logger.warning("Benchmark {} is in baseline but was not run".format(name))
+            continue
+        current = results[name]["median"]
+        limit = reference["median"] * (1 + tolerance)
+        ratio = current / reference["median"] if reference["median"] else 0
+        logger.info(
+            "{}: {:.3f}s vs {:.3f}s in baseline ({:+.1%})".format(
+                name, current, reference["median"], ratio - 1
+            )
+        )
+        if current > limit and current - reference["median"] > min_delta:
+            regressions.append((name, current, reference["median"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="benchmarks", description="Benchmark taskboot transfer and archive paths"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: value.split(","),
+        default=["100M"],
+        help="Comma separated sizes of the synthetic images (example: 100M,1G,5G)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs for each benchmark"
+    )
+    parser.add_argument(
+        "--workdir",
+        type=str,
+        help="Directory to store the synthetic images, reused across runs",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="benchmarks.json",
+        help="Path to write the JSON results",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=os.path.join(os.path.dirname(__file__), "baseline.json"),
+        help="Path to the baseline results to compare against",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown ratio over the baseline before failing",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=0.05,
+        help="Minimum slowdown over the baseline before failing, in seconds",
+    )
+    parser.add_argument(
+        "--require-baseline",
+        action="store_true",
+        help="Fail when the baseline is missing, instead of only warning",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Store the results as the new baseline",
+    )
+    args = parser.parse_args()
+    assert args.repeat > 0, "Repeat must be a positive integer"
+
+    logging.basicConfig(level=logging.INFO)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="taskboot-benchmarks-")
+    os.makedirs(workdir, exist_ok=True)
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "benchmarks": run_benchmarks(workdir, args.sizes, args.repeat),
+    }
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logger.info("Written results in {}".format(args.output))
+
+    if args.update_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        logger.info("Updated baseline {}".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        if args.require_baseline:
+            logger.error("No baseline found in {}".format(args.baseline))
+            sys.exit(1)
+        logger.warning("No baseline found in {}".format(args.baseline))
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(
+        results["benchmarks"], baseline, args.tolerance, args.min_delta
+    )
+    if regressions:
+        for name, current, reference in regressions:
+            logger.error(
+                "PERFORMANCE REGRESSION {}: {:.3f}s, baseline {:.3f}s".format(
+                    name, current, reference
+                )
+            )
+        sys.exit(1)
+    logger.info("No performance regression found")
+
+
+if __name__ == "__main__":
+    main()
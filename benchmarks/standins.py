@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Common helpers for the local HTTP services used by the benchmarks
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def read_body(self, sink):
+        """
+        Stream the request body into a callable, supporting chunked encoding
+        Returns the number of bytes read
+        """
+        size = 0
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                chunk_size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if chunk_size == 0:
+                    # Skip trailers until the final empty line
+                    while self.rfile.readline().strip():
+                        pass
+                    return size
+                remaining = chunk_size
+                while remaining:
+                    data = self.rfile.read(min(remaining, CHUNK_SIZE))
+                    sink(data)
+                    remaining -= len(data)
+                size += chunk_size
+                self.rfile.readline()
+
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            data = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                break
+            sink(data)
+            size += len(data)
+            remaining -= len(data)
+        return size
+
+    def send(self, status, body=b"", headers={}):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+            headers = dict(headers, **{"Content-Type": "application/json"})
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def send_file(self, path):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                self.wfile.write(chunk)
+
+
+class StandIn(object):
+    """
+    Run a stand-in service on a random local port, in a background thread
+    """
+
+    handler = StandInHandler
+
+    def __init__(self):
+        handler = type(self.handler.__name__, (self.handler,), {"service": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        return "127.0.0.1:{}".format(self.server.server_address[1])
+
+    @property
+    def url(self):
+        return "http://{}".format(self.host)
+
+    def __enter__(self):
+        self.thread.start()
+        logger.info("Started {} on {}".format(self.__class__.__name__, self.url))
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class QueueHandler(StandInHandler):
+    """
+    Subset of the Taskcluster queue API used by taskboot
+    Artifacts are served through a redirection, like on Taskcluster
+    """
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path)
+
+        match = re.match(r"^/api/queue/v1/task/([\w\-]+)$", path)
+        if match:
+            task_id = match.group(1)
+            return self.send(
+                200, {"dependencies": self.service.dependencies.get(task_id, [])}
+            )
+
+        match = re.match(r"^/api/queue/v1/task/([\w\-]+)/status$", path)
+        if match:
+            return self.send(
+                200,
+                {"status": {"taskId": match.group(1), "runs": [{"runId": 0}]}},
+            )
+
+        match = re.match(
+            r"^/api/queue/v1/task/([\w\-]+)/runs/0/artifact-info/(.+)$", path
+        )
+        if match:
+            task_id, name = match.groups()
+            if name not in self.service.artifacts.get(task_id, {}):
+                return self.send(404, {"message": "Missing artifact"})
+            return self.send(200, {"storageType": "s3", "name": name})
+
+        match = re.match(r"^/api/queue/v1/task/([\w\-]+)/artifacts$", path)
+        if match:
+            artifacts = self.service.artifacts.get(match.group(1), {})
+            return self.send(
+                200,
+                {
+                    "artifacts": [
+                        {"storageType": "s3", "name": name, "contentType": "x"}
+                        for name in sorted(artifacts)
+                    ]
+                },
+            )
+
+        match = re.match(
+            r"^/api/queue/v1/task/([\w\-]+)/(?:runs/0/)?artifacts/(.+)$", path
+        )
+        if match:
+            task_id, name = match.groups()
+            if name not in self.service.artifacts.get(task_id, {}):
+                return self.send(404, {"message": "Missing artifact"})
+            location = "/storage/{}/{}".format(task_id, name)
+            return self.send(303, headers={"Location": location})
+
+        match = re.match(r"^/storage/([\w\-]+)/(.+)$", path)
+        if match:
+            task_id, name = match.groups()
+            return self.send_file(self.service.artifacts[task_id][name])
+
+        self.send(404, {"message": "Unknown route {}".format(path)})
+
+
+class Queue(StandIn):
+    """
+    Local stand-in for the Taskcluster queue artifact endpoints
+    """
+
+    handler = QueueHandler
+
+    def __init__(self):
+        super().__init__()
+        self.dependencies = {}
+        self.artifacts = {}
+
+    def add_task(self, task_id, dependencies=[], artifacts={}):
+        """
+        Declare a task, its dependencies and its artifacts as name: local path
+        """
+        self.dependencies[task_id] = list(dependencies)
+        self.artifacts[task_id] = dict(artifacts)
+
+    @property
+    def root_url(self):
+        return self.url
+
+
+class RegistryHandler(StandInHandler):
+    """
+    Subset of the Docker registry HTTP API v2 needed to push images
+    Blob content is only hashed and counted, never stored
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/v2/":
+            return self.send(
+                200, {}, {"Docker-Distribution-API-Version": "registry/2.0"}
+            )
+
+        match = re.match(r"^/v2/(.+)/blobs/(sha256:\w+)$", path)
+        if match:
+            size = self.service.blobs.get(match.group(2))
+            if size is None:
+                return self.send(404, {"errors": [{"code": "BLOB_UNKNOWN"}]})
+            self.send_response(200)
+            self.send_header("Content-Length", str(size))
+            self.send_header("Docker-Content-Digest", match.group(2))
+            self.end_headers()
+            return
+
+        match = re.match(r"^/v2/(.+)/manifests/(.+)$", path)
+        if match:
+            manifest = self.service.manifests.get(match.groups())
+            if manifest is None:
+                return self.send(404, {"errors": [{"code": "MANIFEST_UNKNOWN"}]})
+            content_type, body = manifest
+            digest = "sha256:{}".format(hashlib.sha256(body).hexdigest())
+            return self.send(
+                200,
+                body,
+                {"Content-Type": content_type, "Docker-Content-Digest": digest},
+            )
+
+        self.send(404, {"errors": [{"code": "UNSUPPORTED"}]})
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        match = re.match(r"^/v2/(.+)/blobs/uploads/$", url.path)
+        if not match:
+            return self.send(404, {"errors": [{"code": "UNSUPPORTED"}]})
+        name = match.group(1)
+        self.read_body(lambda data: None)
+
+        # Cross repository mounts only need the blob to exist
+        mount = parse_qs(url.query).get("mount")
+        if mount and mount[0] in self.service.blobs:
+            return self.send(
+                201,
+                headers={
+                    "Location": "/v2/{}/blobs/{}".format(name, mount[0]),
+                    "Docker-Content-Digest": mount[0],
+                },
+            )
+
+        upload_id = str(uuid.uuid4())
+        self.service.uploads[upload_id] = (hashlib.sha256(), [0])
+        self.send(
+            202,
+            headers={
+                "Location": "/v2/{}/blobs/uploads/{}".format(name, upload_id),
+                "Docker-Upload-UUID": upload_id,
+                "Range": "0-0",
+            },
+        )
+
+    def receive_upload(self, upload_id):
+        digest, size = self.service.uploads[upload_id]
+
+        def _sink(data):
+            digest.update(data)
+            size[0] += len(data)
+
+        self.read_body(_sink)
+        return digest, size[0]
+
+    def do_PATCH(self):
+        path = urlparse(self.path).path
+        match = re.match(r"^/v2/(.+)/blobs/uploads/([\w\-]+)$", path)
+        if not match or match.group(2) not in self.service.uploads:
+            return self.send(404, {"errors": [{"code": "BLOB_UPLOAD_UNKNOWN"}]})
+        name, upload_id = match.groups()
+        _, size = self.receive_upload(upload_id)
+        self.send(
+            202,
+            headers={
+                "Location": "/v2/{}/blobs/uploads/{}".format(name, upload_id),
+                "Docker-Upload-UUID": upload_id,
+                "Range": "0-{}".format(max(size - 1, 0)),
+            },
+        )
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+
+        match = re.match(r"^/v2/(.+)/blobs/uploads/([\w\-]+)$", url.path)
+        if match and match.group(2) in self.service.uploads:
+            name, upload_id = match.groups()
+            digest, size = self.receive_upload(upload_id)
+            del self.service.uploads[upload_id]
+            expected = parse_qs(url.query)["digest"][0]
+            actual = "sha256:{}".format(digest.hexdigest())
+            if actual != expected:
+                return self.send(400, {"errors": [{"code": "DIGEST_INVALID"}]})
+            self.service.blobs[actual] = size
+            self.service.uploaded_bytes += size
+            return self.send(
+                201,
+                headers={
+                    "Location": "/v2/{}/blobs/{}".format(name, actual),
+                    "Docker-Content-Digest": actual,
+                },
+            )
+
+        match = re.match(r"^/v2/(.+)/manifests/(.+)$", url.path)
+        if match:
+            body = []
+            self.read_body(body.append)
+            body = b"".join(body)
+            self.service.manifests[match.groups()] = (
+                self.headers.get("Content-Type"),
+                body,
+            )
+            digest = "sha256:{}".format(hashlib.sha256(body).hexdigest())
+            return self.send(
+                201,
+                headers={
+                    "Location": "/v2/{}/manifests/{}".format(match.group(1), digest),
+                    "Docker-Content-Digest": digest,
+                },
+            )
+
+        self.send(404, {"errors": [{"code": "UNSUPPORTED"}]})
+
+
+class Registry(StandIn):
+    """
+    Local stand-in for a docker registry
+    """
+
+    handler = RegistryHandler
+
+    def __init__(self):
+        super().__init__()
+        self.blobs = {}
+        self.manifests = {}
+        self.uploads = {}
+        self.uploaded_bytes = 0
+
+
+class S3Handler(StandInHandler):
+    """
+    Subset of the S3 API used by taskboot, with path style addressing
+    Objects are only counted, never stored
+    """
+
+    def do_HEAD(self):
+        bucket = urlparse(self.path).path.strip("/")
+        if bucket not in self.service.buckets:
+            return self.send(404)
+        self.send(200)
+
+    def do_PUT(self):
+        path = urlparse(self.path).path.lstrip("/")
+        bucket, _, key = path.partition("/")
+        if bucket not in self.service.buckets:
+            return self.send(404)
+
+        digest = hashlib.md5()
+        size = self.read_body(digest.update)
+        self.service.buckets[bucket][unquote(key)] = size
+        self.send(200, headers={"ETag": '"{}"'.format(digest.hexdigest())})
+
+
+class S3(StandIn):
+    """
+    Local stand-in for an AWS S3 endpoint
+    """
+
+    handler = S3Handler
+
+    def __init__(self, buckets=[]):
+        super().__init__()
+        self.buckets = {bucket: {} for bucket in buckets}
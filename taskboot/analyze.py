@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import fnmatch
+import json
+import logging
+import os
+import re
+import stat
+
+from dockerfile_parse import DockerfileParser
+
+from taskboot.docker import list_build_context
+
+logger = logging.getLogger(__name__)
+
+# Build contexts above this size should exclude files through a .dockerignore
+LARGE_CONTEXT_SIZE = 50 * 1024**2
+
+# Commands installing the dependencies of a project
+INSTALL_REGEX = re.compile(
+    r"\b(apt-get install|apt install|apk add|yum install|dnf install"
+    r"|pip3? install|poetry install|pipenv install|npm (install|ci)|yarn install"
+    r"|bundle install|go mod download|cargo fetch|composer install)\b"
+)
+
+APT_UPDATE_REGEX = re.compile(r"\bapt(-get)? update\b")
+APT_INSTALL_REGEX = re.compile(r"\bapt(-get)? install\b")
+
+
+def instruction_arguments(value):
+    """
+    Split the value of a COPY or ADD instruction into its flags and paths,
+    supporting both the shell and JSON forms
+    """
+    flags = {}
+    words = value.split()
+    while words and words[0].startswith("--"):
+        name, _, flag_value = words.pop(0)[2:].partition("=")
+        flags[name] = flag_value
+    rest = " ".join(words)
+    if rest.startswith("["):
+        try:
+            return flags, [str(path) for path in json.loads(rest)]
+        except ValueError:
+            pass
+    return flags, words
+
+
+def image_tag(image):
+    """
+    Get the tag and digest of an image reference, supporting registries with a port
+    """
+    image, _, digest = image.partition("@")
+    name, _, tag = image.rpartition(":")
+    if not name or "/" in tag:
+        tag = ""
+    return tag, digest
+
+
+def matches_source(path, source):
+    """
+    Check if a context path is sent by a COPY or ADD source, either directly
+    or through one of its parent directories
+    """
+    while path:
+        if fnmatch.fnmatchcase(path, source):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def context_files(context_dir, dockerfile):
+    """
+    List the regular files of the build context with their size
+    """
+    files, _ = list_build_context(context_dir, dockerfile)
+    sizes = {}
+    for rel_path, full_path in files:
+        info = os.lstat(full_path)
+        if stat.S_ISREG(info.st_mode):
+            sizes[rel_path] = info.st_size
+    return sizes
+
+
+def analyze_dockerfile(dockerfile, context_dir):
+    """
+    Inspect the instructions of a Dockerfile for patterns defeating the layer
+    cache or inflating the image, estimating the context sent by each one
+    """
+    parser = DockerfileParser()
+    parser.dockerfile_path = dockerfile
+    parser.content = open(dockerfile).read()
+
+    files = context_files(context_dir, dockerfile)
+    context_size = sum(files.values())
+    has_dockerignore = os.path.exists(os.path.join(context_dir, ".dockerignore"))
+
+    instructions = []
+    findings = []
+
+    def _finding(rule, line, message):
+        findings.append({"rule": rule, "line": line, "message": message})
+
+    if not has_dockerignore and context_size > LARGE_CONTEXT_SIZE:
+        _finding(
+            "missing-dockerignore",
+            None,
+            "The build context weighs {} bytes without any .dockerignore, "
+            "every build sends and hashes all of it".format(context_size),
+        )
+
+    stages = set()
+    context_copy = None
+    for instruction in parser.structure:
+        name, value = instruction["instruction"], instruction["value"]
+        line = instruction["startline"] + 1
+        summary = {"line": line, "instruction": name, "value": value}
+
+        if name == "FROM":
+            # Each stage has its own cache chain
+            context_copy = None
+            words = [word for word in value.split() if not word.startswith("--")]
+            image = words[0] if words else ""
+            if len(words) == 3 and words[1].lower() == "as":
+                stages.add(words[2].lower())
+            tag, digest = image_tag(image)
+            if (
+                image.lower() not in stages | {"scratch"}
+                and "$" not in image
+                and not digest
+                and tag in ("", "latest")
+            ):
+                _finding(
+                    "unpinned-base-image",
+                    line,
+                    "Base image {} is not pinned to a version or digest, "
+                    "its updates silently invalidate the cache".format(image),
+                )
+
+        elif name in ("COPY", "ADD"):
+            flags, paths = instruction_arguments(value)
+            if "from" not in flags and len(paths) > 1:
+                sources = [
+                    os.path.normpath(source.lstrip("/")) for source in paths[:-1]
+                ]
+                sent = [
+                    path
+                    for path in files
+                    if any(
+                        source == "." or matches_source(path, source)
+                        for source in sources
+                    )
+                ]
+                summary["context_files"] = len(sent)
+                summary["context_bytes"] = sum(files[path] for path in sent)
+                if "." in sources and context_copy is None:
+                    context_copy = line
+
+        elif name == "RUN":
+            if APT_UPDATE_REGEX.search(value) and not APT_INSTALL_REGEX.search(value):
+                _finding(
+                    "apt-get-update-alone",
+                    line,
+                    "apt-get update runs in its own layer, later installs "
+                    "can use a stale cached package index",
+                )
+            if context_copy is not None and INSTALL_REGEX.search(value):
+                _finding(
+                    "copy-before-install",
+                    context_copy,
+                    "The whole context is copied before installing dependencies "
+                    "at line {}, any change in the sources installs them again; "
+                    "copy the dependency manifests first".format(line),
+                )
+                # Only report the first install after the copy
+                context_copy = None
+
+        instructions.append(summary)
+
+    return {
+        "dockerfile": dockerfile,
+        "context": context_dir,
+        "context_files": len(files),
+        "context_bytes": context_size,
+        "dockerignore": has_dockerignore,
+        "instructions": instructions,
+        "findings": findings,
+    }
+
+
+def log_findings(report):
+    for finding in report["findings"]:
+        location = report["dockerfile"]
+        if finding["line"] is not None:
+            location += ":{}".format(finding["line"])
+        logger.warning(
+            "{} [{}] {}".format(location, finding["rule"], finding["message"])
+        )
+    if not report["findings"]:
+        logger.info("No cache issue found in {}".format(report["dockerfile"]))
+
+
+def analyze(target, args):
+    """
+    Report the cache efficiency issues of a Dockerfile as JSON
+    """
+    dockerfile = target.check_path(args.dockerfile)
+    context_dir = target.check_path(args.context) if args.context else target.dir
+    report = analyze_dockerfile(dockerfile, context_dir)
+    log_findings(report)
+    print(json.dumps(report, indent=2))
@@ -6,6 +6,7 @@
 import argparse
 import logging
 import mimetypes
+import os
 from datetime import datetime
 
 import boto3
@@ -14,6 +15,7 @@ import taskcluster
 
 from taskboot.config import Configuration
 from taskboot.target import Target
+from taskboot.tracing import span
 from taskboot.utils import download_artifact
 from taskboot.utils import load_artifacts
 
@@ -69,12 +71,14 @@ def push_s3(target: Target, args: argparse.Namespace) -> None:
 
         # Push that artifact on the S3 bucket, without the artifact folder
         s3_path = artifact_name[len(args.artifact_folder) + 1 :]
-        s3.put_object(
-            Bucket=args.bucket,
-            Key=s3_path,
-            Body=open(local_path, "rb"),
-            ContentType=content_type,
-        )
+        with span("upload", key=s3_path) as s:
+            s.add_bytes(os.path.getsize(local_path))
+            s3.put_object(
+                Bucket=args.bucket,
+                Key=s3_path,
+                Body=open(local_path, "rb"),
+                ContentType=content_type,
+            )
         logger.info("Uploaded {} as {} on S3".format(s3_path, content_type))
 
     cloudfront_distribution_id = config.aws.get("cloudfront_distribution_id")
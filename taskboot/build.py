@@ -3,20 +3,44 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import functools
+import glob
 import json
 import logging
 import os.path
+import shutil
+import statistics
+import tempfile
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import taskcluster
 import taskcluster_urls
 import yaml
 
+from taskboot.analyze import analyze_dockerfile
+from taskboot.analyze import log_findings
 from taskboot.config import Configuration
+from taskboot.docker import BuildCache
 from taskboot.docker import DinD
 from taskboot.docker import Docker
+from taskboot.docker import ImageInventory
 from taskboot.docker import Podman
+from taskboot.docker import PodmanStorage
+from taskboot.docker import image_key
+from taskboot.docker import is_ignored
+from taskboot.docker import is_local_cache
+from taskboot.docker import pack_oci_layout
 from taskboot.docker import patch_dockerfile
+from taskboot.docker import read_dockerignore
+from taskboot.docker import read_parent_images
+from taskboot.history import BuildHistory
+from taskboot.history import repository_key
+from taskboot.retry import POLICIES
+from taskboot.tracing import span
+from taskboot.tracing import tracer
+from taskboot.utils import DiskUsageMonitor
 from taskboot.utils import retry
 from taskboot.utils import zstd_compress
 
@@ -47,14 +71,77 @@ def gen_docker_images(docker_image_name, tags=None, registry=None):
     return result
 
 
-def build_image(target, args):
+def build_caches(args, key, build_tool):
+    """
+    Setup the build cache locations of an image, scoped by branch
+    """
+    caches = [
+        BuildCache(location, key, args.cache_branch, args.cache_default_branch)
+        if location
+        else None
+        for location in (args.cache_from, args.cache_to)
+    ]
+    for cache in caches:
+        if cache is not None:
+            assert not (cache.local and isinstance(build_tool, Podman)), (
+                "Podman only supports registry repositories as build cache"
+            )
+            scope = " or ".join(cache.branches)
+            logger.info(f"Using build cache {cache.location} for {key} ({scope})")
+    return caches
+
+
+def login_cache_registry(build_tool, config, args):
+    """
+    Login on the registry of the build cache, when credentials are available
+    """
+    if not any(
+        location and not is_local_cache(location)
+        for location in (args.cache_from, args.cache_to)
+    ):
+        return
+    login_registry(build_tool, config)
+
+
+def login_registry(build_tool, config):
+    """
+    Login on the configured registry, to pull or push images when allowed
+    """
+    if not config.has_docker_auth():
+        logger.warning("No Docker authentication, using the registry anonymously")
+        return
+    build_tool.login(
+        config.docker["registry"], config.docker["username"], config.docker["password"]
+    )
+
+
+def with_podman_storage(func):
+    """
+    Run a build command with the persistent podman storage, when configured
+    """
+
+    @functools.wraps(func)
+    def wrapper(target, args):
+        if not args.podman_storage:
+            return func(target, args)
+        with PodmanStorage(args.podman_storage, args.podman_storage_size) as storage:
+            return func(target, args, storage)
+
+    return wrapper
+
+
+@with_podman_storage
+def build_image(target, args, storage=None):
     """
     Build a docker image and allow save/push
     """
+    assert storage is None or args.build_tool == "podman", (
+        "A persistent storage is only supported with podman"
+    )
     if args.build_tool == "docker":
         build_tool = Docker()
     elif args.build_tool == "podman":
-        build_tool = Podman()
+        build_tool = Podman(storage)
     elif args.build_tool == "dind":
         build_tool = DinD()
     else:
@@ -65,6 +152,8 @@ def build_image(target, args):
 
     # Check the dockerfile is available in target
     dockerfile = target.check_path(args.dockerfile)
+    if args.lint_cache:
+        log_findings(analyze_dockerfile(dockerfile, target.dir))
 
     # Check the output is writable
     output = None
@@ -89,27 +178,164 @@ def build_image(target, args):
 
         # Login on docker
         build_tool.login(registry, config.docker["username"], config.docker["password"])
+    else:
+        login_cache_registry(build_tool, config, args)
 
     # Build the image
-    build_tool.build(target.dir, dockerfile, tags, args.build_arg)
+    cache_from, cache_to = build_caches(args, base_image.rsplit(":", 1)[0], build_tool)
+    with span("build", image=tags[0]):
+        build_tool.build(
+            target.dir, dockerfile, tags, args.build_arg, cache_from, cache_to
+        )
 
     # Write the produced image
     if output:
-        build_tool.save(tags, output)
+        with span("save", image=tags[0]) as s:
+            build_tool.save(tags, output)
+            s.add_bytes(os.path.getsize(output))
         zstd_compress(output)
 
     # Push the produced image
     if args.push:
         for tag in tags:
-            build_tool.push(tag)
+            with span("push", image=tag):
+                build_tool.push(tag)
 
 
-def build_compose(target, args):
+def compose_images(services, root, args):
+    """
+    List the images to build for the compose services, with the services
+    building their parent images
+    """
+    images = []
+    for name, service in services.items():
+        build = service.get("build")
+        if build is None:
+            logger.info("Skipping service {}, no build declaration".format(name))
+            continue
+
+        if args.service and name not in args.service:
+            msg = "Skipping service {}, building only {}".format(name, args.service)
+            logger.info(msg)
+            continue
+
+        context = os.path.realpath(os.path.join(root, build.get("context", ".")))
+        dockerfile = os.path.realpath(
+            os.path.join(context, build.get("dockerfile", "Dockerfile"))
+        )
+        docker_image = service.get("image", name)
+        images.append(
+            {
+                "service": name,
+                "image": docker_image,
+                "context": context,
+                "dockerfile": dockerfile,
+                "tags": gen_docker_images(docker_image, args.tag, args.registry),
+                "from": read_parent_images(dockerfile),
+            }
+        )
+
+    # Match the parent images with the images built by other services
+    builders = {
+        image_key(tag): image["service"] for image in images for tag in image["tags"]
+    }
+    for image in images:
+        image["parents"] = {
+            builders[image_key(parent)]
+            for parent in image.pop("from")
+            if builders.get(image_key(parent), image["service"]) != image["service"]
+        }
+    return images
+
+
+def changed_services(target, images, composefile, revision):
+    """
+    Find the services affected by the changes since a revision: changes in
+    their build context or Dockerfile, or in the images of their parents
+    """
+    changes = [
+        os.path.realpath(os.path.join(target.dir, path))
+        for path in target.changed_files(revision)
+    ]
+    if os.path.realpath(composefile) in changes:
+        logger.info("The compose file changed, all services are affected")
+        return {image["service"] for image in images}
+
+    affected = set()
+    for image in images:
+        patterns = read_dockerignore(image["context"])
+        for path in changes:
+            relative = os.path.relpath(path, image["context"])
+            if path == image["dockerfile"] or (
+                not relative.startswith("..") and not is_ignored(relative, patterns)
+            ):
+                logger.info(f"Service {image['service']} is affected by {path}")
+                affected.add(image["service"])
+                break
+
+    # Services using an affected image as parent must be built again too
+    while True:
+        children = {
+            image["service"]
+            for image in images
+            if image["parents"] & affected and image["service"] not in affected
+        }
+        if not children:
+            return affected
+        logger.info("Affected through their parent images: {}".format(children))
+        affected |= children
+
+
+def schedule_images(images, estimates):
+    """
+    Order the images so that parents are built before their children, and
+    the longest builds start first among the ones ready to build
+    Services without any estimate are ranked at the median of the others,
+    so that a new slow service is not always built last
+    Builds run one at a time: the order does not shorten the whole build,
+    it only surfaces the slow builds and their failures earlier
+    """
+    known = [estimate for estimate in estimates.values() if estimate is not None]
+    default = statistics.median(known) if known else 0
+
+    def _estimate(image):
+        estimate = estimates.get(image["service"])
+        return default if estimate is None else estimate
+
+    pending = list(images)
+    remaining = {image["service"] for image in images}
+    scheduled = []
+    while pending:
+        ready = [image for image in pending if not image["parents"] & remaining]
+        assert ready, "Circular parent images between services {}".format(
+            ", ".join(sorted(remaining))
+        )
+        image = max(ready, key=_estimate)
+        pending.remove(image)
+        remaining.discard(image["service"])
+        scheduled.append(image)
+    return scheduled
+
+
+def reuse_image(build_tool, image, args):
+    """
+    Use the published image of a service instead of building it again
+    """
+    published = gen_docker_images(image["image"], [args.reuse_tag], args.registry)[0]
+    build_tool.pull(published)
+    for tag in image["tags"]:
+        if tag != published:
+            build_tool.tag(published, tag)
+
+
+@with_podman_storage
+def build_compose(target, args, storage=None):
     """
     Read a compose file and build each image described as buildable
     """
     assert args.build_retries > 0, "Build retries must be a positive integer"
-    build_tool = Podman()
+    build_policy = POLICIES["build"].copy(retries=args.build_retries)
+    build_tool = Podman(storage)
 
     # Check the dockerfile is available in target
     composefile = target.check_path(args.composefile)
@@ -124,11 +350,19 @@ def build_compose(target, args):
 
     # Check output folder
     output = None
+    layout_dir = None
+    assert args.write or not args.remove_images, (
+        "Images can only be removed once written"
+    )
     if args.write:
         output = os.path.realpath(args.write)
         os.makedirs(output, exist_ok=True)
         logger.info("Will write images in {}".format(output))
 
+        # All services share a single OCI layout, storing each layer once
+        if args.format == "oci-layout":
+            layout_dir = tempfile.mkdtemp(prefix="taskboot-oci-")
+
     # Load services
     services = compose.get("services")
     assert isinstance(services, dict), "Missing services"
@@ -136,46 +370,237 @@ def build_compose(target, args):
     # All paths are relative to the dockerfile folder
     root = os.path.dirname(composefile)
 
-    for name, service in services.items():
-        build = service.get("build")
-        if build is None:
-            logger.info("Skipping service {}, no build declaration".format(name))
-            continue
-
-        if args.service and name not in args.service:
-            msg = "Skipping service {}, building only {}".format(name, args.service)
-            logger.info(msg)
-            continue
+    # All the services share the same build cache locations
+    if args.cache_from or args.cache_to:
+        login_cache_registry(build_tool, Configuration(args), args)
+
+    # List the local images once, the inventory is then updated after each build
+    inventory = ImageInventory.load(build_tool)
+
+    images = compose_images(services, root, args)
+
+    # Only build the services affected by the changes since a revision
+    reused = set()
+    if args.changed_since:
+        affected = changed_services(target, images, composefile, args.changed_since)
+        reused = {image["service"] for image in images} - affected
+        logger.info(
+            "Changes since {}: building {}, reusing {}".format(
+                args.changed_since,
+                ", ".join(sorted(affected)) or "nothing",
+                ", ".join(sorted(reused)) or "nothing",
+            )
+        )
 
-        # Build the image
-        logger.info("Building image for service {}".format(name))
-        context = os.path.realpath(os.path.join(root, build.get("context", ".")))
-        dockerfile = os.path.realpath(
-            os.path.join(context, build.get("dockerfile", "Dockerfile"))
+        # The published images are only needed to write them again
+        if not output:
+            images = [image for image in images if image["service"] in affected]
+        elif reused:
+            login_registry(build_tool, Configuration(args))
+
+    # Start the longest builds first, using the durations of the previous ones,
+    # so that slow builds and their failures show up early in the logs
+    with BuildHistory(args.build_history) as history:
+        repository = repository_key(target, args)
+        estimates = {
+            image["service"]: history.estimate(repository, image["service"])
+            for image in images
+            if image["service"] not in reused
+        }
+        images = schedule_images(images, estimates)
+        order = []
+        for image in images:
+            estimate = estimates.get(image["service"])
+            if image["service"] in reused:
+                order.append("{} (reused)".format(image["service"]))
+            elif estimate is None:
+                order.append("{} (never built)".format(image["service"]))
+            else:
+                order.append("{} ({:.1f}s)".format(image["service"], estimate))
+        logger.info("Build order: {}".format(", ".join(order)))
+
+        # Images still needed as parents by the services left to build
+        written = {}
+        # Parents filtered out of the build are never written, nor removed
+        dependents = {image["service"]: set() for image in images}
+        for image in images:
+            for parent in image["parents"] & dependents.keys():
+                dependents[parent].add(image["service"])
+
+        # Sample the disk usage during the builds
+        paths = [build_tool.graph_root(), output, layout_dir]
+        with DiskUsageMonitor(paths) as monitor:
+            for image in images:
+                name, context = image["service"], image["context"]
+                dockerfile, tags = image["dockerfile"], image["tags"]
+                durations = {}
+
+                if name in reused:
+                    logger.info("Reusing published image for service {}".format(name))
+                    with span("pull", service=name):
+                        reuse_image(build_tool, image, args)
+                else:
+                    # Build the image
+                    logger.info("Building image for service {}".format(name))
+
+                    # We need to replace the FROM statements by their local versions
+                    # to avoid using the remote repository first
+                    patch_dockerfile(dockerfile, inventory)
+
+                    cache_from, cache_to = build_caches(args, name, build_tool)
+                    with span("build", service=name) as s:
+                        retry(
+                            lambda: build_tool.build(
+                                context,
+                                dockerfile,
+                                tags,
+                                args.build_arg,
+                                cache_from,
+                                cache_to,
+                            ),
+                            policy=build_policy,
+                        )
+                    durations["build"] = s.duration
+                inventory.add_build(tags, build_tool.inspect_digest(tags[0]))
+
+                # Write the produced image
+                if layout_dir:
+                    with span("save", service=name) as s:
+                        build_tool.save_oci_layout(tags, layout_dir)
+                    durations["save"] = s.duration
+
+                elif output:
+                    output_path = os.path.join(output, f"{name}.tar")
+
+                    with span("save", service=name) as s:
+                        build_tool.save(tags, output_path)
+                        s.add_bytes(os.path.getsize(output_path))
+                    durations["save"] = s.duration
+
+                    start = time.monotonic()
+                    zstd_compress(output_path)
+                    durations["compress"] = time.monotonic() - start
+
+                if name not in reused:
+                    history.record(repository, name, durations)
+
+                # Remove the written images as soon as no other service needs them
+                if args.remove_images:
+                    written[name] = tags
+                    for parent in image["parents"] & dependents.keys():
+                        dependents[parent].discard(name)
+                    for service in [name] + sorted(image["parents"]):
+                        if service in written and not dependents[service]:
+                            removed = written.pop(service)
+                            build_tool.remove(removed)
+                            inventory.remove(removed)
+
+            # Write all the images at once
+            if layout_dir:
+                output_path = os.path.join(output, "oci-layout.tar")
+                with span("save") as s:
+                    pack_oci_layout(layout_dir, output_path)
+                    s.add_bytes(os.path.getsize(output_path))
+                shutil.rmtree(layout_dir)
+                zstd_compress(output_path)
+
+        logger.info(
+            "Peak disk use: {} bytes, {} bytes more than at the start".format(
+                monitor.peak, monitor.peak - monitor.initial
+            )
         )
+        tracer.count("disk", "peak", monitor.peak)
 
-        # We need to replace the FROM statements by their local versions
-        # to avoid using the remote repository first
-        patch_dockerfile(dockerfile, build_tool.list_images())
+    logger.info("Compose file fully processed.")
 
-        docker_image = service.get("image", name)
-        tags = gen_docker_images(docker_image, args.tag, args.registry)
 
-        retry(
-            lambda: build_tool.build(context, dockerfile, tags, args.build_arg),
-            wait_between_retries=1,
-            retries=args.build_retries,
-        )
+# Values set by the hooks service on fields missing from a hook definition,
+# nested objects are completed key by key
+HOOK_DEFAULTS = {
+    "bindings": [],
+    "metadata": {"emailOnError": True},
+    "schedule": [],
+}
 
-        # Write the produced image
-        if output:
-            output_path = os.path.join(output, f"{name}.tar")
+# Trigger schema set on the hooks defined without one, as a whole
+DEFAULT_TRIGGER_SCHEMA = {"type": "object", "additionalProperties": False}
 
-            build_tool.save(tags, output_path)
+# Fields of a hook returned by the hooks service, but not part of its definition
+HOOK_IDENTIFIERS = ("hookGroupId", "hookId")
 
-            zstd_compress(output_path)
+# Extensions of the hook definitions found in a directory
+HOOK_EXTENSIONS = (".json", ".yml", ".yaml")
 
-    logger.info("Compose file fully processed.")
+
+def load_hook_definition(path):
+    with open(path) as hook_file:
+        if path.endswith(".json"):
+            return json.load(hook_file)
+        return yaml.safe_load(hook_file)
+
+
+def merge_defaults(value, defaults):
+    """
+    Complete a definition with the default values of its missing fields,
+    recursively in the nested objects
+    """
+    merged = dict(value)
+    for key, default in defaults.items():
+        if isinstance(default, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_defaults(merged[key], default)
+        else:
+            merged.setdefault(key, default)
+    return merged
+
+
+def hook_with_defaults(hook):
+    hook = merge_defaults(hook, HOOK_DEFAULTS)
+    hook.setdefault("triggerSchema", DEFAULT_TRIGGER_SCHEMA)
+    return hook
+
+
+def hook_differences(local, remote):
+    """
+    List the fields of a hook definition differing from the existing hook,
+    ignoring the key order and the fields left to their default values
+    """
+    local, remote = hook_with_defaults(local), hook_with_defaults(remote)
+    fields = (set(local) | set(remote)) - set(HOOK_IDENTIFIERS)
+    return sorted(field for field in fields if local.get(field) != remote.get(field))
+
+
+def sync_hook(hooks, hook_group_id, hook_id, payload, dry_run=False):
+    """
+    Create or update a hook, only when its definition changed
+    Returns the applied change and the differing fields
+    """
+    hook_name = "{}/{}".format(hook_group_id, hook_id)
+    logger.info("Checking if hook %s exists", hook_name)
+
+    try:
+        existing = hooks.hook(hook_group_id, hook_id)
+        logger.info("Hook %s exists", hook_name)
+    except taskcluster.exceptions.TaskclusterRestFailure as e:
+        if e.status_code != 404:
+            raise
+        existing = None
+        logger.info("Hook %s does not exists", hook_name)
+
+    if existing is None:
+        if not dry_run:
+            hooks.createHook(hook_group_id, hook_id, payload)
+            logger.info("Hook %s was successfully created", hook_name)
+        return "created", []
+
+    differences = hook_differences(payload, existing)
+    if not differences:
+        logger.info("Hook %s is up to date", hook_name)
+        return "unchanged", []
+
+    if not dry_run:
+        hooks.updateHook(hook_group_id, hook_id, payload)
+        logger.info("Hook %s was successfully updated", hook_name)
+    return "updated", differences
 
 
 def build_hook(target, args):
@@ -196,25 +621,74 @@ def build_hook(target, args):
     hooks = taskcluster.Hooks(config.get_taskcluster_options())
     hooks.ping()
 
-    hook_name = "{}/{}".format(hook_group_id, hook_id)
-    logger.info("Checking if hook %s exists", hook_name)
-
-    try:
-        hooks.hook(hook_group_id, hook_id)
-        hook_exists = True
-        logger.info("Hook %s exists", hook_name)
-    except taskcluster.exceptions.TaskclusterRestFailure:
-        hook_exists = False
-        logger.info("Hook %s does not exists", hook_name)
-
-    if hook_exists:
-        hooks.updateHook(hook_group_id, hook_id, payload)
-        logger.info("Hook %s was successfully updated", hook_name)
-    else:
-        hooks.createHook(hook_group_id, hook_id, payload)
-        logger.info("Hook %s was successfully created", hook_name)
+    sync_hook(hooks, hook_group_id, hook_id, payload)
 
     hook_url = taskcluster_urls.ui(
         config.get_root_url(), "hooks/{}/{}".format(hook_group_id, hook_id)
     )
     logger.info("Hook URL for debugging: %r", hook_url)
+
+
+def list_hook_files(target, patterns):
+    """
+    List the hook definition files from directories or glob patterns
+    """
+    paths = []
+    for pattern in patterns:
+        full_pattern = os.path.join(target.dir, pattern)
+        if os.path.isdir(full_pattern):
+            paths += [
+                os.path.join(full_pattern, name)
+                for name in os.listdir(full_pattern)
+                if name.endswith(HOOK_EXTENSIONS)
+            ]
+        else:
+            paths += glob.glob(full_pattern, recursive=True)
+    return sorted(set(paths))
+
+
+def build_hooks(target, args):
+    """
+    Synchronise a set of hook definitions, only updating the changed hooks
+    Each hook is named after its definition file
+    """
+    paths = list_hook_files(target, args.hook_files)
+    assert paths, "No hook definitions found"
+    definitions = {
+        os.path.splitext(os.path.basename(path))[0]: load_hook_definition(path)
+        for path in paths
+    }
+    assert len(definitions) == len(paths), "Hook definitions names are not unique"
+
+    # Load config from file/secret
+    config = Configuration(args)
+
+    hooks = taskcluster.Hooks(config.get_taskcluster_options())
+    hooks.ping()
+
+    def _sync(hook_id):
+        return sync_hook(
+            hooks, args.hook_group_id, hook_id, definitions[hook_id], args.dry_run
+        )
+
+    # Fetch and update the hooks concurrently
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        changes = dict(zip(definitions, executor.map(_sync, definitions)))
+
+    # Summarise the changes
+    summary = {"created": [], "updated": [], "unchanged": []}
+    for hook_id, (change, differences) in sorted(changes.items()):
+        summary[change].append(hook_id)
+        if differences:
+            logger.info("Hook %s changed: %s", hook_id, ", ".join(differences))
+    logger.info(
+        "%sHooks in %s: %d created, %d updated, %d unchanged",
+        "[dry run] " if args.dry_run else "",
+        args.hook_group_id,
+        len(summary["created"]),
+        len(summary["updated"]),
+        len(summary["unchanged"]),
+    )
+    for change in ("created", "updated"):
+        if summary[change]:
+            logger.info("%s: %s", change.capitalize(), ", ".join(summary[change]))
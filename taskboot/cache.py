@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "taskboot")
+
+# Default maximum size of the artifacts cache, in bytes
+DEFAULT_ARTIFACT_CACHE_SIZE = 20 * 1024**3
+
+# Default lifetime of the cached Taskcluster secrets, in seconds
+DEFAULT_SECRET_CACHE_TTL = 3600
+
+# Memory backed filesystems where secrets can be shared without hitting a disk
+SECRET_CACHE_DIRS = ("/dev/shm", os.environ.get("XDG_RUNTIME_DIR"))
+SECRET_CACHE_PREFIX = "taskboot-secrets-"
+
+# Linux ioctl cloning a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def cache_dir(name):
+    """
+    Get a named cache directory, shared by all taskboot runs on this host
+    The root can be overridden through the TASKBOOT_CACHE_DIR env variable
+    """
+    root = os.environ.get("TASKBOOT_CACHE_DIR") or DEFAULT_CACHE_DIR
+    path = os.path.join(root, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def copy_file(source, destination):
+    """
+    Copy an open file to a path, sharing its blocks through a reflink when
+    the filesystem supports it, so that both copies can be modified safely
+    """
+    if os.path.lexists(destination):
+        os.unlink(destination)
+
+    with open(destination, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, source.fileno())
+            return "reflink"
+        except OSError:
+            source.seek(0)
+            shutil.copyfileobj(source, dst, 1024 * 1024)
+            return "copy"
+
+
+class ArtifactCache(object):
+    """
+    Persistent cache of downloaded Taskcluster artifacts, shared by taskboot runs
+    Entries are keyed by (taskId, runId, artifact name) and point to blobs
+    stored by sha256, evicted by least recent use above a maximum size
+    Blobs are copied in and out of the cache, never hardlinked, so that
+    a command modifying an artifact in place can not corrupt the cache
+    The index lock is only held to update the index, not during the copies
+    """
+
+    def __init__(self, directory=None, max_size=DEFAULT_ARTIFACT_CACHE_SIZE):
+        self.directory = directory or cache_dir("artifacts")
+        self.blobs = os.path.join(self.directory, "blobs")
+        os.makedirs(self.blobs, exist_ok=True)
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.lock_path = os.path.join(self.directory, "index.lock")
+        self.max_size = max_size
+
+    @staticmethod
+    def key(task_id, run_id, name):
+        return "{}/{}/{}".format(task_id, run_id, name)
+
+    @contextlib.contextmanager
+    def index(self):
+        """
+        Load the index under an exclusive lock, and save it back on exit
+        so that concurrent taskboot processes can share the cache
+        """
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_path) as f:
+                    index = json.load(f)
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                index = {}
+
+            yield index
+
+            tmp_path = "{}.tmp".format(self.index_path)
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs, sha256)
+
+    def get(self, task_id, run_id, name, destination):
+        """
+        Copy a cached artifact to the destination path
+        Returns its sha256, or None when the artifact is not cached
+        """
+        with self.index() as index:
+            entry = index.get(self.key(task_id, run_id, name))
+            if entry is None:
+                return None
+            try:
+                # An open blob can still be read once evicted by another process
+                blob = open(self.blob_path(entry["sha256"]), "rb")
+            except FileNotFoundError:
+                del index[self.key(task_id, run_id, name)]
+                return None
+            entry["last_used"] = time.time()
+
+        with blob:
+            method = copy_file(blob, destination)
+        logger.info(
+            "Using cached artifact {} from {} ({})".format(name, task_id, method)
+        )
+        return entry["sha256"]
+
+    def add(self, task_id, run_id, name, path, sha256):
+        """
+        Store a downloaded artifact in the cache
+        The artifact is copied next to the blobs first, then moved in place
+        while holding the index lock
+        """
+        blob = self.blob_path(sha256)
+        tmp_blob = "{}.{}.tmp".format(blob, os.getpid())
+        if not os.path.exists(blob):
+            with open(path, "rb") as source:
+                copy_file(source, tmp_blob)
+            os.chmod(tmp_blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+        with self.index() as index:
+            if os.path.exists(tmp_blob):
+                if os.path.exists(blob):
+                    os.unlink(tmp_blob)
+                else:
+                    os.replace(tmp_blob, blob)
+            if not os.path.exists(blob):
+                # Evicted by another process before being indexed
+                return
+            index[self.key(task_id, run_id, name)] = {
+                "sha256": sha256,
+                "size": os.path.getsize(blob),
+                "last_used": time.time(),
+            }
+            self.evict(index)
+
+    def evict(self, index):
+        """
+        Remove the least recently used blobs until the cache fits its maximum size
+        """
+        blobs = {}
+        for entry in index.values():
+            last_used = blobs.get(entry["sha256"], (0, 0))[1]
+            blobs[entry["sha256"]] = (entry["size"], max(last_used, entry["last_used"]))
+
+        total = sum(size for size, _ in blobs.values())
+        for sha256, (size, _) in sorted(blobs.items(), key=lambda item: item[1][1]):
+            if total <= self.max_size:
+                break
+            logger.info("Evicting cached artifact {} ({} bytes)".format(sha256, size))
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.blob_path(sha256))
+            for key in [k for k, entry in index.items() if entry["sha256"] == sha256]:
+                del index[key]
+            total -= size
+
+
+_artifact_cache = None
+
+
+def artifact_cache():
+    """
+    Shared artifacts cache, sized through the TASKBOOT_ARTIFACT_CACHE_SIZE env variable
+    A size of 0 disables the cache
+    """
+    global _artifact_cache
+    max_size = os.environ.get("TASKBOOT_ARTIFACT_CACHE_SIZE")
+    max_size = int(max_size) if max_size else DEFAULT_ARTIFACT_CACHE_SIZE
+    if max_size <= 0:
+        return None
+    if _artifact_cache is None:
+        _artifact_cache = ArtifactCache(max_size=max_size)
+    return _artifact_cache
+
+
+class SecretCache(object):
+    """
+    Cache of the Taskcluster secrets loaded during a task
+    Secrets are kept in memory, and shared with the next taskboot runs of the
+    same task through a file only readable by the current user, on a memory
+    backed filesystem; they expire after a TTL
+
+    Taskboot can not know when the task ends: the shared file stays until an
+    explicit clear-secrets command at the end of the task, or until its secrets
+    expire and a later taskboot run on the host prunes it. Until then, it is
+    readable by the processes of the same user, including concurrent tasks
+    """
+
+    def __init__(self, task_id, directory=None, ttl=DEFAULT_SECRET_CACHE_TTL):
+        self.task_id = task_id
+        self.ttl = ttl
+        self.memory = {}
+
+        # Without a task, secrets are only cached by the current process
+        self.directory = directory
+        self.path = None
+        if task_id is not None and directory is not None:
+            scope = hashlib.sha256(task_id.encode("utf-8")).hexdigest()[:16]
+            self.path = os.path.join(directory, f"{SECRET_CACHE_PREFIX}{scope}.json")
+
+    @contextlib.contextmanager
+    def entries(self):
+        """
+        Load the shared entries under an exclusive lock, and save them back on exit
+        The file is not used when it could have been written by someone else
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            status = os.fstat(f.fileno())
+            if status.st_uid != os.getuid() or status.st_mode & 0o077:
+                raise Exception(f"Unsafe permissions on secret cache {self.path}")
+
+            try:
+                content = json.load(f)
+                assert content["task_id"] == self.task_id
+                entries = content["secrets"]
+            except (json.decoder.JSONDecodeError, AssertionError, KeyError):
+                entries = {}
+
+            yield entries
+
+            f.seek(0)
+            f.truncate()
+            if entries:
+                json.dump({"task_id": self.task_id, "secrets": entries}, f)
+
+    def get(self, name):
+        """
+        Get a cached secret, or None when it is missing or expired
+        """
+        now = time.time()
+        entry = self.memory.get(name)
+        if entry is None and self.path is not None:
+            with self.entries() as entries:
+                entry = entries.get(name)
+        if entry is None or entry["expires"] <= now:
+            return None
+        self.memory[name] = entry
+        return entry["secret"]
+
+    def add(self, name, secret):
+        entry = {"secret": secret, "expires": time.time() + self.ttl}
+        self.memory[name] = entry
+        if self.path is not None:
+            with self.entries() as entries:
+                entries[name] = entry
+
+    def prune(self):
+        """
+        Remove the expired secrets, the shared file once it is empty, and the
+        expired files left by other tasks of the current user
+        """
+        now = time.time()
+        self.memory = {
+            name: entry for name, entry in self.memory.items() if entry["expires"] > now
+        }
+        self.remove_leftovers()
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with self.entries() as entries:
+            for name in [n for n, entry in entries.items() if entry["expires"] <= now]:
+                del entries[name]
+            if not entries:
+                os.unlink(self.path)
+
+    def remove_leftovers(self, expired_only=True):
+        """
+        Remove the shared files of other tasks of the current user
+        Other tasks may run concurrently on the host, so by default only the
+        files not written for longer than the TTL are removed: all their
+        secrets have expired
+        """
+        if self.directory is None:
+            return
+        oldest = time.time() - self.ttl
+        for entry in os.scandir(self.directory):
+            if (
+                not entry.name.startswith(SECRET_CACHE_PREFIX)
+                or entry.path == self.path
+            ):
+                continue
+            try:
+                status = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if status.st_uid != os.getuid():
+                continue
+            if expired_only and status.st_mtime > oldest:
+                continue
+            logger.info(f"Removing secrets left by another task in {entry.path}")
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(entry.path)
+
+    def clear(self):
+        """
+        Remove all the secrets of the task, in memory and on disk
+        """
+        self.memory = {}
+        if self.path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+
+
+_secret_cache = None
+
+
+def new_secret_cache(task_id):
+    """
+    Build the secrets cache of a task, with a TTL set through the
+    TASKBOOT_SECRET_CACHE_TTL env variable; a TTL of 0 disables the cache
+    """
+    ttl = os.environ.get("TASKBOOT_SECRET_CACHE_TTL")
+    ttl = int(ttl) if ttl else DEFAULT_SECRET_CACHE_TTL
+    if ttl <= 0:
+        return None
+    directory = next(
+        (
+            path
+            for path in SECRET_CACHE_DIRS
+            if path and os.path.isdir(path) and os.access(path, os.W_OK)
+        ),
+        None,
+    )
+    return SecretCache(task_id, directory, ttl)
+
+
+def secret_cache():
+    """
+    Secrets cache of the task running this process
+    """
+    global _secret_cache
+    if _secret_cache is None:
+        _secret_cache = new_secret_cache(os.environ.get("TASK_ID"))
+        if _secret_cache is not None:
+            atexit.register(_secret_cache.prune)
+    return _secret_cache
+
+
+def clear_secrets(target, args):
+    """
+    Remove the Taskcluster secrets cached for the current task
+    """
+    cache = secret_cache()
+    if cache is None:
+        logger.info("Secrets cache is disabled")
+        return
+    cache.clear()
+    cache.remove_leftovers(expired_only=False)
+    logger.info("Cached secrets removed")
@@ -4,34 +4,181 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import json
 import logging
+import os
 import subprocess
+import time
+from typing import Any
+from typing import Dict
+from typing import List
 
 from taskboot.config import Configuration
 from taskboot.target import Target
+from taskboot.tracing import span
+from taskboot.tracing import track_subprocess
+from taskboot.utils import http_session
 
 logger = logging.getLogger(__name__)
 
+# Sparse index of crates.io, also used by cargo
+CRATES_INDEX_URL = "https://index.crates.io"
 
-def cargo_publish(target: Target, args: argparse.Namespace) -> None:
+# Delays between two checks of the index after a publication, in seconds
+INDEX_POLL_DELAY = 1
+INDEX_POLL_MAX_DELAY = 30
+INDEX_TIMEOUT = 600
+
+
+def load_workspace_crates() -> List[Dict[str, Any]]:
     """
-    Publish a crate on crates.io
+    List the publishable crates of the current workspace, or the current crate,
+    from the cargo metadata
     """
+    with track_subprocess(["cargo"]):
+        output = subprocess.run(
+            ["cargo", "metadata", "--format-version", "1", "--no-deps"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+    metadata = json.loads(output)
 
-    # Load config from file/secret
-    config = Configuration(args)
-    assert config.has_cargo_auth(), "Missing Cargo authentication"
+    members = set(metadata["workspace_members"])
+    crates = []
+    for package in metadata["packages"]:
+        if package["id"] not in members:
+            continue
+
+        # An empty publish list disables the publication
+        if package.get("publish") == []:
+            logger.info(f"Skipping {package['name']}, publication is disabled")
+            continue
+        crates.append(package)
+    return crates
+
+
+def publication_layers(crates: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """
+    Sort crates in layers, each crate only depending on crates from previous layers
+    Development dependencies are not needed to publish a crate
+    """
+    names = {crate["name"] for crate in crates}
+    dependencies = {
+        crate["name"]: {
+            dependency["name"]
+            for dependency in crate["dependencies"]
+            if dependency["name"] in names and dependency.get("kind") != "dev"
+        }
+        for crate in crates
+    }
+
+    layers = []
+    published: set = set()
+    remaining = list(crates)
+    while remaining:
+        layer = [
+            crate for crate in remaining if dependencies[crate["name"]] <= published
+        ]
+        assert layer, "Dependency cycle between {}".format(
+            ", ".join(crate["name"] for crate in remaining)
+        )
+        layers.append(layer)
+        published.update(crate["name"] for crate in layer)
+        remaining = [crate for crate in remaining if crate not in layer]
+    return layers
+
+
+def index_path(name: str) -> str:
+    """
+    Path of a crate in the sparse index
+    """
+    name = name.lower()
+    if len(name) <= 2:
+        return f"{len(name)}/{name}"
+    if len(name) == 3:
+        return f"3/{name[0]}/{name}"
+    return f"{name[0:2]}/{name[2:4]}/{name}"
+
+
+class CratesIndex(object):
+    """
+    Read the published versions of crates from the sparse index
+    Index files are revalidated through their ETag
+    """
+
+    def __init__(self, url=CRATES_INDEX_URL):
+        self.url = url.rstrip("/")
+        self.session = http_session()
+        self.cache: Dict[str, Any] = {}
 
-    # Build the package to publish on crates.io
-    subprocess.run(["cargo", "publish", "--no-verify", "--dry-run"], check=True)
+    def versions(self, name: str) -> set:
+        url = f"{self.url}/{index_path(name)}"
+        headers = {}
+        cached = self.cache.get(url)
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
 
-    # Publish the crate on crates.io
-    # stdout and stderr are captured to avoid leaking the token
-    proc = subprocess.run(
-        ["cargo", "publish", "--no-verify", "--token", config.cargo["token"]],
-        capture_output=True,
-        text=True,  # Return stdout and stderr output as strings
-    )
+        response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cached is not None:
+            return cached[1]
+        if response.status_code in (403, 404):
+            return set()
+        response.raise_for_status()
+
+        versions = {
+            json.loads(line)["vers"] for line in response.text.splitlines() if line
+        }
+        if "ETag" in response.headers:
+            self.cache[url] = (response.headers["ETag"], versions)
+        return versions
+
+    def is_published(self, name: str, version: str) -> bool:
+        return version in self.versions(name)
+
+    def wait(self, crates: List[Dict[str, Any]], timeout=INDEX_TIMEOUT) -> None:
+        """
+        Wait until published crates are available on the index,
+        so that their dependents can be published
+        """
+        deadline = time.monotonic() + timeout
+        delay = INDEX_POLL_DELAY
+        pending = list(crates)
+        while True:
+            pending = [
+                crate
+                for crate in pending
+                if not self.is_published(crate["name"], crate["version"])
+            ]
+            if not pending:
+                return
+            if time.monotonic() + delay > deadline:
+                raise Exception(
+                    "Timeout waiting for {} on the index".format(
+                        ", ".join(crate["name"] for crate in pending)
+                    )
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, INDEX_POLL_MAX_DELAY)
+
+
+def publish_crate(crate: Dict[str, Any], token: str, args: argparse.Namespace):
+    """
+    Package and publish a single crate of the workspace
+    """
+    name, version = crate["name"], crate["version"]
+    logger.info(f"Publishing {name} {version}")
+
+    # The token is given through the environment to avoid leaking it,
+    # and stdout and stderr are captured for the same reason
+    env = dict(os.environ, CARGO_REGISTRY_TOKEN=token)
+    with span("push", crate=name), track_subprocess(["cargo"]):
+        proc = subprocess.run(
+            ["cargo", "publish", "--no-verify", "--package", name],
+            capture_output=True,
+            text=True,  # Return stdout and stderr output as strings
+            env=env,
+        )
 
     # If an error is occurred while publishing the crate
     # Do not fail when a `crate already uploaded` error is found and
@@ -39,4 +186,43 @@ def cargo_publish(target: Target, args: argparse.Namespace) -> None:
     if proc.returncode != 0 and not (
         args.ignore_published and "is already uploaded" in proc.stderr
     ):
-        raise Exception("Failed to publish the crate on crates.io")
+        raise Exception(f"Failed to publish the crate {name} on crates.io")
+
+
+def cargo_publish(target: Target, args: argparse.Namespace) -> None:
+    """
+    Publish a crate, or all the crates of a workspace, on crates.io
+    """
+
+    # Load config from file/secret
+    config = Configuration(args)
+    assert config.has_cargo_auth(), "Missing Cargo authentication"
+
+    index = CratesIndex()
+    with span("metadata"):
+        crates = load_workspace_crates()
+
+    # Skip the versions already published
+    to_publish = []
+    for crate in crates:
+        name, version = crate["name"], crate["version"]
+        if not index.is_published(name, version):
+            to_publish.append(crate)
+        elif args.ignore_published:
+            logger.info(f"Skipping {name} {version}, already published")
+        else:
+            raise Exception(f"{name} {version} is already published on crates.io")
+
+    # Crates from a layer are published once their dependencies from the
+    # previous layers are available on the index. They are published one
+    # after the other, as cargo locks the workspace target directory anyway,
+    # and the index is only polled once for the whole layer
+    layers = publication_layers(to_publish)
+    for i, layer in enumerate(layers):
+        for crate in layer:
+            publish_crate(crate, config.cargo["token"], args)
+        if i < len(layers) - 1:
+            with span("index"):
+                index.wait(layer)
+
+    logger.info(f"Published {len(to_publish)} crates on crates.io")
@@ -7,20 +7,38 @@ import argparse
 import logging
 import os
 import pathlib
+from typing import Mapping
+from typing import Optional
 
+from taskboot.analyze import analyze
 from taskboot.artifacts import retrieve_artifacts
 from taskboot.aws import push_s3
 from taskboot.build import build_compose
 from taskboot.build import build_hook
+from taskboot.build import build_hooks
 from taskboot.build import build_image
+from taskboot.cache import clear_secrets
 from taskboot.cargo import cargo_publish
+from taskboot.docker import DEFAULT_CACHE_BRANCH
+from taskboot.docker import DEFAULT_PODMAN_STORAGE_SIZE
 from taskboot.git import git_push
 from taskboot.github import github_release
 from taskboot.github import github_workflow_dispatch
+from taskboot.history import DEFAULT_HISTORY_RUNS
+from taskboot.history import build_report
+from taskboot.layers import DEFAULT_TOP_FILES
+from taskboot.layers import inspect_archive
+from taskboot.plan import run_plan
+from taskboot.profiling import PROFILE_MODES
+from taskboot.profiling import Profiler
 from taskboot.push import heroku_release
 from taskboot.push import push_artifacts
 from taskboot.pypi import publish_pypi
+from taskboot.serve import DEFAULT_SOCKET
+from taskboot.serve import serve
+from taskboot.serve import submit
 from taskboot.target import Target
+from taskboot.tracing import tracer
 
 logging.basicConfig(level=logging.INFO)
 
@@ -29,39 +47,69 @@ def usage(target: Target, args: argparse.Namespace) -> None:
     print("Here is how to use taskboot...")
 
 
-def main() -> None:
+def build_parser(
+    environ: Mapping[str, str] = os.environ, cwd: Optional[str] = None
+) -> argparse.ArgumentParser:
+    """
+    Build the command line parser, with its defaults read from an environment
+    The jobs of a server use the environment of their client, and resolve
+    their relative paths from its working directory
+    """
+
+    def _path(value: str) -> str:
+        return os.path.join(cwd, value) if cwd is not None else value
+
     parser = argparse.ArgumentParser(prog="taskboot")
     parser.add_argument(
-        "--config", type=open, help="Path to local configuration/secrets file"
+        "--config",
+        type=lambda value: open(_path(value)),
+        help="Path to local configuration/secrets file",
     )
     parser.add_argument(
         "--secret",
         type=str,
-        default=os.environ.get("TASKCLUSTER_SECRET"),
+        default=environ.get("TASKCLUSTER_SECRET"),
         help="Taskcluster secret path",
     )
     parser.add_argument(
         "--git-repository",
         type=str,
-        default=os.environ.get("GIT_REPOSITORY"),
+        default=environ.get("GIT_REPOSITORY"),
         help="Target git repository",
     )
     parser.add_argument(
         "--git-revision",
         type=str,
-        default=os.environ.get("GIT_REVISION", "master"),
+        default=environ.get("GIT_REVISION", "master"),
         help="Target git revision",
     )
     parser.add_argument(
-        "--target", type=str, help="Target directory to use a local project"
+        "--target", type=_path, help="Target directory to use a local project"
+    )
+    parser.add_argument(
+        "--metrics-out",
+        type=_path,
+        default=environ.get("TASKBOOT_METRICS_OUT"),
+        help="Path to write a JSON report with the duration of each phase",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILE_MODES,
+        help="Profile the subcommand: cProfile stats, sampled wall-clock stacks "
+        "or tracemalloc peak memory",
+    )
+    parser.add_argument(
+        "--profile-output",
+        type=_path,
+        help="Path to write the profile, defaults to a file in the current directory",
     )
-    commands = parser.add_subparsers(help="sub-command help")
-    parser.set_defaults(func=usage)
+    commands = parser.add_subparsers(dest="command", help="sub-command help")
+    parser.set_defaults(func=usage, environ=environ, cwd=cwd)
 
     # Build a docker image
     build = commands.add_parser("build", help="Build a docker image")
     build.add_argument("dockerfile", type=str, help="Path to Dockerfile to build")
-    build.add_argument("--write", type=str, help="Path to write the docker image")
+    build.add_argument("--write", type=_path, help="Path to write the docker image")
     build.add_argument(
         "--push",
         action="store_true",
@@ -76,7 +124,7 @@ def main() -> None:
     build.add_argument(
         "--registry",
         type=str,
-        default=os.environ.get("REGISTRY", "registry.hub.docker.com"),
+        default=environ.get("REGISTRY", "registry.hub.docker.com"),
         help="Docker registry to use in images tags",
     )
     build.add_argument(
@@ -97,11 +145,87 @@ def main() -> None:
         "--build-tool",
         dest="build_tool",
         choices=["docker", "dind", "podman"],
-        default=os.environ.get("BUILD_TOOL") or "podman",
+        default=environ.get("BUILD_TOOL") or "podman",
         help="Tool to build docker images.",
     )
+    build.add_argument(
+        "--cache-from",
+        type=str,
+        help="Build cache to use: a registry repository, or a local directory "
+        "with the docker build tool",
+    )
+    build.add_argument(
+        "--cache-to",
+        type=str,
+        help="Build cache to export to: a registry repository, or a local directory "
+        "with the docker build tool",
+    )
+    build.add_argument(
+        "--cache-branch",
+        type=str,
+        default=environ.get("GIT_BRANCH"),
+        help="Branch scoping the build cache entries",
+    )
+    build.add_argument(
+        "--cache-default-branch",
+        type=str,
+        default=DEFAULT_CACHE_BRANCH,
+        help="Branch whose build cache is used when the current branch has none",
+    )
+    build.add_argument(
+        "--podman-storage",
+        type=_path,
+        default=environ.get("TASKBOOT_PODMAN_STORAGE"),
+        help="Persistent directory storing the podman images, shared between tasks",
+    )
+    build.add_argument(
+        "--podman-storage-size",
+        type=int,
+        default=int(
+            environ.get("TASKBOOT_PODMAN_STORAGE_SIZE", DEFAULT_PODMAN_STORAGE_SIZE)
+        ),
+        help="Maximum size of the persistent podman storage in bytes, "
+        "least recently used images are removed above it",
+    )
+    build.add_argument(
+        "--lint-cache",
+        action="store_true",
+        help="Warn about the Dockerfile patterns defeating the layer cache",
+    )
     build.set_defaults(func=build_image)
 
+    # Analyze the cache efficiency of a Dockerfile
+    analyze_cmd = commands.add_parser(
+        "analyze", help="Report the Dockerfile patterns defeating the layer cache"
+    )
+    analyze_cmd.add_argument(
+        "dockerfile", type=str, help="Path to Dockerfile to analyze"
+    )
+    analyze_cmd.add_argument(
+        "--context",
+        type=str,
+        help="Path to the build context, default to the target directory",
+    )
+    analyze_cmd.set_defaults(func=analyze)
+
+    # Report the layers of a saved image archive
+    inspect_archive_cmd = commands.add_parser(
+        "inspect-archive", help="Report the size of the layers of an image archive"
+    )
+    inspect_archive_cmd.add_argument(
+        "archive", type=_path, help="Path to a .tar or .tar.zst Docker image archive"
+    )
+    inspect_archive_cmd.add_argument(
+        "--top",
+        type=int,
+        default=DEFAULT_TOP_FILES,
+        help="Number of largest files and duplicated files to report",
+    )
+    inspect_archive_cmd.add_argument(
+        "--json", action="store_true", help="Output the report as JSON"
+    )
+    inspect_archive_cmd.set_defaults(func=inspect_archive)
+
     # Build images from a docker-compose.yml file
     compose = commands.add_parser(
         "build-compose", help="Build images from a docker-compose file"
@@ -117,11 +241,36 @@ def main() -> None:
     compose.add_argument(
         "--registry",
         type=str,
-        default=os.environ.get("REGISTRY", "registry.hub.docker.com"),
+        default=environ.get("REGISTRY", "registry.hub.docker.com"),
         help="Docker registry to use in images tags",
     )
     compose.add_argument(
-        "--write", type=str, help="Directory to write the docker images"
+        "--write", type=_path, help="Directory to write the docker images"
+    )
+    compose.add_argument(
+        "--format",
+        choices=["docker-archive", "oci-layout"],
+        default="docker-archive",
+        help="Format of the written images: one docker archive per service, "
+        "or a single OCI layout storing shared layers once",
+    )
+    compose.add_argument(
+        "--changed-since",
+        type=str,
+        help="Only build the services affected by the changes since this revision, "
+        "and reuse the published images of the others",
+    )
+    compose.add_argument(
+        "--reuse-tag",
+        type=str,
+        default="latest",
+        help="Tag of the published images reused with --changed-since",
+    )
+    compose.add_argument(
+        "--remove-images",
+        action="store_true",
+        help="Remove each image from the local storage once written, "
+        "unless other services still need it as a parent image",
     )
     compose.add_argument(
         "--build-retries",
@@ -151,8 +300,81 @@ def main() -> None:
         default=[],
         help="Use a specific tag on this image, default to latest tag",
     )
+    compose.add_argument(
+        "--cache-from",
+        type=str,
+        help="Build cache to use: a registry repository, as compose builds run "
+        "with Podman",
+    )
+    compose.add_argument(
+        "--cache-to",
+        type=str,
+        help="Build cache to export to: a registry repository, as compose builds "
+        "run with Podman",
+    )
+    compose.add_argument(
+        "--cache-branch",
+        type=str,
+        default=environ.get("GIT_BRANCH"),
+        help="Branch scoping the build cache entries",
+    )
+    compose.add_argument(
+        "--cache-default-branch",
+        type=str,
+        default=DEFAULT_CACHE_BRANCH,
+        help="Branch whose build cache is used when the current branch has none",
+    )
+    compose.add_argument(
+        "--podman-storage",
+        type=_path,
+        default=environ.get("TASKBOOT_PODMAN_STORAGE"),
+        help="Persistent directory storing the podman images, shared between tasks",
+    )
+    compose.add_argument(
+        "--podman-storage-size",
+        type=int,
+        default=int(
+            environ.get("TASKBOOT_PODMAN_STORAGE_SIZE", DEFAULT_PODMAN_STORAGE_SIZE)
+        ),
+        help="Maximum size of the persistent podman storage in bytes, "
+        "least recently used images are removed above it",
+    )
+    compose.add_argument(
+        "--build-history",
+        type=_path,
+        default=environ.get("TASKBOOT_BUILD_HISTORY"),
+        help="Path to the database of the previous build durations, "
+        "defaults to one in the taskboot cache directory",
+    )
     compose.set_defaults(func=build_compose)
 
+    # Report the build durations recorded by build-compose
+    build_report_cmd = commands.add_parser(
+        "build-report", help="Display the duration trends of the compose services"
+    )
+    build_report_cmd.add_argument(
+        "--build-history",
+        type=_path,
+        default=environ.get("TASKBOOT_BUILD_HISTORY"),
+        help="Path to the database of the previous build durations, "
+        "defaults to one in the taskboot cache directory",
+    )
+    build_report_cmd.add_argument(
+        "--repository",
+        type=str,
+        help="Repository of the builds, defaults to the target repository",
+    )
+    build_report_cmd.add_argument(
+        "--last",
+        type=int,
+        default=DEFAULT_HISTORY_RUNS,
+        help="Number of recent builds of each service to report",
+    )
+    build_report_cmd.add_argument(
+        "--json", action="store_true", help="Output the report as JSON"
+    )
+    build_report_cmd.set_defaults(func=build_report)
+
     # Download all artifacts from a specific task
     download_artifacts = commands.add_parser(
         "retrieve-artifact",
@@ -161,12 +383,12 @@ def main() -> None:
     download_artifacts.add_argument(
         "--task-id",
         type=str,
-        default=os.environ.get("TASK_ID"),
+        default=environ.get("TASK_ID"),
         help="Taskcluster task group to analyse",
     )
     download_artifacts.add_argument(
         "--output-path",
-        type=lambda value: pathlib.Path(value),
+        type=lambda value: pathlib.Path(_path(value)),
         help="Output path for artifacts.",
     )
     download_artifacts.add_argument(
@@ -184,7 +406,7 @@ def main() -> None:
     artifacts.add_argument(
         "--task-id",
         type=str,
-        default=os.environ.get("TASK_ID"),
+        default=environ.get("TASK_ID"),
         help="Taskcluster task group to analyse",
     )
     artifacts.add_argument(
@@ -202,7 +424,7 @@ def main() -> None:
         "--push-tool",
         dest="push_tool",
         choices=["skopeo", "docker", "podman"],
-        default=os.environ.get("PUSH_TOOL") or "skopeo",
+        default=environ.get("PUSH_TOOL") or "skopeo",
         help="Tool to push docker images.",
     )
     artifacts.set_defaults(func=push_artifacts)
@@ -217,6 +439,33 @@ def main() -> None:
     hooks.add_argument("hook_id", type=str, help="Hook ID")
     hooks.set_defaults(func=build_hook)
 
+    # Ensure a set of hooks are up-to-date with their definitions
+    hooks_batch = commands.add_parser(
+        "build-hooks",
+        help="Ensure a set of hooks are up-to-date with their definitions",
+    )
+    hooks_batch.add_argument(
+        "hook_files",
+        nargs="+",
+        type=str,
+        help="Directories or glob patterns of hook definitions, named after their hook ID",
+    )
+    hooks_batch.add_argument(
+        "--hook-group-id", type=str, required=True, help="Hook group ID"
+    )
+    hooks_batch.add_argument(
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of hooks synchronised concurrently",
+    )
+    hooks_batch.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only display the changes, without applying them",
+    )
+    hooks_batch.set_defaults(func=build_hooks)
+
     # Push and trigger a Heroku release
     deploy_heroku = commands.add_parser(
         "deploy-heroku", help="Push and trigger a Heroku release"
@@ -224,7 +473,7 @@ def main() -> None:
     deploy_heroku.add_argument(
         "--task-id",
         type=str,
-        default=os.environ.get("TASK_ID"),
+        default=environ.get("TASK_ID"),
         help="Taskcluster task group to analyse",
     )
     deploy_heroku.add_argument("--heroku-app", type=str, required=True)
@@ -232,7 +481,7 @@ def main() -> None:
         "--push-tool",
         dest="push_tool",
         choices=["skopeo", "docker", "podman"],
-        default=os.environ.get("PUSH_TOOL") or "skopeo",
+        default=environ.get("PUSH_TOOL") or "skopeo",
         help="Tool to push docker images.",
     )
     deploy_heroku.add_argument(
@@ -247,7 +496,7 @@ def main() -> None:
     deploy_s3.add_argument(
         "--task-id",
         type=str,
-        default=os.environ.get("TASK_ID"),
+        default=environ.get("TASK_ID"),
         help="Taskcluster task group to analyse",
     )
     deploy_s3.add_argument(
@@ -269,9 +518,15 @@ def main() -> None:
     deploy_pypi.add_argument(
         "--repository",
         type=str,
-        default=os.environ.get("PYPI_REPOSITORY"),
+        default=environ.get("PYPI_REPOSITORY"),
         help="PyPi repository to use for publication",
     )
+    deploy_pypi.add_argument(
+        "--index-url",
+        type=str,
+        default=environ.get("PYPI_INDEX_URL"),
+        help="Simple index of the repository, used to skip files already published",
+    )
     deploy_pypi.set_defaults(func=publish_pypi)
 
     # Push on a repository
@@ -318,7 +573,7 @@ def main() -> None:
     github_release_cmd.add_argument(
         "--task-id",
         type=str,
-        default=os.environ.get("TASK_ID"),
+        default=environ.get("TASK_ID"),
         help="Taskcluster task group to analyse",
     )
     group = github_release_cmd.add_mutually_exclusive_group()
@@ -334,6 +589,12 @@ def main() -> None:
         type=str,
         help="Asset to upload on the release, retrieved from previously created artifacts. Format is asset-name:path/to/artifact",
     )
+    github_release_cmd.add_argument(
+        "--upload-workers",
+        type=int,
+        default=4,
+        help="Number of assets uploaded concurrently",
+    )
     github_release_cmd.set_defaults(func=github_release)
 
     # Trigger a workflow dispatch event
@@ -360,6 +621,22 @@ def main() -> None:
         type=str,
         help="JSON payload with input keys and values configured in the workflow file. The maximum number of properties is 10. Any default properties configured in the workflow file will be used when inputs are omitted.",
     )
+    github_workflow_dispatch_cmd.add_argument(
+        "--wait",
+        action="store_true",
+        help="Wait for the triggered workflow run to complete, and fail when it fails",
+    )
+    github_workflow_dispatch_cmd.add_argument(
+        "--correlation-input",
+        type=str,
+        help="Name of a workflow input receiving a unique id, used to identify the triggered run when waiting. The workflow must show this input in its run-name",
+    )
+    github_workflow_dispatch_cmd.add_argument(
+        "--wait-timeout",
+        type=int,
+        default=3600,
+        help="Maximum time to wait for the workflow run, in seconds",
+    )
     github_workflow_dispatch_cmd.set_defaults(func=github_workflow_dispatch)
 
     # Publish on crates.io
@@ -369,16 +646,86 @@ def main() -> None:
     cargo_publish_cmd.add_argument(
         "--ignore-published",
         action="store_true",
-        help="Do not fail if a crate is already published on crates.io",
+        help="Skip the crates already published on crates.io instead of failing",
     )
     cargo_publish_cmd.set_defaults(func=cargo_publish)
 
-    # Always load the target
+    # Run several commands in a single process
+    run_cmd = commands.add_parser(
+        "run", help="Run the steps of a plan, sharing the target and configuration"
+    )
+    run_cmd.add_argument(
+        "plan",
+        type=str,
+        help="Path to a YAML plan, listing the taskboot commands to run",
+    )
+    run_cmd.add_argument(
+        "--jobs",
+        type=int,
+        default=4,
+        help="Maximum number of independent steps running at the same time",
+    )
+    run_cmd.set_defaults(func=run_plan)
+
+    # Remove the cached secrets at the end of a task
+    clear_secrets_cmd = commands.add_parser(
+        "clear-secrets",
+        help="Remove the Taskcluster secrets cached for the current task, to run as its last command",
+    )
+    clear_secrets_cmd.set_defaults(func=clear_secrets)
+
+    # Run jobs sent on a local socket, keeping the process warm between them
+    serve_cmd = commands.add_parser(
+        "serve", help="Run taskboot jobs sent on a local UNIX socket"
+    )
+    serve_cmd.add_argument(
+        "--socket",
+        type=str,
+        default=environ.get("TASKBOOT_SOCKET", DEFAULT_SOCKET),
+        help="Path of the UNIX socket receiving the jobs",
+    )
+    serve_cmd.add_argument(
+        "--concurrency",
+        type=int,
+        default=2,
+        help="Maximum number of jobs running at the same time, others are queued",
+    )
+    serve_cmd.set_defaults(func=serve)
+
+    submit_cmd = commands.add_parser(
+        "submit",
+        help="Run a taskboot command through a server, from the current directory "
+        "and environment",
+    )
+    submit_cmd.add_argument(
+        "--socket",
+        type=str,
+        default=environ.get("TASKBOOT_SOCKET", DEFAULT_SOCKET),
+        help="Path of the UNIX socket of the server",
+    )
+    submit_cmd.add_argument(
+        "job",
+        nargs=argparse.REMAINDER,
+        help="Taskboot command line to run, with its global options",
+    )
+    submit_cmd.set_defaults(func=submit)
+
+    return parser
+
+
+def main() -> None:
+    parser = build_parser()
     args = parser.parse_args()
-    target = Target(args)
+    try:
+        # Always load the target
+        target = Target(args)
 
-    # Call the assigned function
-    args.func(target, args)
+        # Call the assigned function
+        with Profiler(args.profile, args.profile_output):
+            args.func(target, args)
+    finally:
+        if args.metrics_out:
+            tracer.write_report(args.metrics_out, command=args.command)
 
 
 if __name__ == "__main__":
@@ -9,21 +9,57 @@ import os
 from typing import IO
 from typing import Any
 from typing import Dict
+from typing import Mapping
+from typing import Optional
 
 import taskcluster
 import yaml
 
+from taskboot.cache import SecretCache
+from taskboot.cache import secret_cache
+from taskboot.tracing import traced
+
 logger = logging.getLogger(__name__)
 
 TASKCLUSTER_DEFAULT_URL = "https://taskcluster.net"
 
 
+def options_from_environment(environ: Mapping[str, str]) -> Dict[str, Any]:
+    """
+    Read the Taskcluster root url and credentials from an environment,
+    like taskcluster.optionsFromEnvironment does from the process one
+    """
+    options: Dict[str, Any] = {}
+    if environ.get("TASKCLUSTER_ROOT_URL"):
+        options["rootUrl"] = environ["TASKCLUSTER_ROOT_URL"].rstrip("/")
+
+    credentials = {
+        key: environ[variable]
+        for key, variable in (
+            ("clientId", "TASKCLUSTER_CLIENT_ID"),
+            ("accessToken", "TASKCLUSTER_ACCESS_TOKEN"),
+            ("certificate", "TASKCLUSTER_CERTIFICATE"),
+        )
+        if environ.get(variable)
+    }
+    if credentials:
+        options["credentials"] = credentials
+    return options
+
+
 class Configuration(object):
     config: Dict[str, Any] = {}
 
     def __init__(self, args: argparse.Namespace) -> None:
+        # Jobs of a server run with the environment of their client
+        self.environ: Mapping[str, str] = vars(args).get("environ", os.environ)
+
         if args.secret:
-            self.load_secret(args.secret)
+            # Jobs of a server get their own cache, other runs share the process one
+            if "secret_cache" in vars(args):
+                self.load_secret(args.secret, args.secret_cache)
+            else:
+                self.load_secret(args.secret, secret_cache())
         elif args.config:
             self.load_config(args.config)
         else:
@@ -35,8 +71,8 @@ class Configuration(object):
         raise KeyError
 
     def get_root_url(self) -> str:
-        if "TASKCLUSTER_ROOT_URL" in os.environ:
-            return os.environ["TASKCLUSTER_ROOT_URL"]
+        if "TASKCLUSTER_ROOT_URL" in self.environ:
+            return self.environ["TASKCLUSTER_ROOT_URL"]
         return TASKCLUSTER_DEFAULT_URL
 
     def get_taskcluster_options(self) -> Dict[str, Any]:
@@ -44,8 +80,8 @@ class Configuration(object):
         Helper to get the Taskcluster setup options
         according to current environment (local or Taskcluster)
         """
-        options = taskcluster.optionsFromEnvironment()
-        proxy_url = os.environ.get("TASKCLUSTER_PROXY_URL")
+        options = options_from_environment(self.environ)
+        proxy_url = self.environ.get("TASKCLUSTER_PROXY_URL")
 
         if proxy_url is not None:
             # Always use proxy url when available
@@ -57,12 +93,23 @@ class Configuration(object):
 
         return options
 
-    def load_secret(self, name: str) -> None:
+    @traced("secret")
+    def load_secret(self, name: str, cache: Optional[SecretCache] = None) -> None:
+        # Secrets are shared by the taskboot runs of a task
+        if cache is not None:
+            secret = cache.get(name)
+            if secret is not None:
+                logger.info("Using cached Taskcluster secret {}".format(name))
+                self.config = secret
+                return
+
         secrets = taskcluster.Secrets(self.get_taskcluster_options())
         logging.info("Loading Taskcluster secret {}".format(name))
         payload = secrets.get(name)
         assert "secret" in payload, "Missing secret value"
         self.config = payload["secret"]
+        if cache is not None:
+            cache.add(name, self.config)
 
     def load_config(self, fileobj: IO) -> None:
         self.config = yaml.safe_load(fileobj)
@@ -4,6 +4,9 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import base64
+import contextlib
+import fcntl
+import functools
 import hashlib
 import http.client
 import io
@@ -20,6 +23,9 @@ import time
 import docker as really_old_docker
 from dockerfile_parse import DockerfileParser
 
+from taskboot.cache import cache_dir
+from taskboot.tracing import track_subprocess
+
 logger = logging.getLogger(__name__)
 
 IMG_NAME_REGEX = re.compile(r"(?P<name>[\/\w\-\._]+):?(?P<tag>\S*)")
@@ -28,6 +34,18 @@ IMG_NAME_REGEX = re.compile(r"(?P<name>[\/\w\-\._]+):?(?P<tag>\S*)")
 # so we need to use a *really* outdated client too
 TASKCLUSTER_DIND_API_VERSION = "1.18"
 
+# Number of build context archives kept in the local cache
+CONTEXT_CACHE_SIZE = 10
+
+# Annotation holding the image reference in an OCI image layout index
+OCI_REF_ANNOTATION = "org.opencontainers.image.ref.name"
+
+# Default maximum size of a persistent podman storage, in bytes
+DEFAULT_PODMAN_STORAGE_SIZE = 50 * 1024**3
+
+# Branch whose build cache is used when a branch has none yet
+DEFAULT_CACHE_BRANCH = "master"
+
 
 def read_archive_tags(path):
     tar = tarfile.open(path)
@@ -49,6 +67,324 @@ def read_archive_tags(path):
     return tags
 
 
+def is_oci_layout_archive(path):
+    """
+    Check if a TAR archive holds an OCI image layout instead of a docker archive
+    """
+    with tarfile.open(path) as tar:
+        try:
+            tar.getmember("oci-layout")
+            return True
+        except KeyError:
+            return False
+
+
+def read_oci_layout_refs(layout_dir):
+    """
+    List the image references stored in an OCI image layout directory
+    """
+    with open(os.path.join(layout_dir, "index.json")) as f:
+        index = json.load(f)
+    refs = [
+        manifest["annotations"][OCI_REF_ANNOTATION]
+        for manifest in index.get("manifests", [])
+        if OCI_REF_ANNOTATION in manifest.get("annotations", {})
+    ]
+    assert len(refs) > 0, "No image references found in {}".format(layout_dir)
+    return refs
+
+
+def pack_oci_layout(layout_dir, path):
+    """
+    Write an OCI image layout directory as a single TAR archive
+    Blobs are already compressed and stored once, so no extra compression is applied
+    """
+    logger.info("Packing OCI layout {} into {}".format(layout_dir, path))
+    with tarfile.open(path, "w") as tar:
+        for name in sorted(os.listdir(layout_dir)):
+            tar.add(os.path.join(layout_dir, name), arcname=name)
+
+
+def unpack_oci_layout(path):
+    """
+    Extract an OCI image layout archive into a temporary directory
+    """
+    layout_dir = tempfile.mkdtemp(prefix="taskboot-oci-")
+    logger.info("Extracting OCI layout {} into {}".format(path, layout_dir))
+    with tarfile.open(path) as tar:
+        tar.extractall(layout_dir, filter="data")
+    return layout_dir
+
+
+def read_dockerignore(context_dir):
+    """
+    Load the exclusion patterns from a .dockerignore file in the context
+    Returns a list of (compiled regex, is_exception) tuples
+    """
+    path = os.path.join(context_dir, ".dockerignore")
+    if not os.path.exists(path):
+        return []
+
+    patterns = []
+    with open(path) as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            exception = line.startswith("!")
+            if exception:
+                line = line[1:].strip()
+            line = os.path.normpath(line).lstrip("/")
+            if line == ".":
+                continue
+            patterns.append((dockerignore_regex(line), exception))
+    return patterns
+
+
+def dockerignore_regex(pattern):
+    """
+    Convert a .dockerignore pattern into a regex, following the Go filepath.Match
+    rules used by Docker, with ** matching any number of directories
+    A pattern also matches every file under a matching directory
+    """
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            # Any number of directories, including none
+            regex += "(.*/)?"
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                group = pattern[i + 1 : end]
+                if group.startswith("!"):
+                    group = "^" + group[1:]
+                regex += "[{}]".format(group)
+                i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    return re.compile("^{}(/.*)?$".format(regex))
+
+
+def is_ignored(path, patterns):
+    """
+    Check if a relative path is excluded from the build context
+    The last matching pattern wins, like in Docker
+    """
+    ignored = False
+    for regex, exception in patterns:
+        if regex.match(path):
+            ignored = not exception
+    return ignored
+
+
+def list_build_context(context_dir, dockerfile):
+    """
+    List the files to send to the daemon as a build context, honoring .dockerignore
+    Returns a sorted list of (relative path, absolute path) tuples
+    and the name of the dockerfile inside the context
+    """
+    patterns = read_dockerignore(context_dir)
+    has_exceptions = any(exception for _, exception in patterns)
+
+    files = []
+    for root, dirs, filenames in os.walk(context_dir):
+        rel_root = os.path.relpath(root, context_dir)
+        if rel_root == ".":
+            rel_root = ""
+
+        # Directories can only be skipped entirely when no exception
+        # pattern could re-include one of their files
+        if not has_exceptions:
+            dirs[:] = [
+                d for d in dirs if not is_ignored(os.path.join(rel_root, d), patterns)
+            ]
+
+        # Directories are sent too, to keep empty ones and their modes
+        # Symlinks to directories are not followed, but sent as links
+        for name in filenames + dirs:
+            rel_path = os.path.join(rel_root, name)
+            if is_ignored(rel_path, patterns):
+                continue
+            files.append((rel_path, os.path.join(root, name)))
+
+    # The Dockerfile and .dockerignore are always sent, even when ignored
+    # A Dockerfile outside of the context is added under a dedicated name
+    dockerfile = os.path.realpath(dockerfile)
+    dockerfile_name = os.path.relpath(dockerfile, os.path.realpath(context_dir))
+    if dockerfile_name.startswith(".."):
+        dockerfile_name = ".taskboot.Dockerfile"
+    required = [dockerfile_name, ".dockerignore"]
+    present = {rel_path for rel_path, _ in files}
+    for rel_path in required:
+        full_path = (
+            dockerfile
+            if rel_path == dockerfile_name
+            else os.path.join(context_dir, rel_path)
+        )
+        if rel_path not in present and os.path.exists(full_path):
+            files.append((rel_path, full_path))
+
+    return sorted(files), dockerfile_name
+
+
+def hash_build_context(files, dockerfile_name):
+    """
+    Compute a content hash of the files in a build context
+    """
+    digest = hashlib.sha256(dockerfile_name.encode("utf-8"))
+    for rel_path, full_path in files:
+        stat = os.lstat(full_path)
+        digest.update("\0{}\0{:o}\0".format(rel_path, stat.st_mode).encode("utf-8"))
+        if os.path.islink(full_path):
+            digest.update(os.readlink(full_path).encode("utf-8"))
+            continue
+        if os.path.isdir(full_path):
+            continue
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prepare_build_context(context_dir, dockerfile):
+    """
+    Build a gzip compressed tarball of a build context, honoring .dockerignore
+    The archive is cached by content hash, so retries and builds
+    sharing the same context do not archive the same files again
+    Returns the archive path and the name of the dockerfile in the archive
+    """
+    start = time.time()
+    files, dockerfile_name = list_build_context(context_dir, dockerfile)
+    digest = hash_build_context(files, dockerfile_name)
+
+    contexts = cache_dir("contexts")
+    path = os.path.join(contexts, "{}.tar.gz".format(digest))
+    if os.path.exists(path):
+        # Touch the archive so it stays among the most recent ones
+        os.utime(path)
+        logger.info(
+            "Reusing cached build context {} ({} files, {} bytes)".format(
+                digest[:12], len(files), os.path.getsize(path)
+            )
+        )
+        return path, dockerfile_name
+
+    # Write in a temporary file first so that a crash never leaves
+    # a partial archive in the cache
+    fd, tmp_path = tempfile.mkstemp(dir=contexts, suffix=".tmp")
+    os.close(fd)
+    raw_size = 0
+    try:
+        with tarfile.open(tmp_path, "w:gz", compresslevel=6) as tar:
+            for rel_path, full_path in files:
+                tar.add(full_path, arcname=rel_path, recursive=False)
+                if os.path.isfile(full_path) and not os.path.islink(full_path):
+                    raw_size += os.path.getsize(full_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+    logger.info(
+        "Archived build context {} ({} files, {} bytes, {} compressed) in {:.2f}s".format(
+            digest[:12],
+            len(files),
+            raw_size,
+            os.path.getsize(path),
+            time.time() - start,
+        )
+    )
+
+    # Only keep the most recent contexts
+    archives = sorted(
+        (
+            os.path.join(contexts, name)
+            for name in os.listdir(contexts)
+            if name.endswith(".tar.gz")
+        ),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for old in archives[CONTEXT_CACHE_SIZE:]:
+        logger.debug("Removing old build context {}".format(old))
+        os.unlink(old)
+
+    return path, dockerfile_name
+
+
+def cache_slug(name):
+    """
+    Normalize a name so that it can be used in image repositories and tags
+    """
+    slug = re.sub(r"[^a-z0-9._-]+", "-", name.lower()).strip("-._")
+    assert slug, "Invalid cache name {}".format(name)
+    return slug[:64]
+
+
+def is_local_cache(location):
+    """
+    Build caches in a local directory are given as paths, others are repositories
+    """
+    return location.startswith(("/", "."))
+
+
+class BuildCache(object):
+    """
+    Location of a build cache: a registry repository or a local directory
+    Entries are scoped by branch, so that builds on a branch never overwrite
+    the cache of another one, and fall back on the default branch cache
+    """
+
+    def __init__(self, location, key, branch=None, default_branch=DEFAULT_CACHE_BRANCH):
+        self.local = is_local_cache(location)
+        if self.local:
+            self.location = os.path.realpath(location)
+        else:
+            self.location = location.rstrip("/")
+        self.key = cache_slug(key)
+        self.branches = [cache_slug(default_branch)]
+        if branch and cache_slug(branch) not in self.branches:
+            self.branches.insert(0, cache_slug(branch))
+
+    @property
+    def branch(self):
+        return self.branches[0]
+
+    def repositories(self):
+        """
+        Registry repositories of the cache, holding content addressed entries
+        that can be shared by all the images built
+        """
+        assert not self.local, "Only registry repositories are supported as cache"
+        return [f"{self.location}/{branch}" for branch in self.branches]
+
+    def references(self):
+        """
+        Exports of the cache for an image, in a registry tag or a local directory
+        """
+        if self.local:
+            return [
+                os.path.join(self.location, self.key, branch)
+                for branch in self.branches
+            ]
+        return [f"{self.location}:{self.key}-{branch}" for branch in self.branches]
+
+
 class Tool(object):
     """
     Common interface for tools available in shell
@@ -61,7 +397,8 @@ class Tool(object):
 
     def run(self, command, **params):
         command = [self.binary] + command
-        return subprocess.run(command, check=True, **params)
+        with track_subprocess(command):
+            return subprocess.run(command, check=True, **params)
 
 
 class Docker(Tool):
@@ -105,12 +442,7 @@ class Docker(Tool):
                 if digest == "<none>":
                     logger.warn("Skipping image without digest: {}".format(line))
                     continue
-                repository_parts = repository.split("/")
-                if len(repository_parts) < 3:
-                    registry = None
-                else:
-                    registry = repository_parts[0]
-                    repository = "/".join(repository_parts[1:])
+                registry, repository = split_registry(repository)
                 images.append(
                     {
                         "registry": registry,
@@ -123,7 +455,15 @@ class Docker(Tool):
                 logger.warn("Did not parse this image: {}".format(line))
         return images
 
-    def build(self, context_dir, dockerfile, tags, build_args=[]):
+    def build(
+        self,
+        context_dir,
+        dockerfile,
+        tags,
+        build_args=[],
+        cache_from=None,
+        cache_to=None,
+    ):
         logger.info("Building docker image {}".format(dockerfile))
 
         command = ["build", "--file", dockerfile]
@@ -134,6 +474,9 @@ class Docker(Tool):
         for single_build_arg in build_args:
             command += ["--build-arg", single_build_arg]
 
+        if cache_from is not None or cache_to is not None:
+            command = self.cache_command(command, cache_from, cache_to)
+
         command.append(context_dir)
 
         logger.info("Running docker command: {}".format(command))
@@ -141,6 +484,24 @@ class Docker(Tool):
         self.run(command)
         logger.info("Built image {}".format(", ".join(tags)))
 
+    def cache_command(self, command, cache_from, cache_to):
+        """
+        Import and export the build cache through BuildKit, which is needed
+        to export a cache; the built image is then loaded in the local images
+        """
+        command = ["buildx"] + command + ["--load"]
+        if cache_from is not None:
+            for reference in cache_from.references():
+                if not cache_from.local:
+                    command += ["--cache-from", f"type=registry,ref={reference}"]
+                elif os.path.isdir(reference):
+                    command += ["--cache-from", f"type=local,src={reference}"]
+        if cache_to is not None:
+            reference = cache_to.references()[0]
+            kind = "local,dest" if cache_to.local else "registry,ref"
+            command += ["--cache-to", f"type={kind}={reference},mode=max"]
+        return command
+
     def save(self, tags, path):
         assert isinstance(tags, list)
         assert len(tags) > 0, "Missing tags"
@@ -152,10 +513,20 @@ class Docker(Tool):
         logger.info("Loading image from {}".format(path))
         self.run(["load", "--input", path])
 
+    def save_oci_layout(self, *args, **kwargs):
+        raise NotImplementedError("Cannot write an OCI layout using docker")
+
+    def push_oci_layout(self, *args, **kwargs):
+        raise NotImplementedError("Cannot push an OCI layout using docker")
+
     def push(self, tag):
         logger.info("Pushing image {}".format(tag))
         self.run(["push", tag])
 
+    def pull(self, tag):
+        logger.info("Pulling image {}".format(tag))
+        self.run(["pull", tag])
+
     def tag(self, source, target):
         logger.info("Tagging {} with {}".format(source, target))
         self.run(["tag", source, target])
@@ -222,11 +593,31 @@ class DinD(Tool):
             for image in _list_images()
         ]
 
-    def build(self, context_dir, dockerfile, tags, build_args=[]):
+    def build(
+        self,
+        context_dir,
+        dockerfile,
+        tags,
+        build_args=[],
+        cache_from=None,
+        cache_to=None,
+    ):
         logger.info(f"Building docker image with DinD {dockerfile}")
-        build_output = self.client.build(
-            path=context_dir, dockerfile=dockerfile, buildargs=build_args, tag=tags
-        )
+        if cache_from is not None or cache_to is not None:
+            raise NotImplementedError("Cannot use a build cache with dind")
+
+        # Send our own compressed context instead of letting the client
+        # archive the whole context directory uncompressed
+        context, dockerfile_name = prepare_build_context(context_dir, dockerfile)
+        with open(context, "rb") as fileobj:
+            build_output = self.client.build(
+                fileobj=fileobj,
+                custom_context=True,
+                encoding="gzip",
+                dockerfile=dockerfile_name,
+                buildargs=build_args,
+                tag=tags,
+            )
 
         def _read_line(line):
             try:
@@ -300,8 +691,103 @@ class Podman(Docker):
     Interface to the podman tool, replacing docker daemon
     """
 
-    def __init__(self):
+    def __init__(self, storage=None):
         Tool.__init__(self, "podman")
+        self.storage = storage
+
+    def run(self, command, **params):
+        if self.storage is not None:
+            command = self.storage.options() + command
+        return super().run(command, **params)
+
+    def build(self, context_dir, dockerfile, tags, *args, **kwargs):
+        super().build(context_dir, dockerfile, tags, *args, **kwargs)
+        if self.storage is not None:
+            self.storage.touch([self.inspect_id(tags[0])])
+
+    def graph_root(self):
+        """
+        Directory storing the local images
+        """
+        info = self.run(
+            ["info", "--format", "{{ .Store.GraphRoot }}"], stdout=subprocess.PIPE
+        )
+        return info.stdout.decode("utf-8").strip()
+
+    def remove(self, tags):
+        """
+        Remove a local image, by removing all its tags
+        """
+        logger.info("Removing image {}".format(", ".join(tags)))
+        self.run(["rmi"] + tags, stdout=subprocess.DEVNULL)
+
+    def inspect_id(self, tag):
+        """
+        Get the identifier of a local image
+        """
+        inspect = self.run(
+            ["image", "inspect", "--format", "{{ .Id }}", tag], stdout=subprocess.PIPE
+        )
+        return inspect.stdout.decode("utf-8").strip()
+
+    def list_storage_images(self):
+        """
+        List all the images of the storage, including intermediate ones
+        """
+        output = self.run(
+            ["images", "--all", "--format", "json"], stdout=subprocess.PIPE
+        ).stdout
+        return json.loads(output or b"[]")
+
+    def cache_command(self, command, cache_from, cache_to):
+        """
+        Pull and push the intermediate layers from a registry repository
+        Podman stores them with content based tags, so a single repository
+        can be shared by all the images
+        """
+        command = command + ["--layers"]
+        if cache_from is not None:
+            for repository in cache_from.repositories():
+                command += ["--cache-from", repository]
+        if cache_to is not None:
+            command += ["--cache-to", cache_to.repositories()[0]]
+        return command
+
+    def inspect_digest(self, tag):
+        """
+        Get the digest of a local image, without the sha256 prefix
+        """
+        inspect = self.run(
+            ["image", "inspect", "--format", "{{ .Digest }}", tag],
+            stdout=subprocess.PIPE,
+        )
+        digest = inspect.stdout.decode("utf-8").strip()
+        if digest.startswith("sha256:"):
+            digest = digest[7:]
+        return digest
+
+    def save_oci_layout(self, tags, layout_dir):
+        """
+        Write an image in a shared OCI image layout directory
+        Layers are stored as content addressed blobs, so the layers
+        shared by several images are only stored once
+        """
+        assert isinstance(tags, list)
+        assert len(tags) > 0, "Missing tags"
+        for tag in tags:
+            logger.info("Saving image {} in OCI layout {}".format(tag, layout_dir))
+            self.run(["push", tag, "oci:{}:{}".format(layout_dir, tag)])
+
+    def push_oci_layout(self, layout_dir):
+        """
+        Push all the images of an OCI image layout on the remote repo from config
+        """
+        for tag in read_oci_layout_refs(layout_dir):
+            assert tag.startswith(self.registry), (
+                "Invalid tag {} : must use registry {}".format(tag, self.registry)
+            )
+            self.run(["pull", "oci:{}:{}".format(layout_dir, tag)])
+            self.push(tag)
 
     def list_images(self):
         """
@@ -315,6 +801,167 @@ class Podman(Docker):
         return result
 
 
+class PodmanStorage(object):
+    """
+    Persistent podman storage, shared by the tasks running on a host
+    Tasks hold a shared lock while using the storage, and the garbage
+    collection only runs under an exclusive lock, when no task uses it
+    Images are evicted by least recent use until the storage fits its size
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_PODMAN_STORAGE_SIZE):
+        self.directory = os.path.realpath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.root = os.path.join(self.directory, "storage")
+        self.lock_path = os.path.join(self.directory, "taskboot.lock")
+        self.usage_path = os.path.join(self.directory, "usage.json")
+        self.max_size = max_size
+        self.lock = None
+
+        # Processes using the same storage must share their runtime state,
+        # which is kept outside of the persistent directory as it does not
+        # survive a reboot
+        scope = hashlib.sha256(self.directory.encode("utf-8")).hexdigest()[:16]
+        self.runroot = os.path.join(tempfile.gettempdir(), f"taskboot-podman-{scope}")
+
+    def options(self):
+        return ["--root", self.root, "--runroot", self.runroot]
+
+    def __enter__(self):
+        self.lock = open(self.lock_path, "a")
+        fcntl.flock(self.lock, fcntl.LOCK_SH)
+        logger.info(f"Using persistent podman storage {self.root}")
+        return self
+
+    def __exit__(self, *args):
+        # Try to get the storage for ourselves, or leave the cleanup
+        # to the last task using it
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.collect()
+        except BlockingIOError:
+            logger.info("Podman storage in use, skipping garbage collection")
+        finally:
+            self.lock.close()
+            self.lock = None
+
+    @contextlib.contextmanager
+    def usage(self):
+        """
+        Load the last use of the images under a lock, and save it back on exit
+        """
+        with open(self.usage_path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.usage_path) as f:
+                    usage = json.load(f)
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                usage = {}
+
+            yield usage
+
+            tmp_path = "{}.tmp".format(self.usage_path)
+            with open(tmp_path, "w") as f:
+                json.dump(usage, f)
+            os.replace(tmp_path, self.usage_path)
+
+    def touch(self, image_ids):
+        with self.usage() as usage:
+            for image_id in image_ids:
+                usage[image_id] = time.time()
+
+    def size(self):
+        """
+        Disk usage of the storage, counting hardlinked files once
+        """
+        total = 0
+        inodes = set()
+        for root, dirs, files in os.walk(self.root):
+            for name in dirs + files:
+                try:
+                    stat = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if (stat.st_dev, stat.st_ino) not in inodes:
+                    inodes.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_blocks * 512
+        return total
+
+    def collect(self, podman=None):
+        """
+        Remove the least recently used images until the storage fits its size
+        An image is considered used as long as one of its children is
+        """
+        podman = podman or Podman(self)
+        size = self.size()
+        if size <= self.max_size:
+            logger.info(f"Podman storage uses {size} bytes, no cleanup needed")
+            return
+
+        images = {image["Id"]: image for image in podman.list_storage_images()}
+        with self.usage() as usage:
+            # Forget the images that are no longer stored
+            for image_id in set(usage) - set(images):
+                del usage[image_id]
+            last_used = {
+                image_id: usage.get(image_id, image.get("Created", 0))
+                for image_id, image in images.items()
+            }
+
+        # Propagate the last use of images to their parents
+        children = {}
+        for image_id, image in images.items():
+            parent = image.get("ParentId")
+            if parent in images:
+                children.setdefault(parent, set()).add(image_id)
+
+        @functools.lru_cache(maxsize=None)
+        def _last_use(image_id):
+            return max(
+                [last_used[image_id]]
+                + [_last_use(c) for c in children.get(image_id, ())]
+            )
+
+        # An image shares the layers of its parent, only its own are freed
+        own_sizes = {
+            image_id: max(
+                image.get("Size", 0)
+                - images.get(image.get("ParentId"), {}).get("Size", 0),
+                0,
+            )
+            for image_id, image in images.items()
+        }
+
+        evicted = set()
+        candidates = sorted(images, key=_last_use)
+        while size > self.max_size:
+            # Only images without children can be removed
+            image_id = next((i for i in candidates if not children.get(i)), None)
+            if image_id is None:
+                logger.warning("No more podman images can be evicted")
+                break
+            candidates.remove(image_id)
+
+            logger.info("Evicting podman image {}".format(image_id[:12]))
+            try:
+                podman.run(["rmi", "--force", image_id], stdout=subprocess.DEVNULL)
+            except subprocess.CalledProcessError:
+                logger.warning(f"Failed to remove image {image_id[:12]}")
+                continue
+            parent = images[image_id].get("ParentId")
+            if parent in children:
+                children[parent].discard(image_id)
+            evicted.add(image_id)
+            size -= own_sizes[image_id]
+
+        with self.usage() as usage:
+            for image_id in evicted & set(usage):
+                del usage[image_id]
+        logger.info(
+            f"Evicted {len(evicted)} podman images, storage uses about {size} bytes"
+        )
+
+
 class Skopeo(Tool):
     """
     Interface to the skopeo tool, used to copy local images to remote repositories
@@ -369,6 +1016,30 @@ class Skopeo(Tool):
             self.run(cmd)
             logger.info("Push successful")
 
+    def push_oci_layout(self, layout_dir):
+        """
+        Push all the images of an OCI image layout on the remote repo from config
+        Blobs already present on the registry are not uploaded again,
+        so layers shared between images are only sent once
+        """
+        for tag in read_oci_layout_refs(layout_dir):
+            assert tag.startswith(self.registry), (
+                "Invalid tag {} : must use registry {}".format(tag, self.registry)
+            )
+
+            logger.info("Pushing image as {}".format(tag))
+            cmd = [
+                "copy",
+                "--retry-times",
+                "3",
+                "--authfile",
+                self.auth_file,
+                "oci:{}:{}".format(layout_dir, tag),
+                "docker://{}".format(tag),
+            ]
+            self.run(cmd)
+            logger.info("Push successful")
+
 
 def docker_id_archive(path):
     """Get docker image ID
@@ -399,6 +1070,118 @@ def parse_image_name(image_name):
     return (match.group("name"), match.group("tag") or "latest")
 
 
+def split_registry(repository):
+    """
+    Helper to split the registry from a repository name, as listed by docker
+    Only names with at least 3 parts are considered to have a registry
+    """
+    parts = repository.split("/")
+    if len(parts) < 3:
+        return (None, repository)
+    return (parts[0], "/".join(parts[1:]))
+
+
+class ImageInventory(object):
+    """
+    Index of the local images, by (repository, tag) and by digest
+    It is loaded once and updated as images are built,
+    instead of listing the local images again
+    """
+
+    def __init__(self, images=[]):
+        self.names = {}
+        self.digests = {}
+        for image in images:
+            # Keep the first listed image for a name, like a linear scan would
+            if (image["repository"], image["tag"]) not in self.names:
+                self.add(image)
+
+    @classmethod
+    def load(cls, tool):
+        """
+        Load the inventory from the images listed by a build tool
+        """
+        inventory = cls(tool.list_images())
+        logger.info("Loaded {} local images".format(len(inventory)))
+        return inventory
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, image):
+        """
+        Add or replace an image in the inventory
+        """
+        key = (image["repository"], image["tag"])
+        previous = self.names.get(key)
+        if previous is not None and previous.get("digest"):
+            self.digests[previous["digest"]].remove(previous)
+        self.names[key] = image
+        if image.get("digest"):
+            self.digests.setdefault(image["digest"], []).append(image)
+
+    def add_build(self, tags, digest):
+        """
+        Register the tags of a freshly built image
+        """
+        if not digest:
+            logger.warning("No digest for image {}".format(", ".join(tags)))
+            return
+        for full_tag in tags:
+            name, tag = parse_image_name(full_tag)
+            registry, repository = split_registry(name)
+            self.add(
+                {
+                    "registry": registry,
+                    "repository": repository,
+                    "tag": tag,
+                    "digest": digest,
+                }
+            )
+
+    def remove(self, tags):
+        """
+        Remove the tags of a deleted image
+        """
+        for full_tag in tags:
+            image = self.names.pop(image_key(full_tag), None)
+            if image is not None and image.get("digest"):
+                self.digests[image["digest"]].remove(image)
+
+    def find(self, repository, tag):
+        """
+        Find an image by its repository and tag
+        """
+        return self.names.get((repository, tag))
+
+    def find_digest(self, digest):
+        """
+        Find all the images sharing a digest
+        """
+        if digest.startswith("sha256:"):
+            digest = digest[7:]
+        return self.digests.get(digest, [])
+
+
+def image_key(image):
+    """
+    Identify an image by its repository and tag, without the registry
+    """
+    name, tag = parse_image_name(image)
+    _, repository = split_registry(name)
+    return (repository, tag)
+
+
+def read_parent_images(dockerfile):
+    """
+    List the images used in the FROM statements of a Dockerfile
+    """
+    parser = DockerfileParser()
+    parser.dockerfile_path = dockerfile
+    parser.content = open(dockerfile).read()
+    return parser.parent_images
+
+
 def patch_dockerfile(dockerfile, images):
     """
     Patch an existing Dockerfile to replace FROM image statements
@@ -407,7 +1190,9 @@ def patch_dockerfile(dockerfile, images):
     Bug https://github.com/genuinetools/img/issues/206
     """
     assert os.path.exists(dockerfile), "Missing dockerfile {}".format(dockerfile)
-    assert isinstance(images, list)
+    if isinstance(images, list):
+        images = ImageInventory(images)
+    assert isinstance(images, ImageInventory)
     if not images:
         return
 
@@ -415,18 +1200,18 @@ def patch_dockerfile(dockerfile, images):
         # Replace an image name by its local version
         # when it exists
         repo, tag = parse_image_name(original)
-        for image in images:
-            if image["repository"] == repo and image["tag"] == tag:
-                if image["registry"]:
-                    local = "{}/{}@sha256:{}".format(
-                        image["registry"], image["repository"], image["digest"]
-                    )
-                else:
-                    local = "{}@sha256:{}".format(image["repository"], image["digest"])
-                logger.info("Replacing image {} by {}".format(original, local))
-                return local
+        image = images.find(repo, tag)
+        if image is None:
+            return original
 
-        return original
+        if image["registry"]:
+            local = "{}/{}@sha256:{}".format(
+                image["registry"], image["repository"], image["digest"]
+            )
+        else:
+            local = "{}@sha256:{}".format(image["repository"], image["digest"])
+        logger.info("Replacing image {} by {}".format(original, local))
+        return local
 
     # Parse the given dockerfile and update its parent images
     # with local version given by current img state
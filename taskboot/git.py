@@ -8,7 +8,10 @@ import logging
 import subprocess
 
 from taskboot.config import Configuration
+from taskboot.retry import POLICIES
 from taskboot.target import Target
+from taskboot.tracing import span
+from taskboot.tracing import track_subprocess
 from taskboot.utils import retry
 
 logger = logging.getLogger(__name__)
@@ -35,4 +38,10 @@ def git_push(target: Target, args: argparse.Namespace) -> None:
     else:
         command = ["git", "push", "origin", args.branch]
 
-    retry(lambda: subprocess.run(command, check=True))
+    def _push():
+        # Only the git command is tracked, not the delays between the retries
+        with track_subprocess(command):
+            subprocess.run(command, check=True)
+
+    with span("push", branch=args.branch):
+        retry(_push, policy=POLICIES["push"])
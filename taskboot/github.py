@@ -4,28 +4,98 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import argparse
+import hashlib
+import itertools
 import json
 import logging
+import mimetypes
+import os
 import pathlib
 import re
-from typing import List
-
-from github import Commit
-from github import Github
-from github import GitRef
-from github import Repository
-from github import UnknownObjectException
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import Any
+from typing import Container
+from typing import Dict
+from typing import Optional
+from typing import Set
 
 from taskboot.config import Configuration
+from taskboot.github_client import GITHUB_API_URL
+from taskboot.github_client import GithubClient
 from taskboot.target import Target
+from taskboot.tracing import tracer
 from taskboot.utils import load_named_artifacts
 
 logger = logging.getLogger(__name__)
 
 RELEASE_MESSAGE_REGEX = re.compile(r"^(release|version|bump to) ([\w\-_\.]+)$")
 
+# Maximum number of commits listed in release notes
+MAX_RELEASE_COMMITS = 1000
+
+# Delays between two polls of a workflow run, in seconds
+WORKFLOW_POLL_DELAY = 5
+WORKFLOW_POLL_MAX_DELAY = 60
+
+# Clients are shared by the commands running in the same process
+_clients: Dict[str, GithubClient] = {}
+_clients_lock = threading.Lock()
+
+# Workflow runs already matched to a dispatch by this process
+_claimed_runs: Set[int] = set()
+_claimed_runs_lock = threading.Lock()
+
 
-def is_release_commit(commit: Commit.Commit, tags: List[str]) -> bool:
+def github_client(config: Configuration) -> GithubClient:
+    """
+    Setup the Github API client, using the Github Enterprise API
+    when GITHUB_API_URL is set
+    """
+    token = config.git["token"]
+    base_url = config.environ.get("GITHUB_API_URL", GITHUB_API_URL)
+    key = hashlib.sha256(f"{base_url} {token}".encode("utf-8")).hexdigest()
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = GithubClient(token, base_url=base_url)
+        return _clients[key]
+
+
+def load_repository(client: GithubClient, name: str) -> Dict[str, Any]:
+    repository = client.get(f"/repos/{name}", missing_ok=True)
+    if repository is None:
+        raise Exception(f"Repository {name} is not available")
+    logger.info(
+        f"Loaded Github repository {repository['full_name']} #{repository['id']}"
+    )
+    return repository
+
+
+class TagsCommits(object):
+    """
+    Set of the commits targeted by the repository tags
+    Tags are only listed the first time a commit is looked up
+    """
+
+    def __init__(self, client: GithubClient, repository: str):
+        self.client = client
+        self.repository = repository
+        self.commits: Optional[Set[str]] = None
+
+    def __contains__(self, sha: object) -> bool:
+        if self.commits is None:
+            self.commits = {
+                tag["commit"]["sha"]
+                for tag in self.client.paginate(f"/repos/{self.repository}/tags")
+            }
+            logger.info(f"Loaded {len(self.commits)} tags")
+        return sha in self.commits
+
+
+def is_release_commit(commit: Dict[str, Any], tags: Container[str]) -> bool:
     """
     Check if the github commit is a known tag and has a release message like:
     - Release XXX
@@ -33,39 +103,62 @@ def is_release_commit(commit: Commit.Commit, tags: List[str]) -> bool:
     - Bump to XXX
     """
 
+    # Check if the commit matches the release message regex
+    message = commit["commit"]["message"]
+    if not RELEASE_MESSAGE_REGEX.match(message.lower()):
+        return False
+
     # Check if that commit is a tag too
-    if commit.commit.sha not in tags:
+    if commit["sha"] not in tags:
         return False
 
-    # Check if the commit matches the release message regex
-    message = commit.commit.message
-    if RELEASE_MESSAGE_REGEX.match(message.lower()):
-        logger.info(f"Detected release commit {commit.commit.sha}: {message}")
-        return True
+    logger.info(f"Detected release commit {commit['sha']}: {message}")
+    return True
+
 
-    return False
+def list_release_commits(
+    client: GithubClient, repository: str, tag_name: str, tags: Container[str]
+):
+    """
+    Walk the history from a tag, stopping at the previous release commit
+    Commits are loaded lazily, one page at a time
+    """
+    commits = client.paginate(f"/repos/{repository}/commits", {"sha": tag_name})
+    for i, commit in enumerate(commits):
+        # The first commit is the release commit of the tag itself
+        if i > 0 and is_release_commit(commit, tags):
+            logger.info(f"Stopping at previous release commit {commit['sha']}")
+            return
+        yield commit
 
 
-def build_release_notes(repository: Repository.Repository, tag: GitRef.GitRef) -> str:
+def build_release_notes(client: GithubClient, repository: str, tag_name: str) -> str:
     signature = (
         "\n---\nReleased with [mozilla/task-boot](https://github.com/mozilla/task-boot)"
     )
 
+    # List existing tags sha
+    tags = TagsCommits(client, repository)
+
     # Get all commits between both versions using the comparison endpoint
-    try:
-        latest_release = repository.get_latest_release()
-        diff = repository.compare(latest_release.tag_name, tag.ref)
-        commits = diff.commits
-    except UnknownObjectException:
-        logger.info("No previous release available, will use all commits on repo")
-        commits = [commit for commit in repository.get_commits()]
+    latest_release = client.get(f"/repos/{repository}/releases/latest", missing_ok=True)
+    if latest_release is not None:
+        commits = client.paginate(
+            f"/repos/{repository}/compare/{latest_release['tag_name']}...{tag_name}",
+            key="commits",
+        )
+    else:
+        logger.info("No previous release available, will use commits since last tag")
+        commits = list_release_commits(client, repository, tag_name, tags)
 
-    # List existing tags sha
-    tags = [tag.commit.sha for tag in repository.get_tags()]
+    commits = list(itertools.islice(commits, MAX_RELEASE_COMMITS + 1))
+    if len(commits) > MAX_RELEASE_COMMITS:
+        logger.warning(f"Release notes are limited to {MAX_RELEASE_COMMITS} commits")
+        commits = commits[:MAX_RELEASE_COMMITS]
 
     # Use first line of every commit in between versions
     lines = [
-        "- {}".format(commit.commit.message.splitlines()[0])
+        "- {}".format(commit["commit"]["message"].splitlines()[0])
         for commit in commits
         if not is_release_commit(commit, tags)
     ]
@@ -73,6 +166,63 @@ def build_release_notes(repository: Repository.Repository, tag: GitRef.GitRef) -
     return "\n".join(lines) + signature
 
 
+def is_asset_uploaded(asset: Dict[str, Any], path: str) -> bool:
+    """
+    Check if a release asset is complete and matches a local file,
+    using its digest when provided by Github, or its size
+    """
+    if asset["state"] != "uploaded" or asset["size"] != os.path.getsize(path):
+        return False
+
+    digest = asset.get("digest")
+    if not digest:
+        return True
+    algorithm, _, expected = digest.partition(":")
+    local = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            local.update(chunk)
+    return local.hexdigest() == expected
+
+
+def upload_release_asset(
+    client: GithubClient,
+    release: Dict[str, Any],
+    existing: Dict[str, Dict[str, Any]],
+    name: str,
+    path: str,
+    parent=None,
+) -> None:
+    """
+    Upload an asset on a release, streamed from disk
+    An asset already uploaded with the same content is skipped,
+    and a partial or different one is replaced
+    """
+    asset = existing.get(name)
+    if asset is not None:
+        if is_asset_uploaded(asset, path):
+            logger.info(f"Skipping asset {name}, already uploaded")
+            return
+        logger.info(f"Replacing asset {name} ({asset['state']}, {asset['size']} bytes)")
+        client.delete(asset["url"])
+
+    size = os.path.getsize(path)
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    logger.info(f"Uploading asset {name} using {path}")
+    with tracer.span("upload", parent=parent, asset=name) as s:
+        start = time.monotonic()
+        client.upload(
+            release["upload_url"], path, name, label=name, content_type=content_type
+        )
+        duration = time.monotonic() - start
+        s.add_bytes(size)
+
+    throughput = size / duration / 1024**2 if duration else 0
+    logger.info(
+        f"Uploaded asset {name}: {size} bytes in {duration:.1f}s ({throughput:.1f} MB/s)"
+    )
+
+
 def github_release(target: Target, args: argparse.Namespace) -> None:
     """
     Push all artifacts from dependent tasks
@@ -100,43 +250,154 @@ def github_release(target: Target, args: argparse.Namespace) -> None:
         ]
 
     # Setup GitHub API client and load repository
-    github = Github(config.git["token"])
-    try:
-        repository = github.get_repo(args.repository)
-        logger.info(f"Loaded Github repository {repository.full_name} #{repository.id}")
-    except UnknownObjectException:
-        raise Exception(f"Repository {args.repository} is not available")
+    client = github_client(config)
+    repository = load_repository(client, args.repository)
+    repo_path = f"/repos/{repository['full_name']}"
 
     # Check that tag exists, it must be created by the user manually
     # Usually this task is triggered on a github tag event
     logger.debug(f"Checking git tag {args.version}")
-    try:
-        tag = repository.get_git_ref(f"tags/{args.version}")
-        logger.info(f"Found existing tag {args.version}")
-    except UnknownObjectException:
-        raise Exception(f"Tag {args.version} does not exist on {repository}")
+    tag = client.get(f"{repo_path}/git/ref/tags/{args.version}", missing_ok=True)
+    if tag is None:
+        raise Exception(f"Tag {args.version} does not exist on {args.repository}")
+    logger.info(f"Found existing tag {args.version}")
 
     # Check if requested release exists
     logger.debug(f"Checking requested release {args.version}")
-    try:
-        release = repository.get_release(args.version)
+    release = client.get(f"{repo_path}/releases/tags/{args.version}", missing_ok=True)
+    if release is not None:
         logger.info(f"Found existing release {args.version}")
-    except UnknownObjectException:
+    else:
         # Create new release
         logger.info(f"Creating new release {args.version}")
-        release = repository.create_git_release(
-            tag=args.version,
-            name=args.version,
-            message=build_release_notes(repository, tag),
-            target_commitish=tag.object.sha,
+        release = client.post(
+            f"{repo_path}/releases",
+            {
+                "tag_name": args.version,
+                "name": args.version,
+                "body": build_release_notes(
+                    client, repository["full_name"], args.version
+                ),
+                "target_commitish": tag["object"]["sha"],
+            },
+        ).json()
+
+    # Upload every named asset, skipping the ones from a previous run
+    existing = {
+        asset["name"]: asset
+        for asset in client.paginate(f"{repo_path}/releases/{release['id']}/assets")
+    }
+    parent = tracer.current()
+    with ThreadPoolExecutor(max_workers=args.upload_workers) as executor:
+        uploads = [
+            executor.submit(
+                upload_release_asset,
+                client,
+                release,
+                existing,
+                asset_name,
+                str(artifact_path),
+                parent,
+            )
+            for asset_name, _, artifact_path in assets
+        ]
+        for upload in uploads:
+            upload.result()
+
+    logger.info(f"Release available as {release['html_url']}")
+
+
+def poll(check, timeout: int, what: str):
+    """
+    Call a check until it returns a result or the timeout is reached,
+    sleeping with an exponential backoff between two calls
+    """
+    deadline = time.monotonic() + timeout
+    delay = WORKFLOW_POLL_DELAY
+    while True:
+        result = check()
+        if result is not None:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception(f"Timeout after {timeout}s waiting for {what}")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, WORKFLOW_POLL_MAX_DELAY)
+
+
+def find_workflow_run(
+    client: GithubClient,
+    repository: str,
+    workflow_id: str,
+    ref: str,
+    since: str,
+    timeout: int,
+    correlation_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Find the run started by a workflow dispatch, among the dispatched runs
+    on the reference created since the dispatch and not already claimed by
+    another dispatch of this process
+    With a correlation id, the run is the one showing it in its title,
+    otherwise the match fails when several runs are candidates
+    """
+    branch = re.sub(r"^refs/(heads|tags)/", "", ref)
+    params = {
+        "event": "workflow_dispatch",
+        "branch": branch,
+        "created": f">={since}",
+    }
+    path = f"/repos/{repository}/actions/workflows/{workflow_id}/runs"
+
+    def _matches(run):
+        if run.get("head_branch") != branch:
+            return False
+        if correlation_id is None:
+            return True
+        return any(
+            correlation_id in (run.get(key) or "") for key in ("display_title", "name")
         )
 
-    # Upload every named asset
-    for asset_name, _, artifact_path in assets:
-        logger.info(f"Uploading asset {asset_name} using {artifact_path}")
-        release.upload_asset(name=asset_name, path=artifact_path, label=asset_name)
+    def _check():
+        runs = [
+            run for run in client.get(path, params)["workflow_runs"] if _matches(run)
+        ]
+        with _claimed_runs_lock:
+            runs = [run for run in runs if run["id"] not in _claimed_runs]
+            if not runs:
+                return None
+            if len(runs) > 1:
+                urls = ", ".join(run["html_url"] for run in runs)
+                raise Exception(
+                    f"Several workflow runs match the dispatch ({urls}), "
+                    "use a correlation input to identify it"
+                )
+            _claimed_runs.add(runs[0]["id"])
+            return runs[0]
+
+    return poll(_check, timeout, "the workflow run to start")
+
+
+def wait_workflow_run(
+    client: GithubClient, repository: str, run: Dict[str, Any], timeout: int
+) -> Dict[str, Any]:
+    """
+    Poll a workflow run until it completes
+    Polling uses conditional requests, not counted in the rate limit
+    when the run has not changed
+    """
+    logger.info(f"Waiting for workflow run {run['html_url']}")
+    path = f"/repos/{repository}/actions/runs/{run['id']}"
+    statuses = [run["status"]]
+
+    def _check():
+        current = client.get(path)
+        if current["status"] != statuses[-1]:
+            statuses.append(current["status"])
+            logger.info(f"Workflow run {current['id']} is {current['status']}")
+        return current if current["status"] == "completed" else None
 
-    logger.info(f"Release available as {release.html_url}")
+    return poll(_check, timeout, f"workflow run {run['id']}")
 
 
 def github_workflow_dispatch(target: Target, args: argparse.Namespace) -> None:
@@ -145,23 +406,53 @@ def github_workflow_dispatch(target: Target, args: argparse.Namespace) -> None:
     assert config.has_git_auth(), "Missing Github authentication"
 
     # Setup GitHub API client and load repository
-    github = Github(config.git["token"])
-    try:
-        repository = github.get_repo(args.repository)
-        logger.info(f"Loaded Github repository {repository.full_name} #{repository.id}")
-    except UnknownObjectException:
-        raise Exception(f"Repository {args.repository} is not available")
+    client = github_client(config)
+    repository = load_repository(client, args.repository)
 
-    workflow = repository.get_workflow(args.workflow_id)
+    payload: Dict[str, Any] = {"ref": args.ref}
+    if args.inputs is not None:
+        payload["inputs"] = json.loads(args.inputs)
 
-    result = workflow.create_dispatch(
-        args.ref,
-        json.loads(args.inputs) if args.inputs is not None else None,
+    # Pass a unique id to the workflow, so its run can be told apart from
+    # the runs dispatched concurrently on the same reference
+    correlation_id = None
+    if args.correlation_input is not None:
+        correlation_id = uuid.uuid4().hex
+        payload.setdefault("inputs", {})[args.correlation_input] = correlation_id
+    response = client.post(
+        f"/repos/{repository['full_name']}/actions/workflows/{args.workflow_id}/dispatches",
+        payload,
     )
 
-    if result:
+    if response.status_code == 204:
         logger.info("Workflow dispatch triggered")
     else:
         raise Exception(
             f"Failed to trigger workflow dispatch for Repository {args.repository}"
         )
+
+    if not args.wait:
+        return
+
+    # Use the Github clock to find the run, avoiding any local clock skew
+    since = parsedate_to_datetime(response.headers["Date"]).strftime(
+        "%Y-%m-%dT%H:%M:%SZ"
+    )
+    start = time.monotonic()
+    run = find_workflow_run(
+        client,
+        repository["full_name"],
+        args.workflow_id,
+        args.ref,
+        since,
+        args.wait_timeout,
+        correlation_id,
+    )
+    remaining = max(int(args.wait_timeout - (time.monotonic() - start)), 0)
+    run = wait_workflow_run(client, repository["full_name"], run, remaining)
+
+    if run["conclusion"] != "success":
+        raise Exception(
+            f"Workflow run {run['html_url']} failed with conclusion {run['conclusion']}"
+        )
+    logger.info(f"Workflow run {run['html_url']} succeeded")
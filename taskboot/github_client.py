@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlencode
+
+import requests
+
+from taskboot.cache import cache_dir
+from taskboot.retry import POLICIES
+from taskboot.retry import retry_after
+from taskboot.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+GITHUB_API_URL = "https://api.github.com"
+
+# Number of items loaded by each paginated request
+PER_PAGE = 100
+
+# Requests kept in reserve before waiting for the rate limit reset
+RATE_LIMIT_RESERVE = 20
+
+# Minimum delay between two write requests, recommended by Github
+# to avoid hitting the secondary rate limits
+WRITE_INTERVAL = 1.0
+
+# Longest wait for a rate limit reset, in seconds
+MAX_RATE_LIMIT_WAIT = 900
+
+# Number of attempts for a request hitting a rate limit
+RATE_LIMIT_ATTEMPTS = 3
+
+# Cached responses unused for longer than this are removed, in seconds
+MAX_CACHE_AGE = 7 * 24 * 3600
+
+# Maximum size of the cached responses, the least recently used are removed first
+MAX_CACHE_SIZE = 100 * 1024**2
+
+
+class GithubClient(object):
+    """
+    Minimal Github REST API client, shared by the Github commands
+    GET responses are cached with their ETag and revalidated through conditional
+    requests, which do not count against the rate limit
+    """
+
+    def __init__(self, token, base_url=GITHUB_API_URL, cache_directory=None):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Accept": "application/vnd.github+json",
+                "Authorization": "Bearer {}".format(token),
+                "User-Agent": "taskboot",
+                "X-GitHub-Api-Version": "2022-11-28",
+            }
+        )
+
+        # Responses depend on the token permissions, so cache entries are scoped
+        self.cache_directory = cache_directory or cache_dir("github")
+        self.cache_scope = hashlib.sha256(token.encode("utf-8")).hexdigest()
+        self.prune_cache()
+
+        self.lock = threading.Lock()
+        self.last_write = 0.0
+        self.rate_limit = None
+
+    def build_url(self, path, params=None):
+        url = path if path.startswith("http") else self.base_url + path
+        if params:
+            url = "{}?{}".format(url, urlencode(params))
+        return url
+
+    def cache_path(self, url):
+        key = hashlib.sha256("{} {}".format(self.cache_scope, url).encode("utf-8"))
+        return os.path.join(self.cache_directory, "{}.json".format(key.hexdigest()))
+
+    def load_cached(self, url):
+        path = self.cache_path(url)
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+            # Keep the entry as recently used
+            os.utime(path)
+            return cached
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+
+    def save_cached(self, url, etag, body, next_url):
+        # Responses of private resources are only readable by the current user
+        path = self.cache_path(url)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"etag": etag, "body": body, "next": next_url}, f)
+        os.replace(tmp_path, path)
+
+    def prune_cache(self):
+        """
+        Remove the cached responses unused for a while, then the least
+        recently used ones until the cache fits its size
+        """
+        entries = []
+        for entry in os.scandir(self.cache_directory):
+            if not entry.name.endswith(".json"):
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                status = entry.stat()
+                entries.append((status.st_mtime, status.st_size, entry.path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        oldest = time.time() - MAX_CACHE_AGE
+        for mtime, size, path in entries:
+            if mtime >= oldest and total <= MAX_CACHE_SIZE:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+            total -= size
+
+    def throttle(self, method):
+        """
+        Wait for the rate limit reset when the remaining requests are too low,
+        and space out write requests
+        The delay is computed under the lock but waited outside of it, so that
+        other threads are not blocked on a long rate limit reset
+        """
+        delay, reason = 0, None
+        with self.lock:
+            # The rate limit is kept until a response updates it, so that all
+            # the threads wait for the reset
+            if self.rate_limit is not None:
+                remaining, reset = self.rate_limit
+                if remaining < RATE_LIMIT_RESERVE and reset > time.time():
+                    delay = min(reset - time.time(), MAX_RATE_LIMIT_WAIT)
+                    reason = "rate limit reset"
+
+            if method != "GET":
+                # Reserve the next write slot, so concurrent writes stay spaced
+                now = time.monotonic()
+                write_at = max(now + delay, self.last_write + WRITE_INTERVAL)
+                self.last_write = write_at
+                delay = write_at - now
+
+        self.wait(delay, reason)
+
+    def wait(self, delay, reason=None):
+        delay = min(delay, MAX_RATE_LIMIT_WAIT)
+        if delay <= 0:
+            return
+        if reason is not None:
+            logger.info("Waiting {:.1f}s for Github {}".format(delay, reason))
+            tracer.count("github", "throttled")
+            tracer.count("github", "throttled_sleep", delay)
+        time.sleep(delay)
+
+    def update_rate_limit(self, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.rate_limit = (int(remaining), int(reset))
+
+    def is_rate_limited(self, response):
+        if response.status_code not in (403, 429):
+            return False
+        return (
+            "Retry-After" in response.headers
+            or response.headers.get("X-RateLimit-Remaining") == "0"
+        )
+
+    def request(self, method, path, params=None, missing_ok=False, data=None, **kwargs):
+        """
+        Run a request, waiting when a rate limit is hit
+        Returns None for a missing resource when missing_ok is set
+        A callable data is called on each attempt to open a fresh body, as a
+        streamed body can not be sent twice
+        """
+        url = self.build_url(path, params)
+        for attempt in range(1, RATE_LIMIT_ATTEMPTS + 1):
+            self.throttle(method)
+            tracer.count("github", "requests")
+            with contextlib.ExitStack() as stack:
+                if callable(data):
+                    kwargs["data"] = stack.enter_context(data())
+                elif data is not None:
+                    kwargs["data"] = data
+                response = self.session.request(method, url, **kwargs)
+            self.update_rate_limit(response)
+
+            if not self.is_rate_limited(response) or attempt == RATE_LIMIT_ATTEMPTS:
+                break
+            error = requests.HTTPError(response=response)
+            delay = retry_after(error)
+            if delay is None:
+                reset = response.headers.get("X-RateLimit-Reset")
+                delay = int(reset) - time.time() if reset else 60
+            self.wait(delay, "secondary rate limit")
+
+        if missing_ok and response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response
+
+    def fetch(self, path, params=None, missing_ok=False):
+        """
+        Load a resource, revalidating its cached version through its ETag
+        Returns the decoded body and the url of the next page
+        """
+        url = self.build_url(path, params)
+        cached = self.load_cached(url)
+        headers = {}
+        if cached is not None:
+            headers["If-None-Match"] = cached["etag"]
+
+        response = POLICIES["github"].run(
+            lambda: self.request("GET", url, missing_ok=missing_ok, headers=headers)
+        )
+        if response is None:
+            return None, None
+        if response.status_code == 304:
+            tracer.count("github", "not_modified")
+            return cached["body"], cached["next"]
+
+        body = response.json()
+        next_url = response.links.get("next", {}).get("url")
+        etag = response.headers.get("ETag")
+        if etag:
+            self.save_cached(url, etag, body, next_url)
+        return body, next_url
+
+    def get(self, path, params=None, missing_ok=False):
+        body, _ = self.fetch(path, params, missing_ok)
+        return body
+
+    def paginate(self, path, params=None, key=None):
+        """
+        Lazily iterate over the items of a paginated resource
+        The items are listed under a key for some resources
+        """
+        params = dict(params or {}, per_page=PER_PAGE)
+        url = self.build_url(path, params)
+        while url is not None:
+            body, url = self.fetch(url)
+            yield from (body[key] if key is not None else body)
+
+    def post(self, path, payload=None):
+        return self.request("POST", path, json=payload)
+
+    def delete(self, path):
+        return self.request("DELETE", path)
+
+    def upload(self, upload_url, path, name, label=None, content_type=None):
+        """
+        Upload a release asset, streamed from disk
+        """
+        params = {"name": name}
+        if label:
+            params["label"] = label
+        headers = {
+            "Content-Type": content_type or "application/octet-stream",
+            "Content-Length": str(os.path.getsize(path)),
+        }
+
+        # Upload urls are templates like .../assets{?name,label}
+        url = upload_url.split("{")[0]
+        return self.request(
+            "POST", url, params, data=lambda: open(path, "rb"), headers=headers
+        ).json()
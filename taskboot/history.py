@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import time
+
+from taskboot.cache import cache_dir
+
+logger = logging.getLogger(__name__)
+
+# Phases measured for each service of a compose build
+PHASES = ("build", "save", "compress")
+
+# Number of recent builds used to estimate the duration of a service
+DEFAULT_HISTORY_RUNS = 10
+
+# Number of builds kept for each service, older ones are removed
+MAX_HISTORY_RUNS = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    repository TEXT NOT NULL,
+    service TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    build REAL NOT NULL,
+    save REAL,
+    compress REAL
+);
+CREATE INDEX IF NOT EXISTS builds_service ON builds (repository, service, recorded);
+"""
+
+
+def repository_key(target, args):
+    """
+    Identify the repository of a build: its remote when cloned, its directory
+    when using a local target
+    """
+    return args.git_repository or target.dir
+
+
+class BuildHistory(object):
+    """
+    Durations of the previous compose builds, stored in a SQLite database
+    shared by all taskboot runs on this host
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(cache_dir("history"), "builds.sqlite")
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def record(self, repository, service, durations, recorded=None):
+        """
+        Store the phase durations of a service build, in seconds
+        """
+        assert "build" in durations, "Missing build duration"
+        if recorded is None:
+            recorded = time.time()
+        values = [durations.get(phase) for phase in PHASES]
+        with self.db:
+            self.db.execute(
+                "INSERT INTO builds VALUES (?, ?, ?, ?, ?, ?)",
+                [repository, service, recorded] + values,
+            )
+            self.db.execute(
+                """
+                DELETE FROM builds WHERE repository = ? AND service = ? AND rowid
+                NOT IN (
+                    SELECT rowid FROM builds WHERE repository = ? AND service = ?
+                    ORDER BY recorded DESC LIMIT ?
+                )
+                """,
+                [repository, service, repository, service, MAX_HISTORY_RUNS],
+            )
+
+    def builds(self, repository, service, last=DEFAULT_HISTORY_RUNS):
+        """
+        List the most recent builds of a service, from the oldest
+        """
+        rows = self.db.execute(
+            """
+            SELECT * FROM builds WHERE repository = ? AND service = ?
+            ORDER BY recorded DESC LIMIT ?
+            """,
+            [repository, service, last],
+        ).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def services(self, repository):
+        rows = self.db.execute(
+            "SELECT DISTINCT service FROM builds WHERE repository = ? ORDER BY service",
+            [repository],
+        )
+        return [row["service"] for row in rows]
+
+    def estimate(self, repository, service, last=DEFAULT_HISTORY_RUNS):
+        """
+        Estimate the total duration of a service build from its recent builds,
+        using the median to ignore the occasional cold or failing runs
+        Returns None for services never built
+        """
+        builds = self.builds(repository, service, last)
+        if not builds:
+            return None
+        return statistics.median(map(total_duration, builds))
+
+    def trends(self, repository, last=DEFAULT_HISTORY_RUNS):
+        """
+        Summarize the recent durations of each service: the latest build,
+        the median of the recent ones and the evolution between both halves
+        """
+        trends = []
+        for service in self.services(repository):
+            builds = self.builds(repository, service, last)
+            summary = {"service": service, "builds": len(builds)}
+            for phase in PHASES + ("total",):
+                durations = [
+                    total_duration(build) if phase == "total" else build[phase]
+                    for build in builds
+                ]
+                durations = [d for d in durations if d is not None]
+                if not durations:
+                    continue
+                summary[phase] = {
+                    "last": round(durations[-1], 3),
+                    "median": round(statistics.median(durations), 3),
+                    "trend": trend(durations),
+                }
+            trends.append(summary)
+        return trends
+
+
+def total_duration(build):
+    return sum(build[phase] or 0 for phase in PHASES)
+
+
+def trend(durations):
+    """
+    Relative change of the median duration, between the older and the
+    newer half of the builds
+    """
+    if len(durations) < 2:
+        return None
+    half = len(durations) // 2
+    older = statistics.median(durations[:half])
+    newer = statistics.median(durations[-half:])
+    if not older:
+        return None
+    return round((newer - older) / older, 3)
+
+
+def format_trend(value):
+    return "-" if value is None else "{:+.0%}".format(value)
+
+
+def build_report(target, args):
+    """
+    Display the duration trends of the services built for a repository
+    """
+    repository = args.repository or repository_key(target, args)
+    with BuildHistory(args.build_history) as history:
+        trends = history.trends(repository, args.last)
+
+    if args.json:
+        print(json.dumps({"repository": repository, "services": trends}, indent=2))
+        return
+    if not trends:
+        logger.warning(f"No builds recorded for {repository}")
+        return
+
+    print(f"Builds of {repository}, over the last {args.last} runs")
+    columns = ("service", "builds") + PHASES + ("total",)
+    rows = [list(columns)]
+    for summary in trends:
+        row = [summary["service"], str(summary["builds"])]
+        for phase in PHASES + ("total",):
+            stats = summary.get(phase)
+            row.append(
+                "{:.1f}s / {:.1f}s {}".format(
+                    stats["last"], stats["median"], format_trend(stats["trend"])
+                )
+                if stats
+                else "-"
+            )
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    print("Durations are: last build / median, with the evolution of the median")
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import gzip
+import heapq
+import io
+import json
+import logging
+import os
+import subprocess
+import tarfile
+import zlib
+
+from taskboot.tracing import span
+from taskboot.tracing import track_subprocess
+
+logger = logging.getLogger(__name__)
+
+# Size of the chunks read from the archives
+CHUNK_SIZE = 1024 * 1024
+
+# Members of an archive above this size are never buffered in memory
+MAX_BUFFERED_SIZE = 16 * 1024**2
+
+# Compression level used by podman and docker when pushing layers
+GZIP_LEVEL = 6
+
+# Magic numbers of the compressed layers
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Prefix of the files removed by a layer
+WHITEOUT_PREFIX = ".wh."
+
+# Number of files and duplicates reported by default
+DEFAULT_TOP_FILES = 10
+
+
+class CountingReader(object):
+    """
+    Count the bytes read from a stream, and optionally the size they would
+    have once compressed
+    """
+
+    def __init__(self, fileobj, compress=False):
+        self.fileobj = fileobj
+        self.size = 0
+        self.compressor = (
+            zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if compress else None
+        )
+        self.compressed_size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.size += len(data)
+        if self.compressor is not None:
+            self.compressed_size += len(self.compressor.compress(data))
+        return data
+
+    def drain(self):
+        """
+        Read the rest of the stream, like the padding at the end of a TAR
+        """
+        while self.read(CHUNK_SIZE):
+            pass
+        if self.compressor is not None:
+            self.compressed_size += len(self.compressor.flush())
+            self.compressor = None
+
+
+def layer_path(name):
+    return os.path.normpath(name).lstrip("/")
+
+
+def scan_layer(fileobj, top=DEFAULT_TOP_FILES):
+    """
+    Read a layer in a single pass, listing its files without extracting them
+    Plain layers are compressed on the fly to estimate their pushed size
+    """
+    header = fileobj.peek(512)[:512]
+    if header.startswith(GZIP_MAGIC):
+        compression = "gzip"
+    elif header.startswith(ZSTD_MAGIC):
+        compression = "zstd"
+    else:
+        compression = None
+    stored = CountingReader(fileobj, compress=compression is None)
+
+    if compression == "zstd":
+        # zstd layers can not be decompressed without the zstd binary,
+        # only their stored size is reported
+        stored.drain()
+        return {
+            "compression": compression,
+            "compressed_size": stored.size,
+            "size": None,
+            "files": None,
+            "largest": [],
+            "paths": {},
+            "whiteouts": set(),
+        }
+
+    content = stored
+    if compression == "gzip":
+        content = CountingReader(gzip.GzipFile(fileobj=stored, mode="rb"))
+
+    paths = {}
+    whiteouts = set()
+    with tarfile.open(fileobj=content, mode="r|") as tar:
+        for member in tar:
+            path = layer_path(member.name)
+            directory, name = os.path.split(path)
+            if name.startswith(WHITEOUT_PREFIX):
+                # Opaque directories are not tracked, only removed files
+                if name != WHITEOUT_PREFIX + WHITEOUT_PREFIX + ".opq":
+                    whiteouts.add(os.path.join(directory, name[len(WHITEOUT_PREFIX) :]))
+            elif member.isfile():
+                paths[path] = member.size
+    content.drain()
+    if compression == "gzip":
+        stored.drain()
+
+    return {
+        "compression": compression,
+        "compressed_size": stored.size if compression else stored.compressed_size,
+        "size": content.size,
+        "files": len(paths),
+        "largest": [
+            {"path": path, "size": size}
+            for path, size in heapq.nlargest(top, paths.items(), key=lambda p: p[1])
+        ],
+        "paths": paths,
+        "whiteouts": whiteouts,
+    }
+
+
+@contextlib.contextmanager
+def open_archive(path):
+    """
+    Open an image archive as a stream, decompressing .tar.zst archives
+    through the zstd binary without writing them on disk
+    """
+    if not path.endswith(".zst"):
+        with tarfile.open(path, mode="r|") as tar:
+            yield tar
+        return
+
+    command = ["zstd", "--decompress", "--stdout", "--quiet", path]
+    with track_subprocess(command):
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+                yield tar
+            # Read the end of the stream so that zstd exits cleanly
+            while process.stdout.read(CHUNK_SIZE):
+                pass
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+    assert returncode == 0, "Failed to decompress {}".format(path)
+
+
+def scan_archive(path, top=DEFAULT_TOP_FILES):
+    """
+    Read all the members of a Docker archive once, scanning the layers
+    and keeping the small metadata files
+    """
+    layers = {}
+    metadata = {}
+    with open_archive(path) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            fileobj = tar.extractfile(member)
+            header = fileobj.peek(512)[:512]
+            if (
+                member.name.endswith(".tar")
+                or header[257:262] == b"ustar"
+                or header.startswith((GZIP_MAGIC, ZSTD_MAGIC))
+            ):
+                logger.debug(f"Scanning layer {member.name}")
+                layers[member.name] = scan_layer(fileobj, top)
+            elif member.size <= MAX_BUFFERED_SIZE:
+                metadata[member.name] = fileobj.read()
+
+    assert "manifest.json" in metadata, "Only Docker archives are supported"
+    manifest = json.loads(metadata["manifest.json"])
+
+    # Layers not recognized during the scan are still in memory
+    for image in manifest:
+        for name in image["Layers"]:
+            if name not in layers:
+                assert name in metadata, f"Missing layer {name} in archive"
+                reader = io.BufferedReader(io.BytesIO(metadata[name]))
+                layers[name] = scan_layer(reader, top)
+
+    return manifest, metadata, layers
+
+
+def duplicated_files(layers):
+    """
+    Find the files of an image written by several layers, or removed by an
+    upper layer: all their copies but the last one are wasted space
+    """
+    copies = {}
+    for index, layer in enumerate(layers):
+        for path, size in layer["paths"].items():
+            copies.setdefault(path, []).append((index, size))
+        for path in layer["whiteouts"]:
+            if path in copies:
+                copies[path].append((index, 0))
+
+    duplicates = [
+        {
+            "path": path,
+            "layers": [index for index, _ in entries],
+            "wasted_bytes": sum(size for _, size in entries[:-1]),
+        }
+        for path, entries in copies.items()
+        if len(entries) > 1
+    ]
+    duplicates.sort(key=lambda d: (-d["wasted_bytes"], d["path"]))
+    return duplicates
+
+
+def inspect_image_archive(path, top=DEFAULT_TOP_FILES):
+    """
+    Report the size of each layer of the images in an archive, with the
+    command that created it, its largest files and the files duplicated
+    across layers
+    """
+    with span("inspect", path=path) as s:
+        s.add_bytes(os.path.getsize(path))
+        manifest, metadata, scanned = scan_archive(path, top)
+
+    images = []
+    for image in manifest:
+        config = json.loads(metadata.get(image["Config"], b"{}"))
+        history = [
+            entry
+            for entry in config.get("history", [])
+            if not entry.get("empty_layer", False)
+        ]
+        if len(history) != len(image["Layers"]):
+            history = [{}] * len(image["Layers"])
+
+        layers = []
+        for index, (name, entry) in enumerate(zip(image["Layers"], history)):
+            layer = scanned[name]
+            layers.append(
+                {
+                    "index": index,
+                    "name": name,
+                    "created_by": entry.get("created_by"),
+                    "compression": layer["compression"],
+                    "compressed_size": layer["compressed_size"],
+                    "size": layer["size"],
+                    "files": layer["files"],
+                    "largest": layer["largest"],
+                }
+            )
+
+        duplicates = duplicated_files([scanned[name] for name in image["Layers"]])
+        images.append(
+            {
+                "tags": image.get("RepoTags") or [],
+                "compressed_size": sum(layer["compressed_size"] for layer in layers),
+                "size": sum(layer["size"] or 0 for layer in layers),
+                "layers": layers,
+                "duplicated_files": len(duplicates),
+                "wasted_bytes": sum(d["wasted_bytes"] for d in duplicates),
+                "duplicates": duplicates[:top],
+            }
+        )
+
+    return {"archive": path, "archive_size": os.path.getsize(path), "images": images}
+
+
+def inspect_archive(target, args):
+    """
+    Display the layers making up the images of a saved archive
+    """
+    path = os.path.realpath(args.archive)
+    assert os.path.exists(path), "Missing archive {}".format(path)
+    report = inspect_image_archive(path, args.top)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for image in report["images"]:
+        print(
+            "Image {}: {} bytes, {} bytes compressed".format(
+                ", ".join(image["tags"]) or "untagged",
+                image["size"],
+                image["compressed_size"],
+            )
+        )
+        for layer in image["layers"]:
+            print(
+                "  Layer {}: {} bytes, {} bytes compressed, {} files - {}".format(
+                    layer["index"],
+                    layer["size"],
+                    layer["compressed_size"],
+                    layer["files"],
+                    (layer["created_by"] or "unknown command")[:80],
+                )
+            )
+            for largest in layer["largest"]:
+                print("    {size:>12} {path}".format(**largest))
+        if image["duplicates"]:
+            print(
+                "  {} files duplicated across layers, wasting {} bytes:".format(
+                    image["duplicated_files"], image["wasted_bytes"]
+                )
+            )
+            for duplicate in image["duplicates"]:
+                print(
+                    "    {:>12} {} (layers {})".format(
+                        duplicate["wasted_bytes"],
+                        duplicate["path"],
+                        ", ".join(map(str, duplicate["layers"])),
+                    )
+                )
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import io
+import logging
+import shlex
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import yaml
+
+from taskboot.target import Target
+from taskboot.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Options of the main parser, shared by all the steps of a plan
+GLOBAL_OPTIONS = (
+    "config",
+    "secret",
+    "git_repository",
+    "git_revision",
+    "target",
+    "metrics_out",
+    "profile",
+    "profile_output",
+)
+
+
+def load_plan(path: str) -> List[Dict[str, Any]]:
+    """
+    Load the steps of a plan from a YAML file:
+
+    steps:
+      - name: build
+        command: build-compose --registry registry.example.com
+      - name: push
+        command: [push-artifact, --exclude-filter, "*-test"]
+      - name: release
+        needs: [build]
+        command: github-release org/project 1.0
+
+    A step runs after the steps listed in its needs, or after the previous
+    step when it does not list any, so that plans run in order by default
+    """
+    with open(path) as f:
+        plan = yaml.safe_load(f)
+    assert isinstance(plan, dict) and isinstance(plan.get("steps"), list), (
+        "Invalid plan structure"
+    )
+
+    steps: List[Dict[str, Any]] = []
+    for i, step in enumerate(plan["steps"]):
+        assert isinstance(step, dict), f"Invalid step #{i}"
+        assert "command" in step, f"Missing command in step #{i}"
+        name = str(step.get("name", i))
+        assert name not in [s["name"] for s in steps], f"Duplicate step {name}"
+
+        command = step["command"]
+        if isinstance(command, str):
+            command = shlex.split(command)
+        assert command, f"Empty command in step {name}"
+
+        if "needs" in step:
+            needs = [str(need) for need in step["needs"]]
+        else:
+            needs = [steps[-1]["name"]] if steps else []
+        for need in needs:
+            # Steps can only depend on earlier steps, which prevents cycles
+            assert need in [s["name"] for s in steps], f"Unknown step {need} in {name}"
+
+        steps.append({"name": name, "command": list(map(str, command)), "needs": needs})
+    return steps
+
+
+def step_arguments(
+    parser: argparse.ArgumentParser, command: List[str], args: argparse.Namespace
+) -> argparse.Namespace:
+    """
+    Parse the command of a step, using the global options of the plan run
+    """
+    step_args = parser.parse_args(command)
+    assert step_args.command not in (None, "run"), "Invalid step command {}".format(
+        " ".join(command)
+    )
+    for option in GLOBAL_OPTIONS:
+        setattr(step_args, option, getattr(args, option))
+    if "secret_cache" in vars(args):
+        step_args.secret_cache = args.secret_cache
+    return step_args
+
+
+def run_plan(target: Target, args: argparse.Namespace) -> None:
+    """
+    Run the steps of a plan in this process, sharing the target, configuration,
+    HTTP connections and caches; independent steps run concurrently
+    """
+    from taskboot.cli import build_parser
+
+    steps = load_plan(args.plan)
+
+    # Parse all the commands before running anything, in the same
+    # environment and directory as the plan
+    parser = build_parser(args.environ, args.cwd)
+    for step in steps:
+        step["args"] = step_arguments(parser, step["command"], args)
+
+    # A configuration file can only be read once
+    config = args.config.read() if args.config is not None else None
+
+    def _run(step, parent):
+        if config is not None:
+            step["args"].config = io.StringIO(config)
+        command = " ".join(step["command"])
+        logger.info(f"Running step {step['name']}: {command}")
+        start = time.monotonic()
+        with tracer.span("step", parent=parent, step=step["name"], command=command):
+            step["args"].func(target, step["args"])
+        logger.info(
+            "Step {} finished in {:.1f}s".format(step["name"], time.monotonic() - start)
+        )
+
+    parent = tracer.current()
+    done: set = set()
+    pending = list(steps)
+    running: Dict[Any, str] = {}
+    failed: Optional[Exception] = None
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        while pending or running:
+            # No new step starts once a step failed
+            ready = [] if failed else [s for s in pending if set(s["needs"]) <= done]
+            for step in ready:
+                pending.remove(step)
+                running[executor.submit(_run, step, parent)] = step["name"]
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception as e:
+                    logger.error(f"Step {name} failed: {e}")
+                    failed = failed or e
+
+    if failed is not None:
+        skipped = [step["name"] for step in pending]
+        if skipped:
+            logger.warning("Skipped steps: {}".format(", ".join(skipped)))
+        raise failed
+
+    logger.info(f"Ran {len(steps)} steps")
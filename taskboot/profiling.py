@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import cProfile
+import logging
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+from taskboot.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("cprofile", "sampling", "tracemalloc")
+
+# Default output file for each profiling mode
+PROFILE_OUTPUTS = {
+    "cprofile": "taskboot.pstats",
+    "sampling": "taskboot.folded",
+    "tracemalloc": "taskboot-memory.txt",
+}
+
+# Delay between two stack samples, in seconds
+SAMPLING_INTERVAL = 0.01
+
+# Number of frames kept by tracemalloc, and of allocation sites reported
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 30
+
+
+class StackSampler(threading.Thread):
+    """
+    Sample the wall-clock stacks of a thread at a regular interval
+    Time spent waiting on a subprocess shows up under the span that started it
+    """
+
+    def __init__(self, thread_id, interval=SAMPLING_INTERVAL):
+        super().__init__(name="taskboot-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                filename = os.path.basename(frame.f_code.co_filename)
+                stack.append(
+                    "{} ({}:{})".format(frame.f_code.co_name, filename, frame.f_lineno)
+                )
+                frame = frame.f_back
+            stack.reverse()
+
+            # Prefix the stack with the active span
+            span = tracer.current(self.thread_id)
+            if span is not None:
+                stack.insert(0, "span:{}".format(span.path))
+
+            self.samples[";".join(stack)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        """
+        Write the samples in the folded format used by flamegraph tools
+        """
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+class Profiler(object):
+    """
+    Profile a taskboot subcommand with one of the supported modes
+    The spans report, with the time spent in subprocesses for each span,
+    is written alongside the profile
+    """
+
+    def __init__(self, mode, output=None):
+        assert mode is None or mode in PROFILE_MODES, "Invalid mode {}".format(mode)
+        self.mode = mode
+        self.output = output or PROFILE_OUTPUTS.get(mode)
+        self.profile = None
+        self.sampler = None
+
+    def __enter__(self):
+        if self.mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+        elif self.mode == "sampling":
+            self.sampler = StackSampler(threading.get_ident())
+            self.sampler.start()
+
+        elif self.mode == "tracemalloc":
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+
+        if self.mode is not None:
+            logger.info("Profiling with {} into {}".format(self.mode, self.output))
+        return self
+
+    def __exit__(self, *args):
+        if self.mode == "cprofile":
+            self.profile.disable()
+            self.profile.dump_stats(self.output)
+
+        elif self.mode == "sampling":
+            self.sampler.stop()
+            self.sampler.write(self.output)
+
+        elif self.mode == "tracemalloc":
+            self.write_memory()
+
+        if self.mode is not None:
+            tracer.write_report("{}.spans.json".format(self.output))
+            logger.info("Written {} profile in {}".format(self.mode, self.output))
+
+    def write_memory(self):
+        """
+        Write the peak memory usage and the top allocation sites
+        """
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        with open(self.output, "w") as f:
+            f.write("Peak memory: {} bytes\n".format(peak))
+            f.write("Current memory: {} bytes\n\n".format(current))
+            f.write("Top {} allocation sites:\n".format(TRACEMALLOC_TOP))
+            for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP]:
+                f.write("{}\n".format(stat))
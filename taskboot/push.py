@@ -5,8 +5,8 @@
 
 import logging
 import os
+import shutil
 
-import requests
 import taskcluster
 
 from taskboot.config import Configuration
@@ -14,7 +14,11 @@ from taskboot.docker import Docker
 from taskboot.docker import Podman
 from taskboot.docker import Skopeo
 from taskboot.docker import docker_id_archive
+from taskboot.docker import is_oci_layout_archive
+from taskboot.docker import unpack_oci_layout
+from taskboot.tracing import span
 from taskboot.utils import download_artifact
+from taskboot.utils import http_session
 from taskboot.utils import load_artifacts
 from taskboot.utils import load_named_artifacts
 from taskboot.utils import zstd_decompress
@@ -70,7 +74,21 @@ def push_artifact(queue, push_tool, task_id, artifact_name, custom_tag=None):
     path, ext = os.path.splitext(path)
     assert ext == ".zst"
     zstd_decompress(path)
-    push_tool.push_archive(path, custom_tag)
+
+    with span("push", artifact=artifact_name) as s:
+        s.add_bytes(os.path.getsize(path))
+
+        # An OCI layout holds all the images from a compose build
+        if is_oci_layout_archive(path):
+            assert custom_tag is None, "Cannot use a custom tag with an OCI layout"
+            layout_dir = unpack_oci_layout(path)
+            try:
+                push_tool.push_oci_layout(layout_dir)
+            finally:
+                shutil.rmtree(layout_dir)
+            return
+
+        push_tool.push_archive(path, custom_tag)
 
 
 def heroku_release(target, args):
@@ -102,7 +120,7 @@ def heroku_release(target, args):
 
     updates_payload = []
 
-    for heroku_dyno_name, _, artifact_path in load_named_artifacts(
+    for heroku_dyno_name, artifact_name, artifact_path in load_named_artifacts(
         config, args.task_id, args.artifacts
     ):
         # Push the Docker image
@@ -112,7 +130,9 @@ def heroku_release(target, args):
         assert ext == ".zst"
         zstd_decompress(artifact_path)
 
-        push_tool.push_archive(artifact_path, custom_tag_name)
+        with span("push", artifact=artifact_name) as s:
+            s.add_bytes(os.path.getsize(artifact_path))
+            push_tool.push_archive(artifact_path, custom_tag_name)
 
         # Get the Docker image id
         image_id = docker_id_archive(artifact_path)
@@ -128,7 +148,7 @@ def heroku_release(target, args):
     updates_payload = {"updates": updates_payload}
     logger.debug("Using payload: %r", updates_payload)
 
-    r = requests.patch(
+    r = http_session().patch(
         f"https://api.heroku.com/apps/{args.heroku_app}/formation",
         json=updates_payload,
         headers={
@@ -4,19 +4,171 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import glob
+import hashlib
 import logging
 import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from urllib.parse import urlparse
 
-from setuptools._distutils.core import run_setup
+from packaging.utils import canonicalize_name
+from packaging.utils import parse_sdist_filename
+from packaging.utils import parse_wheel_filename
 from twine.commands.upload import upload as twine_upload
 from twine.settings import Settings
 
 from taskboot.config import Configuration
+from taskboot.tracing import tracer
+from taskboot.tracing import track_subprocess
+from taskboot.utils import http_session
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_REPOSITORY = "https://upload.pypi.org/legacy/"
 
+# Simple indexes of the well known upload repositories
+DEFAULT_INDEXES = {
+    "https://upload.pypi.org/legacy/": "https://pypi.org/simple/",
+    "https://test.pypi.org/legacy/": "https://test.pypi.org/simple/",
+}
+
+# Distributions built through PEP 517
+DISTRIBUTIONS = ("sdist", "wheel")
+
+# Files in the project root never copied in the isolated build trees
+BUILD_LEFTOVERS = ("build", "dist")
+
+
+def ignore_leftovers(root):
+    """
+    Skip the outputs of previous builds, only at the root of the project
+    """
+
+    def _ignore(directory, names):
+        if os.path.abspath(directory) != root:
+            return []
+        return [
+            name
+            for name in names
+            if name in BUILD_LEFTOVERS or name.endswith(".egg-info")
+        ]
+
+    return _ignore
+
+
+def build_distribution(project_dir, distribution, output_dir, parent=None):
+    """
+    Build a distribution with PEP 517 in an isolated environment,
+    from a copy of the project so that builds do not share any state
+    """
+    workdir = tempfile.mkdtemp(prefix=f"taskboot-{distribution}-")
+    try:
+        tree = os.path.join(workdir, "project")
+        root = os.path.abspath(project_dir)
+        shutil.copytree(root, tree, symlinks=True, ignore=ignore_leftovers(root))
+
+        command = [
+            sys.executable,
+            "-m",
+            "build",
+            f"--{distribution}",
+            "--outdir",
+            output_dir,
+            tree,
+        ]
+        with tracer.span("build", parent=parent, distribution=distribution):
+            with track_subprocess(command):
+                subprocess.run(command, check=True)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def parse_distribution_name(path):
+    """
+    Read the normalized project name and version of a built distribution
+    """
+    filename = os.path.basename(path)
+    if filename.endswith(".whl"):
+        name, version, _, _ = parse_wheel_filename(filename)
+    else:
+        name, version = parse_sdist_filename(filename)
+    return name, str(version)
+
+
+def list_index_files(index_url, project, auth=None):
+    """
+    List the files of a project already on a package index, with their sha256
+    Uses the JSON simple API (PEP 691), and falls back on the HTML one (PEP 503)
+    """
+    url = "{}/{}/".format(index_url.rstrip("/"), canonicalize_name(project))
+    response = http_session().get(
+        url,
+        auth=auth,
+        headers={"Accept": "application/vnd.pypi.simple.v1+json, text/html;q=0.1"},
+        timeout=30,
+    )
+    if response.status_code == 404:
+        return {}
+    response.raise_for_status()
+
+    content_type = response.headers.get("Content-Type", "")
+    if content_type.startswith("application/vnd.pypi.simple.v1+json"):
+        return {
+            file["filename"]: file.get("hashes", {}).get("sha256")
+            for file in response.json()["files"]
+        }
+
+    files = {}
+    for href in re.findall(r'href="([^"]+)"', response.text):
+        path, _, fragment = href.partition("#")
+        filename = unquote(path.rsplit("/", 1)[-1])
+        algorithm, _, digest = fragment.partition("=")
+        files[filename] = digest if algorithm == "sha256" else None
+    return files
+
+
+def index_auth(index_url, repository, config):
+    """
+    Only send the upload credentials to an index on the same host as
+    the upload repository, public indexes never need them
+    """
+    index, upload = urlparse(index_url), urlparse(repository)
+    if (index.scheme, index.netloc) != (upload.scheme, upload.netloc):
+        return None
+    return (config.pypi["username"], config.pypi["password"])
+
+
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def filter_published(build, index_files):
+    """
+    Remove the files already published on the index
+    A published file with a different content can not be replaced
+    """
+    to_upload = []
+    for path in build:
+        filename = os.path.basename(path)
+        if filename not in index_files:
+            to_upload.append(path)
+            continue
+
+        digest = index_files[filename]
+        if digest is not None and digest != sha256sum(path):
+            raise Exception(f"{filename} is already published with another content")
+        logger.info(f"Skipping {filename}, already published")
+    return to_upload
+
 
 def publish_pypi(target, args):
     """
@@ -25,29 +177,71 @@ def publish_pypi(target, args):
     config = Configuration(args)
     assert config.has_pypi_auth(), "Missing PyPi authentication"
 
-    # Build the project
-    setup = target.check_path("setup.py")
-    logger.info(f"Building Python project using {setup}")
-    run_setup(setup, ["clean", "sdist", "bdist_wheel"])
+    # A project is described by a pyproject.toml or a setup.py
+    if not os.path.exists(os.path.join(target.dir, "pyproject.toml")):
+        target.check_path("setup.py")
+
+    # Build in a new folder so that files from previous builds are never uploaded
+    dist = tempfile.mkdtemp(prefix="taskboot-dist-")
+    try:
+        upload_distributions(config, args, target, dist)
+    finally:
+        shutil.rmtree(dist)
+
+    logger.info("PyPi publication finished.")
+
+
+def upload_distributions(config, args, target, dist):
+    """
+    Build the distributions in a folder, and upload the unpublished ones
+    """
+    # Build all the distributions in parallel
+    logger.info(f"Building Python project in {target.dir}")
+    parent = tracer.current()
+    with ThreadPoolExecutor(max_workers=len(DISTRIBUTIONS)) as executor:
+        builds = [
+            executor.submit(build_distribution, target.dir, distribution, dist, parent)
+            for distribution in DISTRIBUTIONS
+        ]
+        for future in builds:
+            future.result()
 
     # Check some files were produced
-    dist = target.check_path("dist")
-    build = glob.glob(f"{dist}/*")
+    build = sorted(glob.glob(f"{dist}/*"))
     assert len(build) > 0, "No built files found"
-    logger.info("Will upload {}".format(", ".join(map(os.path.basename, build))))
+    logger.info("Built {}".format(", ".join(map(os.path.basename, build))))
 
     # Use default repository
     repository = args.repository or DEFAULT_REPOSITORY
     logger.info(f"Will upload on {repository}")
 
-    # Upload it through twine
+    # Skip the files already on the index
+    index_url = args.index_url or DEFAULT_INDEXES.get(repository)
+    if index_url is not None:
+        name, version = parse_distribution_name(build[0])
+        auth = index_auth(index_url, repository, config)
+        build = filter_published(build, list_index_files(index_url, name, auth))
+        if not build:
+            logger.info(f"{name} {version} is already published")
+            return
+    else:
+        logger.warning(f"No index known for {repository}, uploading all files")
+
+    # Upload them through twine, concurrently
     upload_settings = Settings(
         username=config.pypi["username"],
         password=config.pypi["password"],
         repository_url=repository,
+        skip_existing=True,
         verbose=True,
-        disable_progress_bar=False,
+        disable_progress_bar=True,
     )
-    twine_upload(upload_settings, build)
 
-    logger.info("PyPi publication finished.")
+    def _upload(path):
+        with tracer.span("upload", parent=parent, file=os.path.basename(path)) as s:
+            s.add_bytes(os.path.getsize(path))
+            twine_upload(upload_settings, [path])
+
+    with ThreadPoolExecutor(max_workers=len(build)) as executor:
+        for future in [executor.submit(_upload, path) for path in build]:
+            future.result()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import http.client
+import logging
+import random
+import subprocess
+import time
+
+import requests
+
+from taskboot.tracing import add_retry
+from taskboot.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying, any other 4xx status is a permanent failure
+TRANSIENT_HTTP_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# Failures that will never succeed on a retry
+PERMANENT_EXCEPTIONS = (
+    AssertionError,
+    FileNotFoundError,
+    KeyError,
+    NotImplementedError,
+    PermissionError,
+    TypeError,
+    ValueError,
+)
+
+# Network failures worth retrying
+TRANSIENT_EXCEPTIONS = (
+    http.client.IncompleteRead,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def http_status(error):
+    """
+    Find the HTTP status code of an exception raised by requests, including
+    the errors of GithubClient, or by the Taskcluster client
+    """
+    response = getattr(error, "response", None)
+    if response is not None and getattr(response, "status_code", None) is not None:
+        return response.status_code
+    status = getattr(error, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after(error):
+    """
+    Read the delay requested by the server through a Retry-After header
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    """
+    Retry an operation with exponential backoff and jitter, within a deadline
+    Only failures classified as transient are retried
+    """
+
+    def __init__(
+        self,
+        name,
+        retries=5,
+        base_delay=1.0,
+        multiplier=2.0,
+        max_delay=60.0,
+        jitter=0.5,
+        deadline=None,
+        transient_exit_codes=None,
+        classify=True,
+    ):
+        assert retries > 0, "Retries must be a positive integer"
+        self.name = name
+        self.retries = retries
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+
+        # Exit codes of failed commands worth retrying, None to retry them all
+        self.transient_exit_codes = transient_exit_codes
+
+        # Without classification, every failure is retried
+        self.classify = classify
+
+    def copy(self, **overrides):
+        """
+        Build a new policy, overriding some parameters
+        """
+        params = dict(self.__dict__, **overrides)
+        return RetryPolicy(**params)
+
+    def delay(self, attempt):
+        """
+        Delay before the next attempt, after a number of failed attempts
+        A random part of the delay, up to the jitter ratio, is removed
+        so that concurrent tasks do not retry all at once
+        """
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def is_transient(self, error):
+        """
+        Classify a failure as transient (worth retrying) or permanent
+        """
+        if isinstance(error, subprocess.CalledProcessError):
+            # Commands killed by a signal are always retried
+            if error.returncode < 0 or self.transient_exit_codes is None:
+                return True
+            return error.returncode in self.transient_exit_codes
+
+        status = http_status(error)
+        if status is not None:
+            return status in TRANSIENT_HTTP_STATUSES or status >= 500
+
+        if isinstance(error, TRANSIENT_EXCEPTIONS):
+            return True
+        if isinstance(error, PERMANENT_EXCEPTIONS):
+            return False
+
+        # Keep retrying unknown failures
+        return True
+
+    def run(self, operation, exception_to_break=None):
+        """
+        Run an operation, retrying its transient failures
+        """
+        counters = "retry:{}".format(self.name)
+        start = time.monotonic()
+        for attempt in range(1, self.retries + 1):
+            try:
+                logger.debug("Trying {} {}/{}".format(self.name, attempt, self.retries))
+                tracer.count(counters, "attempts")
+                return operation()
+            except Exception as e:
+                logger.warning("Try failed: {}".format(e))
+                if exception_to_break and isinstance(e, exception_to_break):
+                    raise
+                if self.classify and not self.is_transient(e):
+                    logger.warning("Permanent failure, will not retry")
+                    tracer.count(counters, "permanent")
+                    raise
+                if attempt == self.retries:
+                    tracer.count(counters, "exhausted")
+                    raise
+
+                delay = max(self.delay(attempt), retry_after(e) or 0)
+                elapsed = time.monotonic() - start
+                if self.deadline is not None and elapsed + delay > self.deadline:
+                    logger.warning(
+                        "Retry deadline of {}s reached for {}".format(
+                            self.deadline, self.name
+                        )
+                    )
+                    tracer.count(counters, "deadline")
+                    raise
+
+                logger.info(
+                    "Retrying {} in {:.1f}s ({}/{})".format(
+                        self.name, delay, attempt, self.retries
+                    )
+                )
+                tracer.count(counters, "retries")
+                tracer.count(counters, "sleep", delay)
+                add_retry()
+                time.sleep(delay)
+
+
+# Policies used by each kind of operation
+# git exits with 128 on network failures, and with 1 when a push is rejected
+POLICIES = {
+    "clone": RetryPolicy(
+        "clone", retries=5, base_delay=2, deadline=600, transient_exit_codes={128}
+    ),
+    "download": RetryPolicy("download", retries=5, base_delay=2, deadline=1800),
+    "build": RetryPolicy("build", retries=3, base_delay=1, max_delay=30),
+    "github": RetryPolicy("github", retries=5, base_delay=2, deadline=600),
+    "push": RetryPolicy(
+        "push", retries=5, base_delay=5, deadline=1800, transient_exit_codes={128}
+    ),
+}
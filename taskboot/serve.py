@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Mapping
+
+from taskboot.cache import new_secret_cache
+from taskboot.target import Target
+from taskboot.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "taskboot.sock")
+
+# Commands that can not run as a job of the server
+SERVER_COMMANDS = (None, "serve", "submit")
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Forward the log records of a job to its client
+    Records are attributed to the job through the active span of their thread,
+    which covers the thread pools used by the commands
+    """
+
+    def __init__(self, root, send):
+        super().__init__()
+        self.root = root
+        self.send = send
+        self.setFormatter(logging.Formatter("%(levelname)s:%(name)s:%(message)s"))
+
+    def emit(self, record):
+        span = tracer.current(record.thread)
+        if span is None or not span.within(self.root):
+            return
+        try:
+            self.send({"log": self.format(record)})
+        except OSError:
+            # The client is gone, the job still runs to completion
+            pass
+
+
+def run_job(
+    build_parser: Callable[[Mapping[str, str], str], argparse.ArgumentParser],
+    job_id: int,
+    argv: List[str],
+    environ: Mapping[str, str],
+    cwd: str,
+    send,
+) -> Dict[str, Any]:
+    """
+    Run a taskboot command in this process, in its own workspace
+    The command runs with the environment and working directory of its client,
+    never with the ones of the server, and secrets are cached for the task of
+    the client, never across jobs in memory
+    """
+    start = time.monotonic()
+    try:
+        args = build_parser(environ, cwd).parse_args(argv)
+    except SystemExit:
+        return {"job": job_id, "status": "error", "error": "Invalid arguments"}
+    if args.command in SERVER_COMMANDS:
+        return {"job": job_id, "status": "error", "error": "Invalid command"}
+    args.secret_cache = new_secret_cache(environ.get("TASK_ID"))
+
+    with tracer.span("job", job=job_id, command=args.command) as root:
+        handler = JobLogHandler(root, send)
+        logging.getLogger().addHandler(handler)
+        target = None
+        try:
+            target = Target(args)
+            args.func(target, args)
+            result = {"job": job_id, "status": "success"}
+        except Exception as e:
+            logger.exception(f"Job {job_id} failed")
+            result = {"job": job_id, "status": "error", "error": str(e)}
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+            # Workspaces created for the job are not reused
+            if target is not None and not args.target:
+                shutil.rmtree(target.dir, ignore_errors=True)
+            if args.secret_cache is not None:
+                args.secret_cache.prune()
+
+    if args.metrics_out:
+        tracer.write_report(args.metrics_out, command=args.command, root=root)
+    tracer.forget(root)
+
+    result["duration"] = round(time.monotonic() - start, 3)
+    return result
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Run the job sent by a client as a JSON line, streaming back its logs
+    and finally its status
+    """
+
+    def handle(self):
+        lock = threading.Lock()
+
+        def _send(message):
+            with lock:
+                self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+        # Jobs never fall back on the environment of the server
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [str(arg) for arg in request["argv"]]
+            environ, cwd = request["environ"], request["cwd"]
+            assert isinstance(environ, dict) and all(
+                isinstance(key, str) and isinstance(value, str)
+                for key, value in environ.items()
+            )
+            assert isinstance(cwd, str) and os.path.isabs(cwd)
+        except (ValueError, KeyError, TypeError, AssertionError):
+            return _send({"status": "error", "error": "Invalid request"})
+
+        job_id = next(self.server.job_ids)
+        logger.info("Queued job {}: {}".format(job_id, " ".join(argv)))
+        _send({"job": job_id, "status": "queued"})
+
+        # Jobs start in submission order, when a worker is available
+        future = self.server.executor.submit(
+            run_job, self.server.build_parser, job_id, argv, environ, cwd, _send
+        )
+        result = future.result()
+        logger.info(f"Job {job_id} finished: {result['status']}")
+        with contextlib.suppress(OSError):
+            _send(result)
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, build_parser, concurrency):
+        super().__init__(path, JobHandler)
+        self.build_parser = build_parser
+        self.job_ids = itertools.count(1)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+def remove_stale_socket(path: str) -> None:
+    """
+    Remove the socket of a previous server, refusing to replace a running one
+    """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except OSError:
+            os.unlink(path)
+            return
+    raise Exception(f"A taskboot server is already listening on {path}")
+
+
+def serve(target: Target, args: argparse.Namespace) -> None:
+    """
+    Run taskboot commands sent on a local UNIX socket, keeping the process
+    state (modules, HTTP connections, caches) warm between jobs
+    """
+    from taskboot.cli import build_parser
+
+    remove_stale_socket(args.socket)
+
+    # Only the current user can submit jobs, as they can use its secrets
+    old_umask = os.umask(0o177)
+    try:
+        server = JobServer(args.socket, build_parser, args.concurrency)
+    finally:
+        os.umask(old_umask)
+
+    def _stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, _stop)
+    logger.info(
+        f"Serving jobs on {args.socket}, running {args.concurrency} at the same time"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping server")
+    finally:
+        server.server_close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(args.socket)
+
+
+def submit(target: Target, args: argparse.Namespace) -> None:
+    """
+    Send a job to a taskboot server, and wait for its completion
+    """
+    argv = args.job[1:] if args.job[:1] == ["--"] else args.job
+    assert argv, "Missing job command"
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(args.socket)
+        # The job runs with the environment and directory of the client
+        request = {"argv": argv, "environ": dict(os.environ), "cwd": os.getcwd()}
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        result: Dict[str, Any] = {}
+        for line in client.makefile("rb"):
+            message = json.loads(line)
+            if "log" in message:
+                print(message["log"], flush=True)
+            elif message.get("status") == "queued":
+                logger.info(f"Job {message['job']} queued")
+            else:
+                result = message
+
+    if result.get("status") != "success":
+        raise Exception(
+            "Job {} failed: {}".format(
+                result.get("job"), result.get("error", "no answer from the server")
+            )
+        )
+    logger.info(f"Job {result['job']} finished in {result['duration']}s")
@@ -8,11 +8,23 @@ import os
 import subprocess
 import tempfile
 
+from taskboot.retry import POLICIES
+from taskboot.tracing import traced
+from taskboot.tracing import track_subprocess
 from taskboot.utils import retry
 
 logger = logging.getLogger(__name__)
 
 
+def git(command, **kwargs):
+    """
+    Run a git command, attributing only its own duration to the current span
+    so that retries wrapping it do not count their delays as git time
+    """
+    with track_subprocess(command):
+        return subprocess.check_output(command, **kwargs)
+
+
 class Target(object):
     """
     A target repository
@@ -33,23 +45,40 @@ class Target(object):
         else:
             logger.warn("No target cloned")
 
+    @traced("clone")
     def clone(self, repository, revision):
         logger.info("Cloning {} @ {}".format(repository, revision))
 
         # Clone
-        cmd = ["git", "-c", "init.defaultBranch=clone", "init", self.dir]
-        subprocess.check_output(cmd)
-        cmd = ["git", "remote", "add", "origin", repository]
-        subprocess.check_output(cmd, cwd=self.dir)
+        git(["git", "-c", "init.defaultBranch=clone", "init", self.dir])
+        git(["git", "remote", "add", "origin", repository], cwd=self.dir)
         cmd = ["git", "fetch", "--quiet", "origin", revision]
-        retry(lambda: subprocess.check_output(cmd, cwd=self.dir))
+        retry(lambda: git(cmd, cwd=self.dir), policy=POLICIES["clone"])
         logger.info("Cloned into {}".format(self.dir))
 
         # Checkout revision to pull modifications
-        cmd = ["git", "checkout", "FETCH_HEAD", "-b", "taskboot"]
-        subprocess.check_output(cmd, cwd=self.dir)
+        git(["git", "checkout", "FETCH_HEAD", "-b", "taskboot"], cwd=self.dir)
         logger.info("Checked out revision {}".format(revision))
 
+    def changed_files(self, revision):
+        """
+        List the files changed between a revision and the checked out one,
+        fetching the revision when it is not available locally
+        """
+        cmd = ["git", "cat-file", "-e", "{}^{{commit}}".format(revision)]
+        with track_subprocess(cmd):
+            missing = subprocess.run(cmd, cwd=self.dir, capture_output=True).returncode
+        if missing:
+            logger.info("Fetching revision {}".format(revision))
+            cmd = ["git", "fetch", "--quiet", "origin", revision]
+            retry(lambda: git(cmd, cwd=self.dir), policy=POLICIES["clone"])
+            revision = "FETCH_HEAD"
+
+        # Paths are relative to the target, even in a sub-directory of a repository
+        cmd = ["git", "diff", "--name-only", "--no-renames", "--relative", "-z"]
+        output = git(cmd + [revision, "HEAD"], cwd=self.dir)
+        return [path for path in output.decode("utf-8").split("\0") if path]
+
     def check_path(self, path):
         """
         Check a path exists in target
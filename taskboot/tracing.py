@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class Span(object):
+    """
+    A named phase of a taskboot run, with its duration,
+    the bytes it moved and the retries it needed
+    """
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.monotonic()
+        self.duration = None
+        self.bytes = 0
+        self.retries = 0
+        self.error = None
+        self.subprocesses = {}
+
+    def add_bytes(self, size):
+        self.bytes += size
+
+    def add_retry(self):
+        self.retries += 1
+
+    def add_subprocess(self, binary, duration):
+        self.subprocesses[binary] = self.subprocesses.get(binary, 0.0) + duration
+
+    @property
+    def path(self):
+        """
+        Full name of the span, including its parents
+        """
+        if self.parent is None:
+            return self.name
+        return "{}/{}".format(self.parent.path, self.name)
+
+    def within(self, root):
+        """
+        Check the span is the root span or one of its descendants
+        """
+        span = self
+        while span is not None:
+            if span is root:
+                return True
+            span = span.parent
+        return False
+
+    def to_dict(self, origin):
+        return {
+            "name": self.name,
+            "path": self.path,
+            "start": round(self.start - origin, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "error": self.error,
+            "subprocesses": {
+                binary: round(duration, 6)
+                for binary, duration in self.subprocesses.items()
+            },
+            "attributes": self.attributes,
+        }
+
+
+class Tracer(object):
+    """
+    Collect the spans of a taskboot run to build a timing report
+    Each thread has its own stack of active spans, indexed by thread id
+    so that other threads (like a profiler) can inspect them
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.counters = {}
+        self.started = datetime.now(timezone.utc)
+        self.origin = time.monotonic()
+
+    @property
+    def stack(self):
+        return self.stacks.setdefault(threading.get_ident(), [])
+
+    def current(self, thread_id=None):
+        """
+        The innermost active span in a thread, defaults to the current thread
+        """
+        stack = self.stacks.get(thread_id or threading.get_ident())
+        return stack[-1] if stack else None
+
+    @contextlib.contextmanager
+    def span(self, name, parent=None, **attributes):
+        """
+        Measure a phase, nested in the current span unless a parent is given
+        """
+        span = Span(name, parent or self.current(), **attributes)
+        with self.lock:
+            self.spans.append(span)
+        self.stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration = time.monotonic() - span.start
+            self.stack.pop()
+            logger.debug("Span {} took {:.3f}s".format(span.path, span.duration))
+
+    def count(self, group, key, value=1):
+        """
+        Increment a named counter, reported along the spans
+        """
+        with self.lock:
+            counters = self.counters.setdefault(group, {})
+            counters[key] = counters.get(key, 0) + value
+
+    def report(self, command=None, root=None):
+        """
+        Build a JSON serializable report of all the spans, or of a root span
+        and its descendants; phases aggregate the spans sharing the same name
+        """
+        with self.lock:
+            spans = [span for span in self.spans if root is None or span.within(root)]
+
+        phases = {}
+        for span in spans:
+            phase = phases.setdefault(
+                span.name, {"count": 0, "duration": 0.0, "bytes": 0, "retries": 0}
+            )
+            phase["count"] += 1
+            phase["duration"] += span.duration or 0.0
+            phase["bytes"] += span.bytes
+            phase["retries"] += span.retries
+        for phase in phases.values():
+            phase["duration"] = round(phase["duration"], 6)
+
+        slowest = max(phases, key=lambda name: phases[name]["duration"], default=None)
+        origin = self.origin if root is None else root.start
+        started = self.started + timedelta(seconds=origin - self.origin)
+        return {
+            "command": command,
+            "started": started.isoformat(),
+            "duration": round(time.monotonic() - origin, 6),
+            "slowest": slowest,
+            "phases": phases,
+            # Counters are not attached to spans, they cover the whole process
+            "counters": self.counters,
+            "spans": [span.to_dict(origin) for span in spans],
+        }
+
+    def forget(self, root):
+        """
+        Drop a finished root span and its descendants, so that a long running
+        process does not keep all its spans
+        """
+        with self.lock:
+            self.spans = [span for span in self.spans if not span.within(root)]
+
+    def write_report(self, path, command=None, root=None):
+        with open(path, "w") as f:
+            json.dump(self.report(command, root), f, indent=2, default=str)
+        logger.info("Written metrics report in {}".format(path))
+
+
+# Tracer shared by the whole process
+tracer = Tracer()
+
+
+def span(name, **attributes):
+    """
+    Measure a phase of the current run
+    """
+    return tracer.span(name, **attributes)
+
+
+def traced(name):
+    """
+    Decorator measuring every call of a function as a span
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def add_bytes(size):
+    """
+    Record bytes moved by the current span, if any
+    """
+    current = tracer.current()
+    if current is not None:
+        current.add_bytes(size)
+
+
+def add_retry():
+    """
+    Record a retry in the current span, if any
+    """
+    current = tracer.current()
+    if current is not None:
+        current.add_retry()
+
+
+@contextlib.contextmanager
+def track_subprocess(command):
+    """
+    Attribute the time spent running an external command
+    to the span that started it
+    """
+    binary = os.path.basename(command[0])
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        current = tracer.current()
+        if current is not None:
+            current.add_subprocess(binary, time.monotonic() - start)
@@ -4,45 +4,126 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import errno
+import hashlib
 import logging
 import os
 import pathlib
 import subprocess
 import tempfile
-import time
+import threading
 from fnmatch import fnmatch
 
 import requests
 import taskcluster
+from requests.adapters import HTTPAdapter
+
+from taskboot.cache import artifact_cache
+from taskboot.retry import POLICIES
+from taskboot.retry import RetryPolicy
+from taskboot.tracing import add_bytes
+from taskboot.tracing import span
+from taskboot.tracing import traced
+from taskboot.tracing import track_subprocess
 
 logger = logging.getLogger(__name__)
 
+# Size of the HTTP connection pool, per host
+HTTP_POOL_SIZE = 32
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+class DiskUsageMonitor(threading.Thread):
+    """
+    Sample the space used on the filesystems of some paths, to report its peak
+    """
 
-def retry(operation, retries=5, wait_between_retries=30, exception_to_break=None):
+    def __init__(self, paths, interval=1.0):
+        super().__init__(name="taskboot-disk-monitor", daemon=True)
+
+        # Each filesystem is only counted once
+        self.paths = {}
+        for path in paths:
+            if path and os.path.exists(path):
+                self.paths.setdefault(os.stat(path).st_dev, path)
+
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.initial = self.peak = self.sample()
+
+    def sample(self):
+        used = 0
+        for path in self.paths.values():
+            try:
+                stat = os.statvfs(path)
+            except FileNotFoundError:
+                continue
+            used += (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+        return used
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.sample())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, self.sample())
+
+
+def retry(
+    operation,
+    retries=5,
+    wait_between_retries=30,
+    exception_to_break=None,
+    policy=None,
+):
     """
     Retry an operation several times
+    Without a policy, any failure is retried at a fixed interval
     """
-    for i in range(retries):
-        try:
-            logger.debug("Trying {}/{}".format(i + 1, retries))
-            return operation()
-        except Exception as e:
-            logger.warn("Try failed: {}".format(e))
-            if exception_to_break and isinstance(e, exception_to_break):
-                raise
-            if i == retries - 1:
-                raise
-            time.sleep(wait_between_retries)
+    if policy is None:
+        policy = RetryPolicy(
+            "default",
+            retries=retries,
+            base_delay=wait_between_retries,
+            multiplier=1,
+            jitter=0,
+            classify=False,
+        )
+    return policy.run(operation, exception_to_break)
 
 
-def download_progress(url, path):
+def http_session():
+    """
+    HTTP session shared by the whole process, so that connections are reused
+    between commands and threads
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE)
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+        return _http_session
+
+
+def download_progress(url, path, expected_sha256=None):
     """
     Download a file using a streamed response
     and display progress
+    Returns the number of bytes written and the sha256 of the content
     """
     written = 0
+    digest = hashlib.sha256()
     percent = 0
-    with requests.get(url, stream=True) as resp:
+    with http_session().get(url, stream=True) as resp:
         resp.raise_for_status()
         total = int(resp.headers.get("Content-Length", 0))
         assert total > 0, "No content-length"
@@ -51,16 +132,27 @@ def download_progress(url, path):
             for chunk in resp.iter_content(chunk_size=1024 * 1024):
                 if chunk:
                     x = f.write(chunk)
+                    digest.update(chunk)
                     written += x
                     p = int(100.0 * written / total)
                     if p % 10 == 0 and p > percent:
                         percent = p
                         logger.info("Written {} %".format(p))
 
+    sha256 = digest.hexdigest()
+    if expected_sha256 is not None and sha256 != expected_sha256:
+        raise Exception(
+            "Invalid sha256 for {}: {} instead of {}".format(
+                path, sha256, expected_sha256
+            )
+        )
+
     logger.info("Written {} with {} bytes".format(path, written))
-    return written
+    add_bytes(written)
+    return written, sha256
 
 
+@traced("list-artifacts")
 def load_artifacts(task_id, queue, artifact_filter, exclude_filter=None):
     """
     Load Taskcluster artifacts from all tasks depending on specified one
@@ -100,17 +192,46 @@ def load_artifacts(task_id, queue, artifact_filter, exclude_filter=None):
     return matching_artifacts
 
 
+def artifact_source(queue, task_id, run_id, artifact_name):
+    """
+    Find the url of an artifact and its expected sha256, only provided
+    by Taskcluster for artifacts using the object storage, through the
+    getUrl download method (the simple method does not return any hash)
+    """
+    info = queue.artifactInfo(task_id, run_id, artifact_name)
+    if info["storageType"] == "object":
+        artifact = queue.artifact(task_id, run_id, artifact_name)
+        objects = taskcluster.Object(
+            {
+                "rootUrl": queue.options["rootUrl"],
+                "credentials": artifact["credentials"],
+            }
+        )
+        download = objects.startDownload(
+            artifact["name"], {"acceptDownloadMethods": {"getUrl": True}}
+        )
+        assert download["method"] == "getUrl", "Unsupported download method {}".format(
+            download["method"]
+        )
+        return download["url"], download["hashes"].get("sha256")
+
+    try:
+        url = queue.buildSignedUrl("getArtifact", task_id, run_id, artifact_name)
+    except taskcluster.exceptions.TaskclusterAuthFailure:
+        url = queue.buildUrl("getArtifact", task_id, run_id, artifact_name)
+    return url, None
+
+
 def download_artifact(queue, task_id, artifact_name, output_directory=None):
     """
     Download a Taskcluster artifact into a local tempfile
+    Artifacts are reused from the local cache when already downloaded
     """
     logger.info("Download {} from {}".format(artifact_name, task_id))
 
-    # Build artifact url
-    try:
-        url = queue.buildSignedUrl("getLatestArtifact", task_id, artifact_name)
-    except taskcluster.exceptions.TaskclusterAuthFailure:
-        url = queue.buildUrl("getLatestArtifact", task_id, artifact_name)
+    # An artifact is immutable once its run is completed
+    status = queue.status(task_id)
+    run_id = status["status"]["runs"][-1]["runId"]
 
     if output_directory is None:
         # Download the artifact in a temporary file
@@ -120,7 +241,19 @@ def download_artifact(queue, task_id, artifact_name, output_directory=None):
         # Download the artifact in a specific directory
         path = output_directory.absolute() / pathlib.Path(artifact_name).name
 
-    retry(lambda: download_progress(url, path))
+    cache = artifact_cache()
+    if cache is not None and cache.get(task_id, run_id, artifact_name, path):
+        return path
+
+    with span("download", task_id=task_id, artifact=artifact_name):
+        url, expected_sha256 = artifact_source(queue, task_id, run_id, artifact_name)
+        _, sha256 = retry(
+            lambda: download_progress(url, path, expected_sha256),
+            policy=POLICIES["download"],
+        )
+
+    if cache is not None:
+        cache.add(task_id, run_id, artifact_name, path, sha256)
 
     return path
 
@@ -179,11 +312,17 @@ def zstd_compress(path: str) -> None:
     if not os.path.exists(path):
         raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
-    subprocess.run(["zstd", "--rm", "-f", path], check=True)
+    with span("compress", path=path) as s:
+        s.add_bytes(os.path.getsize(path))
+        with track_subprocess(["zstd"]):
+            subprocess.run(["zstd", "--rm", "-f", path], check=True)
 
 
 def zstd_decompress(path: str) -> None:
     if not os.path.exists(f"{path}.zst"):
         raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
 
-    subprocess.run(["zstd", "--rm", "-df", f"{path}.zst"], check=True)
+    with span("decompress", path=path) as s:
+        with track_subprocess(["zstd"]):
+            subprocess.run(["zstd", "--rm", "-df", f"{path}.zst"], check=True)
+        s.add_bytes(os.path.getsize(path))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+
+from taskboot import analyze
+from taskboot.analyze import analyze_dockerfile
+from taskboot.analyze import image_tag
+from taskboot.analyze import instruction_arguments
+from taskboot.target import Target
+
+DOCKERFILE = """FROM python:3.11-slim AS build
+RUN apt-get update
+RUN apt-get install -y git
+COPY . /src
+RUN pip install -r /src/requirements.txt
+FROM debian
+COPY --from=build /src /src
+FROM build
+COPY ["src/app.py", "/app/"]
+ADD data /data
+"""
+
+
+def test_instruction_arguments():
+    assert instruction_arguments("--chown=1:1 a b /dst") == (
+        {"chown": "1:1"},
+        ["a", "b", "/dst"],
+    )
+    assert instruction_arguments('["a b", "/dst"]') == ({}, ["a b", "/dst"])
+    assert image_tag("debian") == ("", "")
+    assert image_tag("registry:5000/org/app") == ("", "")
+    assert image_tag("registry:5000/org/app:1.0@sha256:abc") == ("1.0", "sha256:abc")
+
+
+def test_analyze_dockerfile(tmpdir, monkeypatch, capsys):
+    """
+    Validate the cache issues and the context sent by each instruction
+    """
+    tmpdir.join("Dockerfile").write(DOCKERFILE)
+    tmpdir.mkdir("src").join("app.py").write("x" * 100)
+    tmpdir.join("src", "big.bin").write("x" * 1000)
+    tmpdir.mkdir("data").join("values.csv").write("x" * 10)
+    dockerfile = str(tmpdir.join("Dockerfile"))
+
+    monkeypatch.setattr(analyze, "LARGE_CONTEXT_SIZE", 1000)
+    report = analyze_dockerfile(dockerfile, str(tmpdir))
+    assert not report["dockerignore"]
+    assert report["context_files"] == 4
+    assert report["context_bytes"] == 1110 + len(DOCKERFILE)
+    assert [(finding["rule"], finding["line"]) for finding in report["findings"]] == [
+        ("missing-dockerignore", None),
+        ("apt-get-update-alone", 2),
+        ("copy-before-install", 4),
+        ("unpinned-base-image", 6),
+    ]
+    assert {
+        instruction["line"]: instruction["context_bytes"]
+        for instruction in report["instructions"]
+        if "context_bytes" in instruction
+    } == {4: report["context_bytes"], 9: 100, 10: 10}
+
+    # Ignored files are not sent to the build
+    tmpdir.join(".dockerignore").write("**/*.bin\n")
+    args = argparse.Namespace(
+        target=str(tmpdir), git_repository=None, dockerfile="Dockerfile", context=None
+    )
+    analyze.analyze(Target(args), args)
+    report = json.loads(capsys.readouterr().out)
+    assert report["dockerignore"]
+    assert report["context_bytes"] == 110 + len(DOCKERFILE) + len("**/*.bin\n")
+    assert [finding["rule"] for finding in report["findings"]] == [
+        "apt-get-update-alone",
+        "copy-before-install",
+        "unpinned-base-image",
+    ]
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import hashlib
+import os
+import pathlib
+import stat
+
+import pytest
+
+from taskboot import cache as cache_module
+from taskboot import utils
+from taskboot.cache import ArtifactCache
+from taskboot.cache import SecretCache
+from taskboot.cache import artifact_cache
+from taskboot.config import Configuration
+
+
+def write_artifact(path, content):
+    path.write_binary(content)
+    return str(path), hashlib.sha256(content).hexdigest()
+
+
+def test_artifact_cache(tmpdir):
+    """
+    Validate cache hits and misses, and the deduplication of blobs
+    """
+    cache = ArtifactCache(str(tmpdir.mkdir("cache")), max_size=1000)
+    path, sha256 = write_artifact(tmpdir.join("a.tar"), b"content")
+    destination = str(tmpdir.join("out.tar"))
+
+    assert cache.get("task", 0, "public/a.tar", destination) is None
+    cache.add("task", 0, "public/a.tar", path, sha256)
+    assert cache.get("task", 0, "public/a.tar", destination) == sha256
+    with open(destination, "rb") as f:
+        assert f.read() == b"content"
+
+    # Another run of the same task is a different artifact
+    assert cache.get("task", 1, "public/a.tar", destination) is None
+
+    # Blobs are read-only, and shared between artifacts with the same content
+    other, _ = write_artifact(tmpdir.join("b.tar"), b"content")
+    cache.add("other", 0, "public/b.tar", other, sha256)
+    assert os.listdir(cache.blobs) == [sha256]
+    mode = os.stat(cache.blob_path(sha256)).st_mode
+    assert not mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+    # Artifacts modified in place do not corrupt the cache
+    for path in (destination, other):
+        assert not os.path.samefile(path, cache.blob_path(sha256))
+        with open(path, "r+b") as f:
+            f.write(b"CORRUPT")
+    assert cache.get("other", 0, "public/b.tar", destination) == sha256
+    with open(destination, "rb") as f:
+        assert f.read() == b"content"
+
+    # A missing blob is a cache miss
+    os.unlink(cache.blob_path(sha256))
+    assert cache.get("task", 0, "public/a.tar", destination) is None
+
+
+def test_artifact_cache_eviction(tmpdir):
+    """
+    Validate the least recently used blobs are evicted above the maximum size
+    """
+    cache = ArtifactCache(str(tmpdir.mkdir("cache")), max_size=25)
+    destination = str(tmpdir.join("out.tar"))
+    hashes = {}
+    for name in ("a", "b"):
+        path, hashes[name] = write_artifact(tmpdir.join(name), name.encode() * 10)
+        cache.add("task", 0, name, path, hashes[name])
+
+    # Use the first artifact so that the second one is evicted
+    assert cache.get("task", 0, "a", destination) == hashes["a"]
+    path, hashes["c"] = write_artifact(tmpdir.join("c"), b"c" * 10)
+    cache.add("task", 0, "c", path, hashes["c"])
+
+    assert sorted(os.listdir(cache.blobs)) == sorted([hashes["a"], hashes["c"]])
+    assert cache.get("task", 0, "b", destination) is None
+    assert cache.get("task", 0, "a", destination) == hashes["a"]
+
+
+def test_artifact_cache_disabled(monkeypatch):
+    """
+    Validate the cache can be disabled through the environment
+    """
+    monkeypatch.setenv("TASKBOOT_ARTIFACT_CACHE_SIZE", "0")
+    assert artifact_cache() is None
+
+
+def test_secret_cache(tmpdir, monkeypatch):
+    """
+    Validate secrets are shared by the runs of a task, until they expire
+    """
+    directory = str(tmpdir)
+    first = SecretCache("task", directory, ttl=60)
+    assert first.get("project/secret") is None
+    first.add("project/secret", {"token": "xxx"})
+    assert stat.S_IMODE(os.stat(first.path).st_mode) == 0o600
+
+    # Another run of the same task uses the shared file, not another task
+    assert SecretCache("task", directory).get("project/secret") == {"token": "xxx"}
+    assert SecretCache("other", directory).get("project/secret") is None
+
+    # Expired secrets are removed, with the shared file once empty
+    now = cache_module.time.time()
+    monkeypatch.setattr("taskboot.cache.time.time", lambda: now + 120)
+    assert first.get("project/secret") is None
+    first.prune()
+    assert not os.path.exists(first.path)
+
+    # A file readable by other users is never trusted
+    first.add("project/secret", {"token": "xxx"})
+    os.chmod(first.path, 0o644)
+    with pytest.raises(Exception, match="Unsafe permissions"):
+        SecretCache("task", directory).get("project/secret")
+
+
+def test_secret_cache_cleanup(tmpdir, monkeypatch):
+    """
+    Validate the shared files are removed at the end of a task, or once expired
+    """
+    directory = str(tmpdir)
+    previous = SecretCache("previous", directory, ttl=60)
+    previous.add("project/secret", {"token": "xxx"})
+    os.utime(previous.path, (0, 0))
+    concurrent = SecretCache("concurrent", directory, ttl=60)
+    concurrent.add("project/secret", {"token": "zzz"})
+    current = SecretCache("task", directory, ttl=60)
+    current.add("project/secret", {"token": "yyy"})
+    tmpdir.join("unrelated.json").write("{}")
+
+    # Only the expired files of other tasks are pruned
+    current.prune()
+    assert not os.path.exists(previous.path)
+    assert os.path.exists(concurrent.path)
+    assert os.path.exists(current.path)
+    assert tmpdir.join("unrelated.json").check()
+
+    # Clearing the secrets at the end of a task removes all the files
+    monkeypatch.setattr(cache_module, "_secret_cache", current)
+    cache_module.clear_secrets(None, None)
+    assert not os.path.exists(concurrent.path)
+    assert not os.path.exists(current.path)
+    assert current.get("project/secret") is None
+    assert tmpdir.join("unrelated.json").check()
+
+
+def test_configuration_secret_cache(monkeypatch):
+    """
+    Validate a Taskcluster secret is only loaded once
+    """
+    calls = []
+
+    class FakeSecrets(object):
+        def __init__(self, options):
+            pass
+
+        def get(self, name):
+            calls.append(name)
+            return {"secret": {"git": {"token": "xxx"}}}
+
+    monkeypatch.setattr("taskboot.config.taskcluster.Secrets", FakeSecrets)
+    monkeypatch.setattr(cache_module, "_secret_cache", SecretCache(None))
+    args = argparse.Namespace(secret="project/secret", config=None)
+    assert Configuration(args).has_git_auth()
+    assert Configuration(args).has_git_auth()
+    assert calls == ["project/secret"]
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+        self.headers = {"Content-Length": str(len(body))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.body
+
+
+class FakeQueue(object):
+    options = {"rootUrl": "https://tc.example.com"}
+
+    def status(self, task_id):
+        return {"status": {"runs": [{"runId": 0}]}}
+
+    def artifactInfo(self, task_id, run_id, name):
+        return {"storageType": "object"}
+
+    def artifact(self, task_id, run_id, name):
+        return {"name": f"t/{task_id}/{run_id}/{name}", "credentials": {}}
+
+
+def test_download_artifact_integrity(tmpdir, monkeypatch):
+    """
+    Validate artifacts from the object storage are checked against their sha256
+    """
+    content = b"artifact content"
+    payloads = []
+
+    class FakeObjects(object):
+        def __init__(self, options):
+            pass
+
+        def startDownload(self, name, payload):
+            payloads.append(payload)
+            return {
+                "method": "getUrl",
+                "url": "https://storage.example.com/blob",
+                "hashes": {"sha256": hashlib.sha256(content).hexdigest()},
+            }
+
+    body = {"content": content}
+
+    class FakeSession(object):
+        def get(self, url, stream):
+            return FakeResponse(body["content"])
+
+    output = pathlib.Path(str(tmpdir))
+    monkeypatch.setenv("TASKBOOT_ARTIFACT_CACHE_SIZE", "0")
+    monkeypatch.setattr(utils.taskcluster, "Object", FakeObjects, raising=False)
+    monkeypatch.setattr(utils, "http_session", lambda: FakeSession())
+    monkeypatch.setitem(
+        utils.POLICIES, "download", utils.POLICIES["download"].copy(retries=1)
+    )
+
+    path = utils.download_artifact(FakeQueue(), "task", "public/a.tar", output)
+    with open(path, "rb") as f:
+        assert f.read() == content
+    assert payloads == [{"acceptDownloadMethods": {"getUrl": True}}]
+
+    # A corrupted body is refused
+    body["content"] = b"corrupted content"
+    with pytest.raises(Exception, match="Invalid sha256"):
+        utils.download_artifact(FakeQueue(), "task", "public/a.tar", output)
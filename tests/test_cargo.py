@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from taskboot.cargo import CratesIndex
+from taskboot.cargo import index_path
+from taskboot.cargo import load_workspace_crates
+from taskboot.cargo import publication_layers
+
+
+def write_crate(directory, name, dependencies={}, dev_dependencies={}, publish=True):
+    crate = directory.mkdir(name)
+    manifest = [
+        "[package]",
+        f'name = "{name}"',
+        'version = "0.1.0"',
+        'edition = "2021"',
+    ]
+    if not publish:
+        manifest.append("publish = false")
+    for section, deps in (
+        ("dependencies", dependencies),
+        ("dev-dependencies", dev_dependencies),
+    ):
+        manifest.append(f"[{section}]")
+        for dep in deps:
+            manifest.append(f'{dep} = {{ path = "../{dep}", version = "0.1.0" }}')
+    crate.join("Cargo.toml").write("\n".join(manifest) + "\n")
+    crate.mkdir("src").join("lib.rs").write("")
+
+
+@pytest.mark.skipif(shutil.which("cargo") is None, reason="Cargo is not available")
+def test_workspace_layers(tmpdir, monkeypatch):
+    """
+    Validate workspace crates are published in dependency order
+    """
+    tmpdir.join("Cargo.toml").write(
+        '[workspace]\nresolver = "2"\n'
+        'members = ["core", "macros", "cli", "server", "tests"]\n'
+    )
+    write_crate(tmpdir, "core", dev_dependencies=["cli"])
+    write_crate(tmpdir, "macros")
+    write_crate(tmpdir, "cli", dependencies=["core", "macros"])
+    write_crate(tmpdir, "server", dependencies=["core"])
+    write_crate(tmpdir, "tests", dependencies=["cli"], publish=False)
+    monkeypatch.chdir(tmpdir)
+
+    crates = load_workspace_crates()
+    assert sorted(crate["name"] for crate in crates) == [
+        "cli",
+        "core",
+        "macros",
+        "server",
+    ]
+
+    layers = [
+        sorted(crate["name"] for crate in layer) for layer in publication_layers(crates)
+    ]
+    assert layers == [["core", "macros"], ["cli", "server"]]
+
+    # Published crates are not waited for
+    crates = [crate for crate in crates if crate["name"] != "core"]
+    layers = [
+        sorted(crate["name"] for crate in layer) for layer in publication_layers(crates)
+    ]
+    assert layers == [["macros", "server"], ["cli"]]
+
+
+def test_index_path():
+    assert index_path("a") == "1/a"
+    assert index_path("ab") == "2/ab"
+    assert index_path("abc") == "3/a/abc"
+    assert index_path("Serde_Json") == "se/rd/serde_json"
+
+
+class IndexHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        versions = self.server.crates.get(self.path)
+        if versions is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        etag = '"{}"'.format(len(versions))
+        if self.headers.get("If-None-Match") == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        body = "\n".join(
+            json.dumps({"name": "serde", "vers": version}) for version in versions
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def test_crates_index(monkeypatch):
+    """
+    Validate published versions are read and waited for on the sparse index
+    """
+    sleeps = []
+    monkeypatch.setattr("taskboot.cargo.time.sleep", sleeps.append)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), IndexHandler)
+    server.crates = {"/se/rd/serde": ["1.0.0"]}
+    server.requests = 0
+    server.not_modified = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        index = CratesIndex("http://{}:{}".format(*server.server_address))
+        assert index.is_published("serde", "1.0.0")
+        assert not index.is_published("serde", "1.0.1")
+        assert server.not_modified == 1
+        assert not index.is_published("missing", "0.1.0")
+
+        # The new version shows up after a few checks
+        def _sleep(delay):
+            sleeps.append(delay)
+            if len(sleeps) == 3:
+                server.crates["/se/rd/serde"].append("1.0.1")
+
+        monkeypatch.setattr("taskboot.cargo.time.sleep", _sleep)
+        index.wait([{"name": "serde", "version": "1.0.1"}])
+        assert sleeps == [1, 2, 4]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import subprocess
+
+import pytest
+import yaml
+
+from taskboot import build
+from taskboot.history import BuildHistory
+from taskboot.target import Target
+
+SERVICES = {
+    "base": "FROM debian:stable\n",
+    "app": "FROM registry.example.com/org/base:latest\nRUN make\n",
+    "tool": "FROM alpine:3\n",
+    "worker": "FROM org/base AS build\nFROM alpine:3\n",
+}
+
+
+class FakePodman(object):
+    """
+    Podman recording the operations on the local images
+    """
+
+    def __init__(self, storage=None):
+        self.events = []
+
+    def list_images(self):
+        return []
+
+    def graph_root(self):
+        return "/"
+
+    def build(self, context_dir, dockerfile, tags, *args):
+        self.events.append(("build", tags[0]))
+
+    def inspect_digest(self, tag):
+        return "digest-{}".format(tag)
+
+    def save(self, tags, path):
+        self.events.append(("save", tags[0]))
+        with open(path, "w") as f:
+            f.write("image")
+
+    def remove(self, tags):
+        self.events.append(("remove", tags[0]))
+
+    def pull(self, tag):
+        self.events.append(("pull", tag))
+
+    def tag(self, source, target):
+        self.events.append(("tag", target))
+
+
+@pytest.fixture
+def compose_project(tmpdir):
+    services = {}
+    for name, dockerfile in SERVICES.items():
+        tmpdir.mkdir(name).join("Dockerfile").write(dockerfile)
+        services[name] = {"build": {"context": name}, "image": f"org/{name}"}
+    services["db"] = {"image": "postgres"}
+    with open(str(tmpdir.join("docker-compose.yml")), "w") as f:
+        yaml.dump({"version": "3.4", "services": services}, f, sort_keys=False)
+    return tmpdir
+
+
+def compose_args(project, **kwargs):
+    args = argparse.Namespace(
+        target=str(project),
+        git_repository=None,
+        secret=None,
+        config=None,
+        composefile="docker-compose.yml",
+        registry="registry.example.com",
+        write=str(project.join("output")),
+        format="docker-archive",
+        changed_since=None,
+        reuse_tag="latest",
+        remove_images=False,
+        build_retries=1,
+        build_arg=[],
+        service=[],
+        tag=[],
+        cache_from=None,
+        cache_to=None,
+        podman_storage=None,
+        build_history=str(project.join("history.sqlite")),
+    )
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def test_compose_images(compose_project):
+    """
+    Validate the parent images built by other services are detected
+    """
+    args = compose_args(compose_project)
+    services = yaml.safe_load(compose_project.join("docker-compose.yml").read())
+    images = build.compose_images(services["services"], str(compose_project), args)
+    assert {image["service"]: image["parents"] for image in images} == {
+        "base": set(),
+        "app": {"base"},
+        "tool": set(),
+        "worker": {"base"},
+    }
+
+
+def test_schedule_images(compose_project, monkeypatch):
+    """
+    Validate the longest builds start first, once their parents are built
+    """
+    args = compose_args(compose_project)
+    services = yaml.safe_load(compose_project.join("docker-compose.yml").read())
+    images = build.compose_images(services["services"], str(compose_project), args)
+
+    def _order(estimates):
+        return [image["service"] for image in build.schedule_images(images, estimates)]
+
+    assert _order({}) == ["base", "app", "tool", "worker"]
+    assert _order({"base": 1, "app": 5, "tool": 10, "worker": 20}) == [
+        "tool",
+        "base",
+        "worker",
+        "app",
+    ]
+    assert _order({"worker": 20}) == ["base", "app", "tool", "worker"]
+
+    # Services never built are ranked at the median of the known durations
+    assert _order({"base": 30, "tool": 1, "worker": 20}) == [
+        "base",
+        "app",
+        "worker",
+        "tool",
+    ]
+
+    images[0]["parents"] = {"app"}
+    with pytest.raises(AssertionError, match="Circular parent images"):
+        _order({})
+
+    # The durations of the builds are recorded for the next ones
+    podman = FakePodman()
+    monkeypatch.setattr(build, "Podman", lambda storage: podman)
+    monkeypatch.setattr(build, "zstd_compress", lambda path: None)
+    build.build_compose(Target(args), args)
+    with BuildHistory(args.build_history) as history:
+        assert history.services(str(compose_project)) == [
+            "app",
+            "base",
+            "tool",
+            "worker",
+        ]
+        (tool,) = history.builds(str(compose_project), "tool")
+        assert tool["build"] >= 0 and tool["save"] >= 0 and tool["compress"] >= 0
+
+        history.record(str(compose_project), "tool", {"build": 60})
+    podman.events.clear()
+    build.build_compose(Target(args), args)
+    assert [event for event in podman.events if event[0] == "build"][0] == (
+        "build",
+        "registry.example.com/org/tool:latest",
+    )
+
+    # The history is closed even when a build fails
+    closed = []
+
+    class FailingPodman(FakePodman):
+        def build(self, context_dir, dockerfile, tags, *args):
+            raise Exception("Build failed")
+
+    class ClosedHistory(BuildHistory):
+        def close(self):
+            closed.append(self.path)
+            super().close()
+
+    monkeypatch.setattr(build, "Podman", lambda storage: FailingPodman())
+    monkeypatch.setattr(build, "BuildHistory", ClosedHistory)
+    with pytest.raises(Exception, match="Build failed"):
+        build.build_compose(Target(args), args)
+    assert closed == [args.build_history]
+
+
+def test_remove_images(compose_project, monkeypatch):
+    """
+    Validate images are removed once written and not needed as parents anymore
+    """
+    podman = FakePodman()
+    monkeypatch.setattr(build, "Podman", lambda storage: podman)
+    monkeypatch.setattr(build, "zstd_compress", lambda path: None)
+
+    args = compose_args(compose_project, remove_images=True)
+    build.build_compose(Target(args), args)
+
+    assert [(event, image.split("/")[-1]) for event, image in podman.events] == [
+        ("build", "base:latest"),
+        ("save", "base:latest"),
+        ("build", "app:latest"),
+        ("save", "app:latest"),
+        ("remove", "app:latest"),
+        ("build", "tool:latest"),
+        ("save", "tool:latest"),
+        ("remove", "tool:latest"),
+        ("build", "worker:latest"),
+        ("save", "worker:latest"),
+        ("remove", "worker:latest"),
+        ("remove", "base:latest"),
+    ]
+
+    # Images can only be removed once written
+    args = compose_args(compose_project, remove_images=True, write=None)
+    with pytest.raises(AssertionError, match="once written"):
+        build.build_compose(Target(args), args)
+
+
+def git(project, *args):
+    return subprocess.check_output(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@test", *args],
+        cwd=str(project),
+    )
+
+
+@pytest.fixture
+def compose_repository(compose_project):
+    compose_project.join("tool", ".dockerignore").write("*.md\n")
+    git(compose_project, "init", "--quiet")
+    git(compose_project, "add", ".")
+    git(compose_project, "commit", "--quiet", "-m", "Initial")
+    return compose_project
+
+
+def test_changed_services(compose_repository):
+    """
+    Validate changes are mapped to the services using them, and their children
+    """
+    args = compose_args(compose_repository)
+    target = Target(args)
+    services = yaml.safe_load(compose_repository.join("docker-compose.yml").read())
+    images = build.compose_images(services["services"], target.dir, args)
+    composefile = str(compose_repository.join("docker-compose.yml"))
+
+    # Files excluded from the build context do not affect the service
+    compose_repository.join("tool", "README.md").write("Tool")
+    git(compose_repository, "add", ".")
+    git(compose_repository, "commit", "--quiet", "-m", "Docs")
+    assert target.changed_files("HEAD~1") == ["tool/README.md"]
+    assert build.changed_services(target, images, composefile, "HEAD~1") == set()
+
+    # Children of a changed service are built again
+    compose_repository.join("base", "setup.sh").write("exit 0")
+    git(compose_repository, "add", ".")
+    git(compose_repository, "commit", "--quiet", "-m", "Setup")
+    assert build.changed_services(target, images, composefile, "HEAD~1") == {
+        "base",
+        "app",
+        "worker",
+    }
+
+    compose_repository.join("docker-compose.yml").write("\n", mode="a")
+    git(compose_repository, "commit", "--quiet", "-am", "Compose")
+    assert build.changed_services(target, images, composefile, "HEAD~1") == {
+        "base",
+        "app",
+        "tool",
+        "worker",
+    }
+
+
+def test_reuse_images(compose_repository, monkeypatch):
+    """
+    Validate unchanged services reuse their published image when written
+    """
+    podman = FakePodman()
+    monkeypatch.setattr(build, "Podman", lambda storage: podman)
+    monkeypatch.setattr(build, "zstd_compress", lambda path: None)
+    compose_repository.join("tool", "run.sh").write("exit 0")
+    git(compose_repository, "add", ".")
+    git(compose_repository, "commit", "--quiet", "-m", "Tool")
+
+    args = compose_args(compose_repository, changed_since="HEAD~1", reuse_tag="main")
+    build.build_compose(Target(args), args)
+    assert podman.events == [
+        ("pull", "registry.example.com/org/base:main"),
+        ("tag", "registry.example.com/org/base:latest"),
+        ("save", "registry.example.com/org/base:latest"),
+        ("pull", "registry.example.com/org/app:main"),
+        ("tag", "registry.example.com/org/app:latest"),
+        ("save", "registry.example.com/org/app:latest"),
+        ("build", "registry.example.com/org/tool:latest"),
+        ("save", "registry.example.com/org/tool:latest"),
+        ("pull", "registry.example.com/org/worker:main"),
+        ("tag", "registry.example.com/org/worker:latest"),
+        ("save", "registry.example.com/org/worker:latest"),
+    ]
+
+    # Without writing the images, only the changed services are built
+    podman.events.clear()
+    args = compose_args(compose_repository, changed_since="HEAD~1", write=None)
+    build.build_compose(Target(args), args)
+    assert podman.events == [("build", "registry.example.com/org/tool:latest")]
+
+    # A changed child is built alone when its parent did not change
+    compose_repository.join("app", "run.sh").write("exit 0")
+    git(compose_repository, "add", ".")
+    git(compose_repository, "commit", "--quiet", "-m", "App")
+    podman.events.clear()
+    args = compose_args(compose_repository, changed_since="HEAD~1", write=None)
+    build.build_compose(Target(args), args)
+    assert podman.events == [("build", "registry.example.com/org/app:latest")]
@@ -3,12 +3,26 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
+import subprocess
+import tarfile
 import uuid
 
 from taskboot.build import gen_docker_images
+from taskboot.docker import BuildCache
+from taskboot.docker import Docker
+from taskboot.docker import ImageInventory
+from taskboot.docker import Podman
+from taskboot.docker import PodmanStorage
+from taskboot.docker import is_oci_layout_archive
+from taskboot.docker import list_build_context
+from taskboot.docker import pack_oci_layout
 from taskboot.docker import parse_image_name
 from taskboot.docker import patch_dockerfile
+from taskboot.docker import prepare_build_context
 from taskboot.docker import read_manifest
+from taskboot.docker import read_oci_layout_refs
+from taskboot.docker import unpack_oci_layout
 from taskboot.docker import write_manifest
 
 DOCKERFILE_SIMPLE = """
@@ -144,6 +158,42 @@ def test_list_local_images(mock_docker):
     ]
 
 
+def test_image_inventory(mock_docker):
+    """
+    Validate the local images inventory, loaded once and updated after builds
+    """
+    mock_docker.images = [
+        ("registry.com/repo/test", "latest", "sha256:deadbeef"),
+        ("registry.com/repo/test", "v1", "sha256:deadbeef"),
+        ("other.com/repo/test", "latest", "sha256:coffee"),
+    ]
+    inventory = ImageInventory.load(mock_docker)
+    assert len(inventory) == 2
+    assert inventory.find("repo/test", "latest") == {
+        "registry": "registry.com",
+        "repository": "repo/test",
+        "tag": "latest",
+        "digest": "deadbeef",
+    }
+    assert inventory.find("repo/test", "v2") is None
+    assert [image["tag"] for image in inventory.find_digest("sha256:deadbeef")] == [
+        "latest",
+        "v1",
+    ]
+
+    # A build replaces the existing tags
+    inventory.add_build(["registry.com/repo/test:latest", "myimage:dev"], "abcd1234")
+    assert inventory.find("repo/test", "latest")["digest"] == "abcd1234"
+    assert inventory.find("myimage", "dev") == {
+        "registry": None,
+        "repository": "myimage",
+        "tag": "dev",
+        "digest": "abcd1234",
+    }
+    assert len(inventory.find_digest("abcd1234")) == 2
+    assert [image["tag"] for image in inventory.find_digest("deadbeef")] == ["v1"]
+
+
 def test_patch_manifest(hello_archive):
     """
     Test low level functions to patch a docker image
@@ -203,3 +253,225 @@ def test_tags_generation():
         "somewhere.com/repo/myimage:b",
         "somewhere.com/repo/myimage:c",
     ]
+
+
+def test_build_context(tmp_path, monkeypatch):
+    """
+    Validate the build context archive, honoring .dockerignore and cached by content
+    """
+    monkeypatch.setenv("TASKBOOT_CACHE_DIR", str(tmp_path / "cache"))
+
+    context = tmp_path / "context"
+    (context / "src").mkdir(parents=True)
+    (context / "node_modules" / "lib").mkdir(parents=True)
+    (context / "Dockerfile").write_text(DOCKERFILE_SIMPLE)
+    (context / "src" / "main.py").write_text("print('hello')")
+    (context / "src" / "debug.log").write_text("noise")
+    (context / "node_modules" / "lib" / "index.js").write_text("noise")
+    (context / "README.md").write_text("readme")
+    (context / "NOTES.md").write_text("notes")
+    (context / ".dockerignore").write_text(
+        "# Comment\nnode_modules\n**/*.log\n*.md\n!README.md\nDockerfile\n"
+    )
+
+    files, dockerfile_name = list_build_context(
+        str(context), str(context / "Dockerfile")
+    )
+    assert dockerfile_name == "Dockerfile"
+    assert [rel_path for rel_path, _ in files] == [
+        ".dockerignore",
+        "Dockerfile",
+        "README.md",
+        "src",
+        "src/main.py",
+    ]
+
+    # The archive is reused as long as the content does not change
+    path, _ = prepare_build_context(str(context), str(context / "Dockerfile"))
+    with tarfile.open(path) as tar:
+        assert sorted(tar.getnames()) == [
+            ".dockerignore",
+            "Dockerfile",
+            "README.md",
+            "src",
+            "src/main.py",
+        ]
+    assert prepare_build_context(str(context), str(context / "Dockerfile")) == (
+        path,
+        "Dockerfile",
+    )
+    (context / "src" / "main.py").write_text("print('updated')")
+    assert prepare_build_context(str(context), str(context / "Dockerfile"))[0] != path
+
+    # A Dockerfile outside of the context is added under a specific name
+    outside = tmp_path / "Dockerfile.outside"
+    outside.write_text(DOCKERFILE_SIMPLE)
+    path, dockerfile_name = prepare_build_context(str(context), str(outside))
+    assert dockerfile_name == ".taskboot.Dockerfile"
+    with tarfile.open(path) as tar:
+        assert ".taskboot.Dockerfile" in tar.getnames()
+
+
+def test_oci_layout(tmp_path, hello_archive):
+    """
+    Validate OCI layout archives, holding several images with shared blobs
+    """
+    layout = tmp_path / "layout"
+    (layout / "blobs" / "sha256").mkdir(parents=True)
+    (layout / "blobs" / "sha256" / "abcd").write_bytes(b"layer")
+    (layout / "oci-layout").write_text(json.dumps({"imageLayoutVersion": "1.0.0"}))
+    (layout / "index.json").write_text(
+        json.dumps(
+            {
+                "schemaVersion": 2,
+                "manifests": [
+                    {
+                        "digest": "sha256:1234",
+                        "annotations": {
+                            "org.opencontainers.image.ref.name": "registry.com/repo/a:latest"
+                        },
+                    },
+                    {
+                        "digest": "sha256:5678",
+                        "annotations": {
+                            "org.opencontainers.image.ref.name": "registry.com/repo/b:latest"
+                        },
+                    },
+                ],
+            }
+        )
+    )
+
+    archive = tmp_path / "oci-layout.tar"
+    pack_oci_layout(str(layout), str(archive))
+    assert is_oci_layout_archive(str(archive))
+    assert not is_oci_layout_archive(str(hello_archive))
+
+    unpacked = unpack_oci_layout(str(archive))
+    assert read_oci_layout_refs(unpacked) == [
+        "registry.com/repo/a:latest",
+        "registry.com/repo/b:latest",
+    ]
+    with open(f"{unpacked}/blobs/sha256/abcd", "rb") as f:
+        assert f.read() == b"layer"
+
+
+def test_build_cache(tmp_path):
+    """
+    Validate the build cache options, scoped by branch
+    """
+    commands = []
+
+    def _run(command, **kwargs):
+        commands.append(command)
+
+    registry = BuildCache("registry.example.com/org/cache/", "backend", "feature/X")
+    assert registry.repositories() == [
+        "registry.example.com/org/cache/feature-x",
+        "registry.example.com/org/cache/master",
+    ]
+    assert registry.references() == [
+        "registry.example.com/org/cache:backend-feature-x",
+        "registry.example.com/org/cache:backend-master",
+    ]
+
+    # Podman shares the registry repository between images
+    podman = Podman.__new__(Podman)
+    podman.storage = None
+    podman.run = _run
+    podman.build("/src", "/src/Dockerfile", ["backend:latest"], [], registry, registry)
+    assert commands.pop() == [
+        "build",
+        "--file",
+        "/src/Dockerfile",
+        "--tag",
+        "backend:latest",
+        "--layers",
+        "--cache-from",
+        "registry.example.com/org/cache/feature-x",
+        "--cache-from",
+        "registry.example.com/org/cache/master",
+        "--cache-to",
+        "registry.example.com/org/cache/feature-x",
+        "/src",
+    ]
+
+    # Docker exports a cache per image, only importing existing directories
+    local = BuildCache(str(tmp_path), "backend", "main", "main")
+    assert local.branches == ["main"]
+    (tmp_path / "backend" / "main").mkdir(parents=True)
+    docker = Docker.__new__(Docker)
+    docker.run = _run
+    docker.build("/src", "/src/Dockerfile", ["backend:latest"], [], local, local)
+    cache = str(tmp_path / "backend" / "main")
+    assert commands.pop()[-6:] == [
+        "--load",
+        "--cache-from",
+        f"type=local,src={cache}",
+        "--cache-to",
+        f"type=local,dest={cache},mode=max",
+        "/src",
+    ]
+
+    # Without cache, the build command does not change
+    docker.build("/src", "/src/Dockerfile", ["backend:latest"])
+    assert commands.pop()[0] == "build"
+
+
+def test_podman_storage(tmp_path, monkeypatch):
+    """
+    Validate the least recently used images are evicted from a persistent storage
+    """
+    monkeypatch.setattr("taskboot.docker.time.time", lambda: 1000)
+    storage = PodmanStorage(str(tmp_path), max_size=100)
+    assert storage.options()[:2] == ["--root", str(tmp_path / "storage")]
+
+    # The base image is used through its child, the old image is never used
+    images = [
+        {"Id": "base", "Created": 10, "Size": 100},
+        {"Id": "app", "Created": 20, "ParentId": "base", "Size": 130},
+        {"Id": "old", "Created": 15, "Size": 100},
+        {"Id": "tool", "Created": 30, "Size": 60},
+    ]
+    storage.touch(["app"])
+    monkeypatch.setattr(storage, "size", lambda: 250)
+
+    class FakePodman(object):
+        def __init__(self, failing=()):
+            self.removed = []
+            self.failing = failing
+
+        def list_storage_images(self):
+            return images
+
+        def run(self, command, **kwargs):
+            assert command[:2] == ["rmi", "--force"]
+            if command[2] in self.failing:
+                raise subprocess.CalledProcessError(1, command)
+            self.removed.append(command[2])
+
+    # The storage is measured once, and the evicted sizes subtracted
+    podman = FakePodman()
+    storage.collect(podman)
+    assert podman.removed == ["old", "tool"]
+    with storage.usage() as usage:
+        assert usage == {"app": 1000}
+
+    # A parent is never evicted while its child could not be removed
+    images = [images[0], images[1]]
+    podman = FakePodman(failing=["app"])
+    storage.collect(podman)
+    assert podman.removed == []
+    with storage.usage() as usage:
+        assert usage == {"app": 1000}
+
+    # The cleanup only happens when no other task uses the storage
+    collected = []
+    other = PodmanStorage(str(tmp_path))
+    for instance in (storage, other):
+        monkeypatch.setattr(instance, "collect", lambda: collected.append(True))
+    with other:
+        with storage:
+            pass
+        assert collected == []
+    assert len(collected) == 1
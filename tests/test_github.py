@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+
+import pytest
+
+from taskboot import github
+
+
+def make_commit(sha, message):
+    return {"sha": sha, "commit": {"message": message}}
+
+
+class FakeClient(object):
+    """
+    Github client on a repository without any release,
+    recording the commits loaded and the uploads
+    """
+
+    def __init__(self, commits=[], tags=[]):
+        self.commits = commits
+        self.tags = tags
+        self.loaded = 0
+        self.tags_listed = 0
+        self.uploads = []
+        self.deleted = []
+
+    def get(self, path, params=None, missing_ok=False):
+        assert path == "/repos/org/repo/releases/latest"
+        return None
+
+    def paginate(self, path, params=None, key=None):
+        if path == "/repos/org/repo/tags":
+            self.tags_listed += 1
+            return [{"commit": {"sha": sha}} for sha in self.tags]
+
+        assert path == "/repos/org/repo/commits"
+        return self.iter_commits()
+
+    def iter_commits(self):
+        for commit in self.commits:
+            self.loaded += 1
+            yield commit
+
+    def delete(self, url):
+        self.deleted.append(url)
+
+    def upload(self, upload_url, path, name, label=None, content_type=None):
+        with open(path, "rb") as f:
+            self.uploads.append((name, f.read(), content_type))
+
+
+def test_release_notes_since_last_tag():
+    """
+    Validate the release notes stop at the previous release commit
+    """
+    commits = [
+        make_commit("c5", "Release 2.0"),
+        make_commit("c4", "Fix something\n\nDetails"),
+        make_commit("c3", "Version bump unrelated"),
+        make_commit("c2", "Release 1.0"),
+        make_commit("c1", "Initial commit"),
+    ]
+    client = FakeClient(commits, tags=["c5", "c2"])
+
+    notes = github.build_release_notes(client, "org/repo", "2.0")
+
+    assert notes.splitlines()[:2] == ["- Fix something", "- Version bump unrelated"]
+    assert client.loaded == 4
+    assert client.tags_listed == 1
+
+
+def test_release_notes_limit(monkeypatch):
+    """
+    Validate the number of commits in release notes is capped
+    """
+    monkeypatch.setattr(github, "MAX_RELEASE_COMMITS", 3)
+    commits = [make_commit(f"c{i}", f"Change {i}") for i in range(10)]
+    client = FakeClient(commits)
+
+    notes = github.build_release_notes(client, "org/repo", "1.0")
+
+    assert notes.splitlines()[:4] == ["- Change 0", "- Change 1", "- Change 2", "---"]
+    assert client.loaded == 4
+    assert client.tags_listed == 0
+
+
+def test_upload_release_assets(tmpdir):
+    """
+    Validate uploaded assets are skipped and broken ones are replaced
+    """
+    path = tmpdir.join("asset.txt")
+    path.write_binary(b"content")
+    path = str(path)
+    digest = "sha256:{}".format(hashlib.sha256(b"content").hexdigest())
+
+    def _asset(name, state, size, digest=None):
+        return {
+            "name": name,
+            "state": state,
+            "size": size,
+            "digest": digest,
+            "url": f"/assets/{name}",
+        }
+
+    existing = {
+        "by-size": _asset("by-size", "uploaded", 7),
+        "by-digest": _asset("by-digest", "uploaded", 7, digest),
+        "partial": _asset("partial", "starter", 0),
+        "different": _asset("different", "uploaded", 7, "sha256:deadbeef"),
+    }
+    client = FakeClient()
+    release = {"upload_url": "https://uploads/assets{?name,label}"}
+    for name in ("by-size", "by-digest", "partial", "different", "new.txt"):
+        github.upload_release_asset(client, release, existing, name, path)
+
+    assert client.uploads == [
+        ("partial", b"content", "application/octet-stream"),
+        ("different", b"content", "application/octet-stream"),
+        ("new.txt", b"content", "text/plain"),
+    ]
+    assert client.deleted == ["/assets/partial", "/assets/different"]
+
+
+class RunsClient(object):
+    """
+    Github client answering with a sequence of responses
+    """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, path, params=None):
+        self.requests.append((path, params))
+        return self.responses.pop(0)
+
+
+def test_wait_workflow_run(monkeypatch):
+    """
+    Validate a dispatched workflow run is found and polled with a backoff
+    """
+    sleeps = []
+    monkeypatch.setattr("taskboot.github.time.sleep", sleeps.append)
+
+    monkeypatch.setattr("taskboot.github._claimed_runs", set())
+
+    client = RunsClient(
+        [
+            {"workflow_runs": []},
+            {
+                "workflow_runs": [
+                    {"id": 2, "head_branch": "other"},
+                    {"id": 1, "head_branch": "main"},
+                ]
+            },
+        ]
+    )
+    run = github.find_workflow_run(
+        client, "org/repo", "ci.yml", "refs/heads/main", "2026-01-01T00:00:00Z", 60
+    )
+    assert run == {"id": 1, "head_branch": "main"}
+    assert client.requests[0] == (
+        "/repos/org/repo/actions/workflows/ci.yml/runs",
+        {
+            "event": "workflow_dispatch",
+            "branch": "main",
+            "created": ">=2026-01-01T00:00:00Z",
+        },
+    )
+
+    run = {"id": 1, "status": "queued", "html_url": "https://run/1"}
+    client = RunsClient(
+        [
+            {"id": 1, "status": "queued"},
+            {"id": 1, "status": "in_progress"},
+            {"id": 1, "status": "in_progress"},
+            {"id": 1, "status": "completed", "conclusion": "success"},
+        ]
+    )
+    sleeps.clear()
+    run = github.wait_workflow_run(client, "org/repo", run, 3600)
+    assert run["conclusion"] == "success"
+    assert sleeps == [5, 10, 20]
+    assert client.requests[0] == ("/repos/org/repo/actions/runs/1", None)
+
+
+def test_find_workflow_run_concurrent(monkeypatch):
+    """
+    Validate concurrent dispatches on the same reference are told apart
+    """
+    monkeypatch.setattr("taskboot.github.time.sleep", lambda delay: None)
+    monkeypatch.setattr("taskboot.github._claimed_runs", set())
+    runs = {
+        "workflow_runs": [
+            {
+                "id": 2,
+                "head_branch": "main",
+                "display_title": "Deploy 2c9e",
+                "html_url": "https://run/2",
+            },
+            {
+                "id": 1,
+                "head_branch": "main",
+                "display_title": "Deploy 17ab",
+                "html_url": "https://run/1",
+            },
+        ]
+    }
+    args = (RunsClient([runs] * 4), "org/repo", "ci.yml", "main", "2026-01-01", 60)
+
+    # The correlation id identifies each run
+    assert github.find_workflow_run(*args, correlation_id="17ab")["id"] == 1
+    assert github.find_workflow_run(*args, correlation_id="2c9e")["id"] == 2
+
+    # Without it, claimed runs are skipped and ambiguous matches fail
+    monkeypatch.setattr("taskboot.github._claimed_runs", {2})
+    assert github.find_workflow_run(*args)["id"] == 1
+    monkeypatch.setattr("taskboot.github._claimed_runs", set())
+    with pytest.raises(Exception, match="Several workflow runs match"):
+        github.find_workflow_run(*args)
+
+
+def test_wait_workflow_run_timeout(monkeypatch):
+    """
+    Validate waiting for a workflow run stops at the timeout
+    """
+    monkeypatch.setattr("taskboot.github.time.sleep", lambda delay: None)
+    clock = iter(range(0, 1000, 30))
+    monkeypatch.setattr("taskboot.github.time.monotonic", lambda: next(clock))
+
+    run = {"id": 1, "status": "queued", "html_url": "https://run/1"}
+    client = RunsClient([{"id": 1, "status": "queued"}] * 10)
+    with pytest.raises(Exception, match="Timeout after 100s"):
+        github.wait_workflow_run(client, "org/repo", run, 100)
+    assert len(client.requests) == 4
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import os
+import stat
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import pytest
+
+from taskboot.github_client import GithubClient
+
+
+class GithubHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for a few Github API endpoints
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=None, headers={}):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        headers = dict(self.server.headers, **headers)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        url = urlparse(self.path)
+
+        if self.server.rate_limited:
+            self.server.rate_limited -= 1
+            return self.send(
+                403, {"message": "Secondary rate limit"}, {"Retry-After": "5"}
+            )
+
+        headers = {}
+        if url.path == "/repos/org/repo":
+            body = {"full_name": "org/repo", "id": 1}
+        elif url.path == "/repos/org/repo/tags":
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            body = [{"name": "v{}".format(page)}]
+            if page < 3:
+                next_url = "http://{}:{}/repos/org/repo/tags?page={}".format(
+                    *self.server.server_address, page + 1
+                )
+                headers["Link"] = '<{}>; rel="next"'.format(next_url)
+        else:
+            return self.send(404, {"message": "Not Found"})
+
+        headers["ETag"] = '"{}"'.format(
+            hashlib.sha256(json.dumps(body).encode("utf-8")).hexdigest()
+        )
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            self.server.not_modified += 1
+            return self.send(304, headers=headers)
+        self.send(200, body, headers)
+
+    def do_POST(self):
+        self.server.requests.append(self.path)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        if self.server.rate_limited:
+            self.server.rate_limited -= 1
+            return self.send(
+                403, {"message": "Secondary rate limit"}, {"Retry-After": "5"}
+            )
+
+        self.server.uploads.append(body)
+        self.send(201, {"name": parse_qs(urlparse(self.path).query)["name"][0]})
+
+
+@pytest.fixture
+def github_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GithubHandler)
+    server.requests = []
+    server.not_modified = 0
+    server.rate_limited = 0
+    server.headers = {}
+    server.uploads = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr("taskboot.github_client.time.sleep", calls.append)
+    return calls
+
+
+def make_client(server, tmpdir, token="token"):
+    return GithubClient(
+        token,
+        base_url="http://{}:{}".format(*server.server_address),
+        cache_directory=str(tmpdir),
+    )
+
+
+def test_conditional_requests(github_api, tmpdir):
+    """
+    Validate repeated requests are answered from the cache through their ETag
+    """
+    client = make_client(github_api, tmpdir)
+    repository = {"full_name": "org/repo", "id": 1}
+    assert client.get("/repos/org/repo") == repository
+    assert client.get("/repos/org/repo") == repository
+    assert github_api.not_modified == 1
+
+    # The cache is shared by clients with the same token
+    assert make_client(github_api, tmpdir).get("/repos/org/repo") == repository
+    assert github_api.not_modified == 2
+    assert make_client(github_api, tmpdir, "other").get("/repos/org/repo")
+    assert github_api.not_modified == 2
+
+    assert client.get("/repos/org/missing", missing_ok=True) is None
+
+
+def test_cache_eviction(github_api, tmpdir, monkeypatch):
+    """
+    Validate cached responses are private, and evicted by age then size
+    """
+    client = make_client(github_api, tmpdir)
+    client.get("/repos/org/repo")
+    path = client.cache_path(client.build_url("/repos/org/repo"))
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    old = tmpdir.join("old.json")
+    old.write("{}")
+    os.utime(str(old), (0, 0))
+    make_client(github_api, tmpdir)
+    assert not old.check()
+    assert os.path.exists(path)
+
+    monkeypatch.setattr("taskboot.github_client.MAX_CACHE_SIZE", 0)
+    make_client(github_api, tmpdir)
+    assert not os.path.exists(path)
+
+
+def test_pagination(github_api, tmpdir):
+    """
+    Validate pages are loaded lazily and revalidated through their ETag
+    """
+    client = make_client(github_api, tmpdir)
+    tags = client.paginate("/repos/org/repo/tags")
+    assert next(tags) == {"name": "v1"}
+    assert len(github_api.requests) == 1
+    assert list(tags) == [{"name": "v2"}, {"name": "v3"}]
+
+    assert [tag["name"] for tag in client.paginate("/repos/org/repo/tags")] == [
+        "v1",
+        "v2",
+        "v3",
+    ]
+    assert github_api.not_modified == 3
+
+
+def test_rate_limits(github_api, tmpdir, sleeps):
+    """
+    Validate the client waits on rate limits
+    """
+    client = make_client(github_api, tmpdir)
+
+    # Secondary rate limit, with a delay to wait
+    github_api.rate_limited = 1
+    assert client.get("/repos/org/repo") == {"full_name": "org/repo", "id": 1}
+    assert sleeps == [5.0]
+
+    # Wait for the reset when few requests remain
+    github_api.headers = {
+        "X-RateLimit-Remaining": "2",
+        "X-RateLimit-Reset": str(int(time.time()) + 60),
+    }
+    client.get("/repos/org/repo")
+    assert len(sleeps) == 1
+    client.get("/repos/org/repo")
+    assert len(sleeps) == 2
+    assert 50 < sleeps[1] <= 60
+
+
+def test_upload_retries(github_api, tmpdir, sleeps):
+    """
+    Validate a release asset is sent in full again after a rate limit
+    """
+    client = make_client(github_api, tmpdir)
+    asset = tmpdir.join("asset.bin")
+    asset.write_binary(b"x" * 100000)
+    upload_url = "http://{}:{}/repos/org/repo/releases/1/assets{{?name,label}}".format(
+        *github_api.server_address
+    )
+
+    github_api.rate_limited = 1
+    assert client.upload(upload_url, str(asset), "asset.bin") == {"name": "asset.bin"}
+    assert github_api.uploads == [b"x" * 100000]
+    assert len(github_api.requests) == 2
+    assert 5.0 in sleeps
+
+
+def test_throttle_sleeps_unlocked(tmpdir, monkeypatch):
+    """
+    Validate all the threads wait for a reset, without holding the client lock
+    """
+    client = GithubClient("token", cache_directory=str(tmpdir))
+    client.rate_limit = (0, int(time.time()) + 60)
+    delays = []
+
+    def check_unlocked(delay):
+        assert not client.lock.locked()
+        delays.append(delay)
+
+    # All the threads wait for the reset, not only the first one
+    monkeypatch.setattr("taskboot.github_client.time.sleep", check_unlocked)
+    threads = [
+        threading.Thread(target=client.throttle, args=("GET",)) for _ in range(3)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(delays) == 3
+    assert all(50 < delay <= 60 for delay in delays)
+
+    # Nothing to wait once the reset is passed
+    client.rate_limit = (0, int(time.time()) - 1)
+    client.throttle("GET")
+    assert len(delays) == 3
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+
+from taskboot import history
+from taskboot.history import BuildHistory
+from taskboot.history import build_report
+
+
+def test_build_history(tmpdir, monkeypatch):
+    """
+    Validate the estimates and trends computed from the recorded builds
+    """
+    path = str(tmpdir.join("history.sqlite"))
+    with BuildHistory(path) as builds:
+        for i, duration in enumerate([10, 12, 11, 20, 22, 21]):
+            builds.record(
+                "repo", "app", {"build": duration, "save": 2, "compress": 1}, i
+            )
+        builds.record("repo", "tool", {"build": 5}, 0)
+        builds.record("other", "app", {"build": 100}, 0)
+
+    # The database is shared between runs
+    with BuildHistory(path) as builds:
+        assert builds.services("repo") == ["app", "tool"]
+        assert builds.estimate("repo", "app") == 19.0
+        assert builds.estimate("repo", "app", last=2) == 24.5
+        assert builds.estimate("repo", "tool") == 5
+        assert builds.estimate("repo", "db") is None
+
+        app, tool = builds.trends("repo")
+        assert app["builds"] == 6
+        assert app["build"] == {"last": 21, "median": 16.0, "trend": 0.909}
+        assert app["save"] == {"last": 2, "median": 2.0, "trend": 0.0}
+        assert tool == {
+            "service": "tool",
+            "builds": 1,
+            "build": {"last": 5, "median": 5.0, "trend": None},
+            "total": {"last": 5, "median": 5.0, "trend": None},
+        }
+
+        # Only the most recent builds are kept
+        monkeypatch.setattr(history, "MAX_HISTORY_RUNS", 3)
+        builds.record("repo", "app", {"build": 30}, 10)
+        assert [build["build"] for build in builds.builds("repo", "app")] == [
+            22,
+            21,
+            30,
+        ]
+
+
+def test_build_report(tmpdir, capsys):
+    """
+    Validate the trends are displayed as a table or as JSON
+    """
+    path = str(tmpdir.join("history.sqlite"))
+    with BuildHistory(path) as builds:
+        builds.record("repo", "app", {"build": 10, "save": 2}, 0)
+        builds.record("repo", "app", {"build": 15, "save": 2}, 1)
+
+    args = argparse.Namespace(
+        build_history=path, repository="repo", last=10, json=False
+    )
+    build_report(None, args)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1].split() == [
+        "service",
+        "builds",
+        "build",
+        "save",
+        "compress",
+        "total",
+    ]
+    assert lines[2].split() == [
+        "app",
+        "2",
+        *("15.0s", "/", "12.5s", "+50%"),
+        *("2.0s", "/", "2.0s", "+0%"),
+        "-",
+        *("17.0s", "/", "14.5s", "+42%"),
+    ]
+
+    args.json = True
+    build_report(None, args)
+    report = json.loads(capsys.readouterr().out)
+    assert report["repository"] == "repo"
+    assert [service["service"] for service in report["services"]] == ["app"]
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+
+import taskcluster
+
+from taskboot import build
+from taskboot.target import Target
+
+HOOK = {
+    "metadata": {"name": "Hook", "owner": "test@mozilla.com"},
+    "task": {"provisionerId": "proj", "payload": {"image": "taskboot"}},
+}
+
+
+class FakeHooks(object):
+    """
+    Hooks service with a fake state
+    """
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.calls = []
+
+    def ping(self):
+        pass
+
+    def hook(self, hook_group_id, hook_id):
+        if hook_id not in self.existing:
+            raise taskcluster.exceptions.TaskclusterRestFailure(
+                "Not found", None, status_code=404
+            )
+        return dict(self.existing[hook_id], hookGroupId=hook_group_id, hookId=hook_id)
+
+    def createHook(self, hook_group_id, hook_id, payload):
+        self.calls.append(("create", hook_id))
+
+    def updateHook(self, hook_group_id, hook_id, payload):
+        self.calls.append(("update", hook_id))
+
+
+class FakeConfiguration(object):
+    def __init__(self, args):
+        pass
+
+    def get_taskcluster_options(self):
+        return {}
+
+
+def test_hook_differences():
+    """
+    Validate hooks are compared semantically
+    """
+    remote = dict(
+        json.loads(json.dumps(HOOK)), bindings=[], hookGroupId="group", hookId="hook"
+    )
+    local = {"task": dict(reversed(HOOK["task"].items())), "metadata": HOOK["metadata"]}
+    assert build.hook_differences(local, remote) == []
+
+    # The service stores the default values of nested fields
+    remote["metadata"] = dict(HOOK["metadata"], emailOnError=True)
+    remote["triggerSchema"] = {"type": "object", "additionalProperties": False}
+    assert build.hook_differences(local, remote) == []
+    local["metadata"] = dict(HOOK["metadata"], emailOnError=False)
+    assert build.hook_differences(local, remote) == ["metadata"]
+
+    local["metadata"] = HOOK["metadata"]
+    local["schedule"] = ["0 0 * * *"]
+    local["task"] = {"provisionerId": "proj", "payload": {"image": "other"}}
+    assert build.hook_differences(local, remote) == ["schedule", "task"]
+
+
+def test_build_hooks(tmpdir, monkeypatch):
+    """
+    Validate only the changed hooks are updated or created
+    """
+    definitions = tmpdir.mkdir("hooks")
+    definitions.join("same.json").write(json.dumps(HOOK))
+    definitions.join("changed.yml").write(
+        json.dumps(dict(HOOK, schedule=["0 0 * * *"]))
+    )
+    definitions.join("new.json").write(json.dumps(HOOK))
+    definitions.join("README.md").write("Not a hook")
+
+    hooks = FakeHooks({"same": HOOK, "changed": HOOK})
+    monkeypatch.setattr(build.taskcluster, "Hooks", lambda options: hooks)
+    monkeypatch.setattr(build, "Configuration", FakeConfiguration)
+
+    target = Target(argparse.Namespace(target=str(tmpdir), git_repository=None))
+    args = argparse.Namespace(
+        hook_files=["hooks"], hook_group_id="group", jobs=2, dry_run=True
+    )
+    build.build_hooks(target, args)
+    assert hooks.calls == []
+
+    args.dry_run = False
+    build.build_hooks(target, args)
+    assert sorted(hooks.calls) == [("create", "new"), ("update", "changed")]
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import gzip
+import io
+import json
+import subprocess
+import tarfile
+
+from taskboot.layers import inspect_archive
+from taskboot.layers import inspect_image_archive
+
+
+def make_tar(files):
+    """
+    Build an uncompressed TAR archive from a mapping of paths to contents
+    """
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode="w") as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return output.getvalue()
+
+
+def make_archive(path):
+    """
+    Write a Docker archive with a plain layer and a gzip compressed one,
+    the second one overwriting and removing files from the first one
+    """
+    first = make_tar(
+        {"app/data.bin": b"\0" * 5000, "app/tmp.log": b"log" * 100, "etc/conf": b"x"}
+    )
+    second = gzip.compress(
+        make_tar({"app/data.bin": b"\1" * 6000, "app/.wh.tmp.log": b""})
+    )
+    config = {
+        "history": [
+            {"created_by": "/bin/sh -c #(nop) ADD file:abc in /"},
+            {"created_by": "/bin/sh -c #(nop) ENV A=1", "empty_layer": True},
+            {"created_by": "/bin/sh -c make && rm app/tmp.log"},
+        ]
+    }
+    manifest = [
+        {
+            "Config": "config.json",
+            "RepoTags": ["org/app:latest"],
+            "Layers": ["first/layer.tar", "blobs/sha256/second"],
+        }
+    ]
+    with tarfile.open(path, mode="w") as tar:
+        for name, content in (
+            ("first/layer.tar", first),
+            ("blobs/sha256/second", second),
+            ("config.json", json.dumps(config).encode("utf-8")),
+            ("manifest.json", json.dumps(manifest).encode("utf-8")),
+        ):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return len(first), len(second)
+
+
+def test_inspect_image_archive(tmpdir):
+    """
+    Validate the layers sizes, history and duplicated files of an archive
+    """
+    path = str(tmpdir.join("app.tar"))
+    first_size, second_size = make_archive(path)
+
+    report = inspect_image_archive(path, top=2)
+    (image,) = report["images"]
+    assert image["tags"] == ["org/app:latest"]
+
+    first, second = image["layers"]
+    assert first["created_by"] == "/bin/sh -c #(nop) ADD file:abc in /"
+    assert first["compression"] is None
+    assert first["size"] == first_size
+    assert 0 < first["compressed_size"] < first_size
+    assert first["files"] == 3
+    assert first["largest"] == [
+        {"path": "app/data.bin", "size": 5000},
+        {"path": "app/tmp.log", "size": 300},
+    ]
+
+    assert second["created_by"] == "/bin/sh -c make && rm app/tmp.log"
+    assert second["compression"] == "gzip"
+    assert second["compressed_size"] == second_size
+    assert second["size"] > second_size
+    assert second["files"] == 1
+
+    assert image["duplicated_files"] == 2
+    assert image["wasted_bytes"] == 5300
+    assert image["duplicates"] == [
+        {"path": "app/data.bin", "layers": [0, 1], "wasted_bytes": 5000},
+        {"path": "app/tmp.log", "layers": [0, 1], "wasted_bytes": 300},
+    ]
+
+    # Compressed archives are streamed through zstd
+    subprocess.run(["zstd", "--quiet", path], check=True)
+    compressed = inspect_image_archive(path + ".zst", top=2)
+    assert compressed["images"] == report["images"]
+
+
+def test_inspect_archive(hello_archive, capsys):
+    """
+    Validate the report of a Docker archive is displayed as text or JSON
+    """
+    args = argparse.Namespace(archive=str(hello_archive), top=10, json=False)
+    inspect_archive(None, args)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith("Image hello-world:latest: 3584 bytes, ")
+    assert lines[1].startswith("  Layer 0: 3584 bytes")
+    assert lines[2].split() == ["1840", "hello"]
+
+    args.json = True
+    inspect_archive(None, args)
+    report = json.loads(capsys.readouterr().out)
+    assert report["archive_size"] == hello_archive.stat().st_size
+    assert report["images"][0]["layers"][0]["largest"] == [
+        {"path": "hello", "size": 1840}
+    ]
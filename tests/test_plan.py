@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import threading
+
+import pytest
+
+from taskboot import plan
+from taskboot.plan import load_plan
+from taskboot.plan import run_plan
+
+
+def write_plan(tmpdir, content):
+    path = tmpdir.join("plan.yml")
+    path.write(content)
+    return str(path)
+
+
+def test_load_plan(tmpdir):
+    """
+    Validate steps run in order unless they list their needs
+    """
+    path = write_plan(
+        tmpdir,
+        """
+steps:
+  - name: build
+    command: build-compose --registry registry.example.com
+  - name: push
+    command: [push-artifact, --exclude-filter, "*-test"]
+  - name: release
+    needs: [build]
+    command: github-release org/project "1.0"
+  - command: deploy-s3
+""",
+    )
+    steps = load_plan(path)
+    assert [(step["name"], step["needs"]) for step in steps] == [
+        ("build", []),
+        ("push", ["build"]),
+        ("release", ["build"]),
+        ("3", ["release"]),
+    ]
+    assert steps[0]["command"] == [
+        "build-compose",
+        "--registry",
+        "registry.example.com",
+    ]
+    assert steps[2]["command"] == ["github-release", "org/project", "1.0"]
+
+    path = write_plan(tmpdir, "steps:\n  - name: a\n    needs: [b]\n    command: x")
+    with pytest.raises(AssertionError, match="Unknown step b in a"):
+        load_plan(path)
+
+
+def make_parser(calls, barrier):
+    """
+    Build a parser with commands recording their calls
+    """
+
+    def _record(target, args):
+        calls.append((args.command, args.secret, args.config.read()))
+        if args.command == "parallel":
+            barrier.wait(timeout=5)
+        elif args.command == "fail":
+            raise Exception("Step failure")
+
+    parser = argparse.ArgumentParser()
+    for option in plan.GLOBAL_OPTIONS:
+        parser.add_argument("--" + option.replace("_", "-"))
+    commands = parser.add_subparsers(dest="command")
+    for name in ("first", "parallel", "fail", "last"):
+        commands.add_parser(name).set_defaults(func=_record)
+    return parser
+
+
+def test_run_plan(tmpdir, monkeypatch):
+    """
+    Validate steps share the global options, and independent ones run concurrently
+    """
+    calls = []
+    barrier = threading.Barrier(2)
+    monkeypatch.setattr(
+        "taskboot.cli.build_parser",
+        lambda environ, cwd: make_parser(calls, barrier),
+    )
+    config = tmpdir.join("config.yml")
+    config.write("git: {}")
+
+    path = write_plan(
+        tmpdir,
+        """
+steps:
+  - name: first
+    command: first
+  - name: a
+    needs: [first]
+    command: parallel
+  - name: b
+    needs: [first]
+    command: parallel
+  - name: last
+    needs: [a, b]
+    command: last
+""",
+    )
+    args = argparse.Namespace(
+        plan=path,
+        jobs=4,
+        secret="project/secret",
+        config=open(str(config)),
+        environ={},
+        cwd=None,
+    )
+    for option in plan.GLOBAL_OPTIONS:
+        if not hasattr(args, option):
+            setattr(args, option, None)
+    run_plan(None, args)
+    assert [call[0] for call in calls] == ["first", "parallel", "parallel", "last"]
+    assert {call[1:] for call in calls} == {("project/secret", "git: {}")}
+
+    # No step starts after a failure
+    calls.clear()
+    args.plan = write_plan(
+        tmpdir, "steps:\n  - command: first\n  - command: fail\n  - command: last"
+    )
+    args.config = open(str(config))
+    with pytest.raises(Exception, match="Step failure"):
+        run_plan(None, args)
+    assert [call[0] for call in calls] == ["first", "fail"]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import pstats
+import subprocess
+import sys
+
+import pytest
+
+from taskboot.profiling import Profiler
+from taskboot.tracing import span
+from taskboot.tracing import track_subprocess
+
+
+def workload():
+    with span("build"):
+        command = [sys.executable, "-c", "import time; time.sleep(0.1)"]
+        with track_subprocess(command):
+            subprocess.run(command, check=True)
+        return [str(i) for i in range(100000)]
+
+
+@pytest.mark.parametrize("mode", ["cprofile", "sampling", "tracemalloc"])
+def test_profiler(tmp_path, mode):
+    """
+    Validate each profiling mode writes its output and the spans report
+    """
+    output = tmp_path / "profile"
+    with Profiler(mode, str(output)):
+        workload()
+
+    assert output.exists()
+    if mode == "cprofile":
+        stats = pstats.Stats(str(output))
+        assert any(name == "workload" for _, _, name in stats.stats)
+    elif mode == "sampling":
+        assert "span:build;" in output.read_text()
+    else:
+        assert output.read_text().startswith("Peak memory: ")
+
+    # Subprocess time is attributed to the calling span
+    report = json.loads((tmp_path / "profile.spans.json").read_text())
+    build = [s for s in report["spans"] if s["name"] == "build"][-1]
+    assert build["subprocesses"][sys.executable.rsplit("/", 1)[-1]] >= 0.1
+
+
+def test_profiler_disabled(tmp_path, monkeypatch):
+    """
+    No profile is written without a mode
+    """
+    monkeypatch.chdir(tmp_path)
+    with Profiler(None):
+        workload()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import json
+import threading
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from taskboot.pypi import filter_published
+from taskboot.pypi import ignore_leftovers
+from taskboot.pypi import index_auth
+from taskboot.pypi import list_index_files
+from taskboot.pypi import parse_distribution_name
+
+WHEEL = "my_project-1.0.0-py3-none-any.whl"
+SDIST = "my_project-1.0.0.tar.gz"
+
+
+class IndexHandler(BaseHTTPRequestHandler):
+    """
+    Local simple index, serving JSON or HTML pages
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/simple/my-project/":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        if self.server.json:
+            content_type = "application/vnd.pypi.simple.v1+json"
+            body = json.dumps(
+                {"files": [{"filename": WHEEL, "hashes": {"sha256": "abcd"}}]}
+            )
+        else:
+            content_type = "text/html"
+            body = '<a href="/files/{}#sha256=abcd">{}</a>'.format(WHEEL, WHEEL)
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def index():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), IndexHandler)
+    server.json = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_distribution_name():
+    assert parse_distribution_name(f"/dist/{WHEEL}") == ("my-project", "1.0.0")
+    assert parse_distribution_name(f"/dist/{SDIST}") == ("my-project", "1.0.0")
+
+
+@pytest.mark.parametrize("use_json", [True, False])
+def test_list_index_files(index, use_json):
+    """
+    Validate the files are listed from the JSON and HTML simple APIs
+    """
+    index.json = use_json
+    url = "http://{}:{}/simple/".format(*index.server_address)
+    assert list_index_files(url, "My_Project") == {WHEEL: "abcd"}
+    assert list_index_files(url, "other") == {}
+
+
+def test_index_auth():
+    """
+    Validate the upload credentials are only sent to the upload host
+    """
+    config = Namespace(pypi={"username": "user", "password": "secret"})
+    assert (
+        index_auth(
+            "https://pypi.org/simple/", "https://upload.pypi.org/legacy/", config
+        )
+        is None
+    )
+    assert index_auth(
+        "https://pypi.corp.example/simple/", "https://pypi.corp.example/upload/", config
+    ) == ("user", "secret")
+    assert (
+        index_auth(
+            "http://pypi.corp.example/simple/",
+            "https://pypi.corp.example/upload/",
+            config,
+        )
+        is None
+    )
+
+
+def test_filter_published(tmpdir):
+    """
+    Validate published files are skipped, unless their content changed
+    """
+    wheel = tmpdir.join(WHEEL)
+    wheel.write_binary(b"wheel")
+    sdist = tmpdir.join(SDIST)
+    sdist.write_binary(b"sdist")
+    build = [str(wheel), str(sdist)]
+
+    digest = hashlib.sha256(b"wheel").hexdigest()
+    assert filter_published(build, {WHEEL: digest}) == [str(sdist)]
+    assert filter_published(build, {WHEEL: None, SDIST: None}) == []
+
+    with pytest.raises(Exception, match="already published with another content"):
+        filter_published(build, {WHEEL: "abcd"})
+
+
+def test_ignore_leftovers(tmpdir):
+    """
+    Validate build outputs are only ignored at the root of the project
+    """
+    root = str(tmpdir)
+    ignore = ignore_leftovers(root)
+    names = ["build", "dist", "project.egg-info", "src", "setup.py"]
+    assert ignore(root, names) == ["build", "dist", "project.egg-info"]
+    assert ignore(str(tmpdir.join("src")), names) == []
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import http.client
+import subprocess
+
+import pytest
+import requests
+
+from taskboot.retry import RetryPolicy
+from taskboot.tracing import tracer
+from taskboot.utils import retry
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers={}):
+        self.status_code = status_code
+        self.headers = headers
+
+
+def http_error(status, headers={}):
+    return requests.HTTPError(response=FakeResponse(status, headers))
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """
+    Record sleeps instead of waiting
+    """
+    calls = []
+    monkeypatch.setattr("taskboot.retry.time.sleep", calls.append)
+    return calls
+
+
+def test_classification():
+    """
+    Validate the transient/permanent classification of failures
+    """
+    policy = RetryPolicy("test", transient_exit_codes={128})
+
+    assert policy.is_transient(http_error(503))
+    assert policy.is_transient(http_error(429))
+    assert not policy.is_transient(http_error(404))
+    assert not policy.is_transient(http_error(401))
+    assert policy.is_transient(http.client.IncompleteRead(b"partial"))
+    assert policy.is_transient(requests.exceptions.ConnectionError())
+    assert not policy.is_transient(AssertionError("No content-length"))
+    assert policy.is_transient(subprocess.CalledProcessError(128, ["git"]))
+    assert policy.is_transient(subprocess.CalledProcessError(-9, ["git"]))
+    assert not policy.is_transient(subprocess.CalledProcessError(1, ["git"]))
+    assert policy.is_transient(Exception("Unknown"))
+
+    # Without specific exit codes, all failed commands are retried
+    assert RetryPolicy("test").is_transient(subprocess.CalledProcessError(1, ["git"]))
+
+
+def test_backoff():
+    """
+    Validate the exponential backoff, bounded by the maximum delay
+    """
+    policy = RetryPolicy("test", base_delay=1, multiplier=2, max_delay=5, jitter=0)
+    assert [policy.delay(attempt) for attempt in range(1, 6)] == [1, 2, 4, 5, 5]
+
+    policy = policy.copy(jitter=0.5)
+    assert all(2 <= policy.delay(3) <= 4 for _ in range(100))
+
+
+def test_retry_transient(sleeps):
+    """
+    Transient failures are retried until success
+    """
+    calls = []
+
+    def _operation():
+        calls.append(1)
+        if len(calls) < 3:
+            raise http_error(503, {"Retry-After": "7"})
+        return "done"
+
+    policy = RetryPolicy("transient", base_delay=1, jitter=0)
+    assert policy.run(_operation) == "done"
+    assert len(calls) == 3
+    assert sleeps == [7, 7]
+    assert tracer.counters["retry:transient"] == {
+        "attempts": 3,
+        "retries": 2,
+        "sleep": 14,
+    }
+
+
+def test_retry_permanent(sleeps):
+    """
+    Permanent failures are raised at once
+    """
+    calls = []
+
+    def _operation():
+        calls.append(1)
+        raise http_error(404)
+
+    with pytest.raises(requests.HTTPError):
+        RetryPolicy("permanent").run(_operation)
+    assert len(calls) == 1
+    assert sleeps == []
+
+    # Without a policy, all failures are retried at a fixed interval
+    calls.clear()
+    with pytest.raises(requests.HTTPError):
+        retry(_operation, retries=3, wait_between_retries=7)
+    assert len(calls) == 3
+    assert sleeps == [7, 7]
+
+    calls.clear()
+    sleeps.clear()
+    with pytest.raises(requests.HTTPError):
+        retry(_operation, exception_to_break=requests.HTTPError)
+    assert len(calls) == 1
+    assert sleeps == []
+
+
+def test_retry_limits(sleeps):
+    """
+    Retries stop after the maximum number of attempts or the deadline
+    """
+
+    def _operation():
+        raise requests.exceptions.ConnectionError()
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        RetryPolicy("attempts", retries=3, base_delay=1, jitter=0).run(_operation)
+    assert sleeps == [1, 2]
+
+    sleeps.clear()
+    policy = RetryPolicy("deadline", retries=10, base_delay=10, jitter=0, deadline=35)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        policy.run(_operation)
+    assert sleeps == [10, 20]
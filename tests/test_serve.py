@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import argparse
+import json
+import logging
+import os
+import socket
+import threading
+
+import pytest
+
+from taskboot.config import Configuration
+from taskboot.serve import JobServer
+from taskboot.serve import submit
+
+logger = logging.getLogger(__name__)
+
+
+def make_parser(workspaces, environ, cwd):
+    """
+    Build a parser with commands logging from the jobs
+    """
+
+    def _hello(target, args):
+        workspaces.append(target.dir)
+        logger.info(f"Hello {args.name}")
+
+    def _fail(target, args):
+        raise Exception("Broken job")
+
+    def _environ(target, args):
+        options = Configuration(args).get_taskcluster_options()
+        logger.info(
+            "Running {} for {} on {}".format(
+                args.git_revision, args.secret_cache.task_id, options["rootUrl"]
+            )
+        )
+
+    def _secret(target, args):
+        cache = args.secret_cache
+        logger.info(f"Cached {cache.get('project/secret')}")
+        cache.add("project/secret", {"task": cache.task_id})
+
+    parser = argparse.ArgumentParser()
+    parser.set_defaults(environ=environ, cwd=cwd)
+    parser.add_argument("--target")
+    parser.add_argument("--secret")
+    parser.add_argument("--config")
+    parser.add_argument("--git-revision", default=environ.get("GIT_REVISION"))
+    parser.add_argument("--git-repository")
+    parser.add_argument("--metrics-out")
+    commands = parser.add_subparsers(dest="command")
+    hello = commands.add_parser("hello")
+    hello.add_argument("name")
+    hello.set_defaults(func=_hello)
+    commands.add_parser("fail").set_defaults(func=_fail)
+    commands.add_parser("secret").set_defaults(func=_secret)
+    commands.add_parser("environ").set_defaults(func=_environ)
+    commands.add_parser("serve")
+    return parser
+
+
+@pytest.fixture
+def server(tmpdir):
+    path = str(tmpdir.join("taskboot.sock"))
+    workspaces = []
+    server = JobServer(
+        path,
+        lambda environ, cwd: make_parser(workspaces, environ, cwd),
+        concurrency=1,
+    )
+    server.workspaces = workspaces
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_submit_jobs(server, tmpdir, capsys, caplog):
+    """
+    Validate jobs run in their own workspace, with their logs sent to the client
+    """
+    caplog.set_level(logging.INFO)
+    metrics = str(tmpdir.join("metrics.json"))
+    for name in ("alice", "bob"):
+        args = argparse.Namespace(
+            socket=server.server_address,
+            job=["--", "--metrics-out", metrics, "hello", name],
+        )
+        submit(None, args)
+        assert f"INFO:test_serve:Hello {name}" in capsys.readouterr().out
+
+    assert len(set(server.workspaces)) == 2
+    assert not any(map(os.path.exists, server.workspaces))
+    with open(metrics) as f:
+        assert [span["name"] for span in json.load(f)["spans"]] == ["job"]
+
+    args = argparse.Namespace(socket=server.server_address, job=["fail"])
+    with pytest.raises(Exception, match="Job 3 failed: Broken job"):
+        submit(None, args)
+
+    args = argparse.Namespace(socket=server.server_address, job=["serve"])
+    with pytest.raises(Exception, match="Invalid command"):
+        submit(None, args)
+
+
+def test_job_secrets(server, tmpdir, capsys, caplog, monkeypatch):
+    """
+    Validate jobs only share the cached secrets of their task
+    """
+    caplog.set_level(logging.INFO)
+    monkeypatch.setattr("taskboot.cache.SECRET_CACHE_DIRS", (str(tmpdir),))
+    args = argparse.Namespace(socket=server.server_address, job=["secret"])
+    for task_id, cached in (
+        ("task-a", "None"),
+        ("task-a", "{'task': 'task-a'}"),
+        ("task-b", "None"),
+    ):
+        monkeypatch.setenv("TASK_ID", task_id)
+        submit(None, args)
+        assert f"INFO:test_serve:Cached {cached}" in capsys.readouterr().out
+
+    # Without a task, secrets are not cached across jobs
+    monkeypatch.delenv("TASK_ID")
+    for _ in range(2):
+        submit(None, args)
+        assert "INFO:test_serve:Cached None" in capsys.readouterr().out
+
+
+def send_request(server, request):
+    """
+    Send a raw request to the server, returning its last message
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(server.server_address)
+        client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        messages = [json.loads(line) for line in client.makefile("rb")]
+    return messages
+
+
+def test_job_environment(server, tmpdir, caplog, monkeypatch):
+    """
+    Validate jobs run with the environment of their client, never the server one
+    """
+    caplog.set_level(logging.INFO)
+    monkeypatch.setenv("TASK_ID", "server-task")
+    monkeypatch.setenv("GIT_REVISION", "server-revision")
+    monkeypatch.setenv("TASKCLUSTER_PROXY_URL", "http://server-proxy")
+
+    environ = {
+        "TASK_ID": "client-task",
+        "GIT_REVISION": "client-revision",
+        "TASKCLUSTER_PROXY_URL": "http://client-proxy",
+    }
+    messages = send_request(
+        server, {"argv": ["environ"], "environ": environ, "cwd": str(tmpdir)}
+    )
+    assert messages[-1]["status"] == "success"
+    assert {
+        "log": "INFO:test_serve:Running client-revision for client-task "
+        "on http://client-proxy"
+    } in messages
+
+    # Requests without the client environment and directory are rejected
+    for request in (
+        {"argv": ["environ"]},
+        {"argv": ["environ"], "environ": environ},
+        {"argv": ["environ"], "environ": environ, "cwd": "relative"},
+    ):
+        assert send_request(server, request) == [
+            {"status": "error", "error": "Invalid request"}
+        ]
+
+
+def test_client_parser(monkeypatch):
+    """
+    Validate the parser of a job uses the defaults and directory of its client
+    """
+    from taskboot.cli import build_parser
+
+    monkeypatch.setenv("GIT_REVISION", "server-revision")
+    environ = {"GIT_REVISION": "client-revision", "TASKBOOT_METRICS_OUT": "out.json"}
+    args = build_parser(environ, "/client").parse_args(
+        ["--target", "src", "build", "--write", "/abs/image.tar", "Dockerfile"]
+    )
+    assert args.git_revision == "client-revision"
+    assert args.metrics_out == "/client/out.json"
+    assert args.target == "/client/src"
+    assert args.write == "/abs/image.tar"
+    assert args.dockerfile == "Dockerfile"
+    assert args.environ is environ
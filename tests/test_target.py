@@ -4,8 +4,13 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import subprocess
 
+import pytest
+
+from taskboot.retry import POLICIES
 from taskboot.target import Target
+from taskboot.tracing import tracer
 
 
 class Config(object):
@@ -28,3 +33,24 @@ def test_path():
     path = target.check_path("test.txt")
     assert os.path.exists(path)
     assert path.startswith(target.dir)
+
+
+def test_clone_retries_timing(tmpdir, monkeypatch):
+    """
+    Validate the delays between the retries of a fetch are not counted as git time
+    """
+    monkeypatch.setitem(
+        POLICIES,
+        "clone",
+        POLICIES["clone"].copy(retries=2, base_delay=0.5, jitter=0, deadline=None),
+    )
+    target = Target(Config())
+
+    with tracer.span("test") as root:
+        with pytest.raises(subprocess.CalledProcessError):
+            target.clone(str(tmpdir.join("missing")), "master")
+    (clone,) = [span for span in tracer.spans if span.parent is root]
+    tracer.forget(root)
+
+    assert clone.duration >= 0.5
+    assert clone.subprocesses["git"] < clone.duration - 0.4
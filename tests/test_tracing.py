@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+import pytest
+
+from taskboot.tracing import Tracer
+
+
+def test_spans_report(tmp_path):
+    """
+    Validate the phases report built from nested spans
+    """
+    tracer = Tracer()
+
+    with tracer.span("download", artifact="public/image.tar.zst") as download:
+        download.add_bytes(1024)
+        download.add_retry()
+        with tracer.span("decompress") as decompress:
+            decompress.add_bytes(4096)
+            assert tracer.current() is decompress
+
+    with pytest.raises(ValueError):
+        with tracer.span("download"):
+            raise ValueError("broken")
+
+    assert tracer.current() is None
+
+    report = tracer.report(command="push-artifact")
+    assert report["command"] == "push-artifact"
+    assert report["phases"]["download"]["count"] == 2
+    assert report["phases"]["download"]["bytes"] == 1024
+    assert report["phases"]["download"]["retries"] == 1
+    assert report["phases"]["decompress"] == {
+        "count": 1,
+        "duration": report["spans"][1]["duration"],
+        "bytes": 4096,
+        "retries": 0,
+    }
+    assert report["slowest"] in ("download", "decompress")
+    assert [span["path"] for span in report["spans"]] == [
+        "download",
+        "download/decompress",
+        "download",
+    ]
+    assert report["spans"][0]["attributes"] == {"artifact": "public/image.tar.zst"}
+    assert report["spans"][2]["error"] == "ValueError('broken')"
+
+    # The report is written as JSON
+    path = tmp_path / "metrics.json"
+    tracer.write_report(str(path), command="push-artifact")
+    assert json.loads(path.read_text())["phases"].keys() == {"download", "decompress"}
+
+
+def test_job_report():
+    """
+    Validate a report can be restricted to a root span, and dropped
+    """
+    tracer = Tracer()
+    with tracer.span("job") as first:
+        with tracer.span("build"):
+            pass
+    with tracer.span("job") as second:
+        pass
+
+    report = tracer.report(command="build", root=first)
+    assert [span["path"] for span in report["spans"]] == ["job", "job/build"]
+    assert report["spans"][0]["start"] == 0
+
+    tracer.forget(first)
+    assert tracer.report()["spans"] == [second.to_dict(tracer.origin)]